@@ -0,0 +1,344 @@
+"""
+Micro-benchmarks of the CPM sampling kernels.
+
+Run from the project directory:
+   python benchmark.py
+"""
+
+#################################
+
+# System modules
+import bz2
+import pickle
+import tempfile
+import time
+from pathlib import Path
+
+# Installed modules
+import numba
+import numpy as np
+from numba import jit
+from scipy import sparse
+
+# Local modules
+import parameters as PAR
+from simulation import cpm as CPM
+from simulation.kernels import do_steps
+from simulation.state import UNIFORM, run_state
+
+#################################
+
+def make_tissue(width=PAR.width, height=PAR.height, cell_number=PAR.initial_cell_number, init_MCS=PAR.init_MCS,
+                seed=PAR.seed):
+    """
+    Set up an initialised tissue using the parameters defined in the input file.
+    """
+
+    params = {
+              "A0"      : PAR.target_volume,
+              "P0"      : PAR.target_surface,
+              "lambda_A": PAR.lambda_volume,
+              "lambda_P": PAR.lambda_surface,
+              "W"       : PAR.adhesion_table,
+              "T"       : PAR.kT,
+              "sampler" : PAR.sampler,
+              "seed"    : seed
+             }
+
+    cpm = CPM.CPM(params)
+    cpm.make_grid(width, height)
+    cpm.generate_cells(N_cell_dict={"E": cell_number[0],
+                                    "T": cell_number[1],
+                                    "X": cell_number[2]})
+    cpm.make_init("circle",
+                  (np.sqrt(PAR.target_volume[0]) / np.pi) * 0.8,
+                  (np.sqrt(PAR.target_volume[0]) / np.pi) * 0.9
+                  )
+    cpm.initialize(J0=-8, n_initialise_steps=init_MCS)
+    return cpm
+
+
+def attempts_per_second(run, n_attempts, repeats=3):
+    """
+    Time **run(n_attempts)** and return the best throughput over **repeats**, in attempts per second.
+    The function is called once beforehand, such that compilation is not timed.
+    """
+    run(1)
+    best = np.inf
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        run(n_attempts)
+        best = min(best, time.perf_counter() - t0)
+    return n_attempts / best
+
+
+#################################
+# Reference implementation of the sampler before the per-attempt path was made allocation-free.
+
+@jit(nopython=True)
+def legacy_do_steps(n_steps, I, num_x, num_y, dP_z, A, P, lambda_A, lambda_P, A0, P0, J_diff, T, primes, hashes):
+    for _ in range(n_steps):
+        picked = False
+        while picked is False:
+            i = int(np.random.random() * num_x)
+            j = int(np.random.random() * num_y)
+            if not ((i * j == 0) or (((i - num_x + 1) * (j - num_y + 1)) == 0)):
+                s = I[i, j]
+                neighbour_options = np.array([[1, 0], [-1, 0], [0, 1], [0, -1]])
+                ni = neighbour_options[int(np.random.random() * 4)]
+                s2 = I[np.mod(ni[0] + i, num_x), np.mod(ni[1] + j, num_y)]
+                if s != s2:
+                    picked = True
+        Na = I[i - 1:i + 2, j - 1:j + 2]
+        dH_1, dH_2 = 0., 0.
+        mask_id_1, mask_id_2 = 0, 0
+        dP_1, dP_2, dA_1, dA_2 = 0, 0, 0, 0
+        if s != 0:
+            mask_id_1 = legacy_get_mask_id(Na == s, primes, hashes)
+            if mask_id_1 != -1:
+                dP_1, dA_1 = dP_z[mask_id_1], -1
+                dH_1 = (lambda_A[s] * (A[s] + dA_1 - A0[s]) ** 2 + lambda_P[s] * (P[s] + dP_1 - P0[s]) ** 2
+                        - lambda_A[s] * (A[s] - A0[s]) ** 2 - lambda_P[s] * (P[s] - P0[s]) ** 2)
+        if s2 != 0:
+            mask_id_2 = legacy_get_mask_id(Na == s2, primes, hashes)
+            if mask_id_2 != -1:
+                dP_2, dA_2 = dP_z[mask_id_2], 1
+                dH_2 = (lambda_A[s2] * (A[s2] + dA_2 - A0[s2]) ** 2 + lambda_P[s2] * (P[s2] + dP_2 - P0[s2]) ** 2
+                        - lambda_A[s2] * (A[s2] - A0[s2]) ** 2 - lambda_P[s2] * (P[s2] - P0[s2]) ** 2)
+        dJ = J_diff[s2, s].take(Na.take([0, 1, 2, 3, 5, 6, 7, 8])).sum()
+        dH = dH_1 + dH_2 + dJ
+        if (mask_id_1 != -1) * (mask_id_2 != -1):
+            if dH <= 0 or np.random.random() < np.exp(-dH / T):
+                I[i, j] = s2
+                A[s] += dA_1
+                A[s2] += dA_2
+                P[s] += dP_1
+                P[s2] += dP_2
+
+
+@jit(nopython=True)
+def legacy_get_mask_id(the_mask, primes, hashes):
+    hash = np.sum(the_mask * primes)
+    for k in range(len(hashes)):
+        if hash == hashes[k]:
+            return k
+    return -1
+
+
+def legacy_J_diff(cpm):
+    """
+    The dense (n_cells+1)^3 array of changes in interfacial energy used by the reference implementation, built from the
+    type-indexed interfacial energies of the CPM object.
+    """
+    ids = np.arange(len(cpm.cell_type))
+    J = cpm.get_J(ids[:, None], ids[None, :])
+    return np.expand_dims(J, 1) - np.expand_dims(J, 0)
+
+
+#################################
+
+def bench_attempts(n_attempts=200000):
+    """
+    Compare the attempts per second of the allocation-free Metropolis kernel with the reference implementation,
+    and with the other samplers of the dense sigma field (for which attempts are counted as equivalent steps of the
+    "uniform" sampler). The "tiled" sampler is compared in **bench_sparse_domain**.
+    """
+    cpm = make_tissue()
+    z = cpm.sample.zmasks
+    J_diff = legacy_J_diff(cpm)
+
+    def run_legacy(n):
+        legacy_do_steps(n, cpm.sigma_field, cpm.num_x, cpm.num_y, z.dP_z, cpm.A, cpm.P, cpm.lambda_A, cpm.lambda_P,
+                        cpm.A0, cpm.P0, J_diff, cpm.sample.T, z.primes, z.hashes)
+
+    def run_current(n):
+        cpm.sample.run(n)
+
+    print("Metropolis kernel (%d x %d lattice, %d cells)" % (cpm.num_x, cpm.num_y, cpm.n_cells))
+    before = attempts_per_second(run_legacy, n_attempts)
+    print("  %-15s %12.0f attempts/s" % ("before", before))
+    for sampler in cpm.sample.samplers:
+        if sampler == "tiled":
+            continue
+        cpm.sample.sampler = sampler
+        after = attempts_per_second(run_current, n_attempts)
+        print("  %-15s %12.0f attempts/s (%.1fx)" % (sampler, after, after / before))
+
+
+def bench_call_overhead(n_calls=100000):
+    """
+    Compare the cost of calling the compiled kernels with separate arrays and with a **CPMState**, performing no steps.
+    """
+    cpm = make_tissue()
+    z = cpm.sample.zmasks
+    cpm.sample.sampler = "uniform"
+    args = (cpm.sigma_field, cpm.num_x, cpm.num_y, z.dP_table, cpm.A, cpm.P, cpm.lambda_A, cpm.lambda_P, cpm.A0, cpm.P0,
+            cpm.adhesion, cpm.sample.T, z.allowed, cpm.rng)
+    state = cpm.sample.get_state()
+
+    def call_arrays(n):
+        for _ in range(n):
+            do_steps(0, *args)
+
+    def call_state(n):
+        for _ in range(n):
+            run_state(state, UNIFORM, 0)
+
+    def call_sample(n):
+        for _ in range(n):
+            cpm.sample.run(0)
+
+    print("Cost per call of the compiled kernels")
+    for name, call in (("arrays", call_arrays), ("CPMState", call_state), ("Sample.run", call_sample)):
+        print("  %-15s %8.2f us" % (name, 1e6 / attempts_per_second(call, n_calls)))
+
+
+def mcs_to_convergence(energies, mcs, threshold):
+    """
+    First MCS at which the energy trajectory reaches **threshold**.
+    """
+    reached = np.nonzero(energies <= threshold)[0]
+    return mcs[reached[0]] if len(reached) else np.nan
+
+
+def bench_convergence(samplers=("uniform", "heat_bath"), n_mcs=100, n_points=100, n_repeats=3, tolerance=0.05):
+    """
+    Compare samplers in MCS (and wall-clock time) to convergence of the total energy, starting from the same
+    initialised tissue.
+
+    A run has converged once its energy is within **tolerance** of the energy plateau of its sampler (mean over the
+    last quarter of the runs of the sampler) relative to the initial energy, such that every sampler is measured
+    against its own stationary state.
+    """
+    tissue = make_tissue()
+    sigma_0, A_0, P_0 = tissue.sigma_field.copy(), tissue.A.copy(), tissue.P.copy()
+    mcs = np.linspace(0, n_mcs, n_points + 1)
+
+    trajectories, timings = {}, {}
+    for sampler in samplers:
+        trajectories[sampler], timings[sampler] = [], []
+        for _ in range(n_repeats):
+            tissue.sigma_field, tissue.A, tissue.P = sigma_0.copy(), A_0.copy(), P_0.copy()
+            tissue.energy = None
+            tissue.sample.sampler = sampler
+            tissue.sample.run(1)  # compile outside of the timing.
+            energies = [tissue.get_energy()]
+            t0 = time.perf_counter()
+            for _ in range(n_points):
+                tissue.do_mcs(n_mcs / n_points)
+                energies.append(tissue.energy)
+            timings[sampler].append(time.perf_counter() - t0)
+            trajectories[sampler].append(np.array(energies))
+
+    E0 = trajectories[samplers[0]][0][0]
+    print("Convergence of the total energy (%d x %d lattice, %d cells, kT = %g, initial energy %.1f)"
+          % (tissue.num_x, tissue.num_y, tissue.n_cells, tissue.sample.T, E0))
+    for sampler in samplers:
+        plateau = np.mean([E[-n_points // 4:] for E in trajectories[sampler]])
+        threshold = plateau + tolerance * (E0 - plateau)
+        mcs_conv = np.array([mcs_to_convergence(E, mcs, threshold) for E in trajectories[sampler]])
+        t_mcs = np.mean(timings[sampler]) / n_mcs
+        print("  %-15s plateau %8.1f %8.1f MCS to convergence, %8.3f s/MCS, %8.2f s to convergence"
+              % (sampler, plateau, np.nanmean(mcs_conv), t_mcs, np.nanmean(mcs_conv) * t_mcs))
+
+
+def bench_threads(size=400, n_mcs=5):
+    """
+    Scaling of the "checkerboard" sampler with the number of threads of numba, from one thread to all the threads
+    available (see **numba.config.NUMBA_NUM_THREADS**), in attempts per second and speed-up over one thread.
+    """
+    cpm = make_tissue(size, size, [size ** 2 // 200] * 3, init_MCS=1000, seed=0)
+    cpm.sample.sampler = "checkerboard"
+    n_max = numba.config.NUMBA_NUM_THREADS
+    print("Scaling of \"checkerboard\" (%d x %d lattice, %d cells, %d threads available)"
+          % (cpm.num_x, cpm.num_y, cpm.n_cells, n_max))
+    rate_1 = None
+    for n_threads in sorted({1, 2, 4, 8, 16, 32, n_max}):
+        if n_threads > n_max:
+            continue
+        numba.set_num_threads(n_threads)
+        rate = attempts_per_second(cpm.sample.run, int(n_mcs * cpm.sample.attempts_per_mcs))
+        rate_1 = rate if rate_1 is None else rate_1
+        print("  %3d threads %12.0f attempts/s (%.2fx)" % (n_threads, rate, rate / rate_1))
+    numba.set_num_threads(n_max)
+
+
+def bench_setup(cell_numbers=(100, 1000, 10000, 100000)):
+    """
+    Time the setup of the cells and of their interfacial energies, and compare the memory of the type-indexed
+    interfacial energies with that of a dense (n_cells+1)^3 array of changes in interfacial energy.
+    """
+    print("Setup of the cells and of their interfacial energies")
+    for n in cell_numbers:
+        cpm = CPM.CPM({"A0": PAR.target_volume, "P0": PAR.target_surface, "lambda_A": PAR.lambda_volume,
+                       "lambda_P": PAR.lambda_surface, "W": PAR.adhesion_table, "T": PAR.kT})
+        t0 = time.perf_counter()
+        cpm.generate_cells(N_cell_dict={"E": n // 3, "T": n // 3, "X": n - 2 * (n // 3)})
+        elapsed = time.perf_counter() - t0
+        memory = sum(x.nbytes for x in cpm.adhesion if x is not None)
+        print("  %8d cells %10.4f s %12d bytes (dense: %.3g bytes)" % (n, elapsed, memory, 8. * (n + 1) ** 3))
+
+
+def bench_sparse_domain(sizes=(100, 300, 1000), tile_size=32, n_attempts=20000):
+    """
+    Compare the dense sigma field, sampled by "uniform", with the tiled lattice, sampled by "tiled", for the same small
+    tissue on lattices of growing size: memory of the sigma field, and throughput in attempts per second, where an
+    attempt is one proposed swap between different indices (see **kernels.pick_pixel**).
+    """
+    print("Small tissue on a growing lattice: dense \"uniform\" vs \"tiled\"")
+    for size in sizes:
+        results = []
+        for tiles in (None, tile_size):
+            cpm = CPM.CPM({"A0": PAR.target_volume, "P0": PAR.target_surface, "lambda_A": PAR.lambda_volume,
+                           "lambda_P": PAR.lambda_surface, "W": PAR.adhesion_table, "T": PAR.kT, "seed": 0})
+            cpm.make_grid(size, size, tiles)
+            cpm.generate_cells(N_cell_dict={"E": 8, "T": 8, "X": 6})
+            cpm.make_init("voronoi")
+            memory = cpm.sigma_field.nbytes if tiles is None else cpm.lattice.nbytes
+            results.append((memory, attempts_per_second(cpm.sample.run, n_attempts)))
+        (m_dense, r_dense), (m_tiled, r_tiled) = results
+        print("  %5d x %-5d dense %11d bytes %10.0f attempts/s   tiled %9d bytes %10.0f attempts/s (%.1fx)"
+              % (size, size, m_dense, r_dense, m_tiled, r_tiled, r_tiled / r_dense))
+
+
+def bench_run_format(size=200, n_save=200, n_mcs=20):
+    """
+    Compare the run format of **CPM.save_simulation** with the former format, a bz2-compressed pickle of csr sparse
+    matrices: time to save and to load all snapshots of a run, and size of the file.
+    """
+    cpm = make_tissue(size, size, [size ** 2 // 200] * 3, init_MCS=1000, seed=0)
+    cpm.simulate(int(n_mcs * size ** 2), n_save, initialize=False)
+    print("Saving %d snapshots of a %d x %d lattice" % (len(cpm.sigma_save), size, size))
+    with tempfile.TemporaryDirectory() as directory:
+        t0 = time.perf_counter()
+        legacy_path = Path(directory) / "run.pbz2"
+        with bz2.BZ2File(legacy_path, "w") as f:
+            pickle.dump([sparse.csr_matrix(I) for I in cpm.sigma_save], f)
+        t1 = time.perf_counter()
+        frames = cpm.load_simulation(legacy_path)
+        t2 = time.perf_counter()
+        print("  bz2 csr pickle  save %8.3f s  load %8.3f s  %10d bytes" % (t1 - t0, t2 - t1, legacy_path.stat().st_size))
+
+        t0 = time.perf_counter()
+        path = cpm.save_simulation(directory, "run")
+        t1 = time.perf_counter()
+        frames_run = list(cpm.load_simulation(path))
+        t2 = time.perf_counter()
+        assert all(np.array_equal(I, J) for I, J in zip(frames, frames_run))
+        print("  run format      save %8.3f s  load %8.3f s  %10d bytes" % (t1 - t0, t2 - t1, path.stat().st_size))
+        t0 = time.perf_counter()
+        cpm.sigma_save[len(frames) // 2 + 1]
+        print("  random access to one frame of a freshly loaded file: %.4f s" % (time.perf_counter() - t0))
+
+
+#################################
+
+if __name__ == "__main__":
+
+    bench_attempts()
+    bench_call_overhead()
+    bench_convergence()
+    bench_threads()
+    bench_setup()
+    bench_sparse_domain()
+    bench_run_format()
@@ -31,7 +31,13 @@ def set_simulation_params():
               "lambda_A": PAR.lambda_volume,
               "lambda_P": PAR.lambda_surface,
               "W"       : PAR.adhesion_table,
-              "T"       : PAR.kT
+              "T"       : PAR.kT,
+              "sampler" : PAR.sampler,
+              "seed"    : PAR.seed,
+              "init_coarsen": PAR.init_coarsen,
+              "init_cache": PAR.init_cache,
+              "init_cache_bytes": PAR.init_cache_bytes,
+              "snapshot_path": PAR.snapshot_path
              }
 
     return(params)
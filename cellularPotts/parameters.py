@@ -10,9 +10,13 @@ import numpy as np
 # Simulation parameters
 
 init_MCS  = 100 # Monte Carlo Steps of initialization routine
+init_coarsen = 1 # downsampling factor of the initialization routine, see CPM.initialize
+init_cache = None # directory of the cache of initialized tissues, or None, see CPM.initialize
+init_cache_bytes = 2 ** 30 # maximal size of the cache
 total_MCS = int(1e6) # int(1e7) # total number of Monte Carlo Steps
 
 SAVE_DATA = False
+snapshot_path = None # file to which snapshots are streamed during the run, or None to keep them in memory
 MCS_to_save = 100  # How many of the data points should be saved
 
 # Grid size
@@ -21,6 +25,32 @@ width  = 80 # number of cols
 
 initial_cell_number = [8, 8, 6]
 
+# Sampler used to choose pixels in the Metropolis-Hastings algorithm
+"""
+"uniform":   draw pixels uniformly over the whole lattice.
+"interface": draw pixels only from the boundaries between cells.
+             Same dynamics per step, but faster for large cells.
+"rejection_free": only perform accepted swaps and advance the clock
+             accordingly. Same dynamics, but faster at low kT.
+"heat_bath": choose the new cell index of a pixel among all of its
+             neighbours at once, from their Boltzmann weights.
+             Same states, different dynamics.
+"checkerboard": update tiles of the lattice in parallel on all cores.
+"tiled":     draw pixels uniformly over the stored tiles of a tiled
+             lattice (see CPM.make_grid), which only stores the tiles
+             in contact with cells. Same dynamics, at a cost
+             proportional to the area of the tissue. Requires a tiled
+             lattice, which the GUI does not display.
+"""
+sampler = "uniform"
+
+# Random seed
+"""
+Seed of the random number stream of the simulation.
+Runs with the same seed are identical. If None, a new seed is drawn every run.
+"""
+seed = None
+
 
 # kT
 """
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""
+This module defines **TissueCache**, a persistent on-disk cache of initialised tissues, such that runs that start from
+the same tissue skip **CPM.initialize** (see the "init_cache" entry of the CPM parameters).
+
+The cache is content-addressed: an entry is stored under the SHA-256 digest of everything that determines the outcome of
+the initialisation, i.e. the sigma field and random number stream before it (which in turn reflect the lattice, the
+cells and the seed of **CPM.make_init**), the parameters of the cells, J0, the numbers of steps, the downsampling factor,
+the sampler and the temperature. Parameters that the initialisation does not use, such as the interfacial energies W,
+are left out, such that e.g. a sweep over W shares one entry. An entry holds the sigma field, areas and perimeters and
+the random number stream after the initialisation, such that a run loaded from the cache is identical to the run that
+stored it.
+
+Every entry is a compressed .npz file, written to a temporary file and renamed, such that concurrent runs never read a
+partial entry. The total size of the cache is bounded: when an entry is stored, the least recently used entries are
+evicted until the cache fits in its budget. Loading an entry marks it as used.
+"""
+
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+CACHE_VERSION = 3  # changes whenever the initialisation changes, invalidating all entries.
+
+
+class TissueCache:
+    """
+    **TissueCache** class, a directory of initialised tissues.
+    """
+
+    def __init__(self, directory, max_bytes=2 ** 30):
+        """
+        Initialise **TissueCache** class.
+        @param directory: Directory of the cache, created if needed.
+        @param max_bytes: Maximal total size of the entries, in bytes.
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    def get_key(self, cpm, J0, n_initialise_steps, coarsen, n_polish_steps):
+        """
+        Key of the initialisation of the CPM object from its current state, with the arguments of **CPM.initialize**.
+        @return: Hexadecimal SHA-256 digest.
+        """
+        digest = hashlib.sha256()
+        settings = (CACHE_VERSION, cpm.num_x, cpm.num_y, cpm.n_cells, J0, n_initialise_steps, coarsen, n_polish_steps,
+                    cpm.sample.sampler, cpm.sample.T, cpm.sample.tile_size)
+        digest.update(repr(settings).encode())
+        for x in (cpm.sigma_field, cpm.rng, cpm.cell_type, cpm.A0, cpm.P0, cpm.lambda_A, cpm.lambda_P):
+            digest.update(str(x.dtype).encode())
+            digest.update(np.ascontiguousarray(x).tobytes())
+        return digest.hexdigest()
+
+    def get_path(self, key):
+        return self.directory / ("%s.npz" % key)
+
+    def load(self, cpm, key):
+        """
+        Load the initialised tissue of **key** into the CPM object, if it is in the cache.
+        @return: True if the entry was found.
+        """
+        path = self.get_path(key)
+        try:
+            with np.load(path) as entry:
+                cpm.sigma_field, cpm.A, cpm.P = entry["sigma_field"], entry["A"], entry["P"]
+                cpm.rng[:] = entry["rng"]
+            os.utime(path)
+        except (OSError, KeyError, ValueError):  # missing, evicted meanwhile, or corrupt.
+            return False
+        cpm.energy = None
+        return True
+
+    def store(self, cpm, key):
+        """
+        Store the initialised tissue of the CPM object under **key**, then evict the least recently used entries
+        beyond the size of the cache.
+        """
+        descriptor, temp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(descriptor, "wb") as f:
+                np.savez_compressed(f, sigma_field=cpm.sigma_field, A=cpm.A, P=cpm.P, rng=cpm.rng)
+            os.replace(temp, self.get_path(key))
+        except BaseException:
+            os.unlink(temp)
+            raise
+        self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used entries until the total size of the cache is at most **max_bytes**.
+        """
+        entries = []
+        for path in self.directory.glob("*.npz"):
+            try:
+                status = path.stat()
+            except OSError:  # deleted by a concurrent run.
+                continue
+            entries.append((status.st_mtime, status.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+    def clear(self):
+        """
+        Delete all entries.
+        """
+        for path in self.directory.glob("*.npz"):
+            path.unlink(missing_ok=True)
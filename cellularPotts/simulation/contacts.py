@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+"""
+This module defines **Contacts**, the contact lengths between cells, maintained incrementally by the samplers.
+
+The contact length between cells a and b is the number of pairs of Moore neighbours (i.e. the same neighbourhood as
+the perimeter) with one pixel in a and the other in b, such that the contact lengths of a cell sum to its perimeter.
+
+The contacts are stored sparsely:
+- for every cell, a list of its neighbouring cells and their contact lengths, with a fixed capacity (ids, lengths and
+degree);
+- the contact lengths with the medium, which may touch every cell, as a vector (medium);
+- the contact lengths aggregated by pair of cell types (type 0 being the medium), as a small dense matrix
+(type_contact), such that sorting metrics are read in O(1).
+
+Kernels receive either the tuple of these arrays (see **Contacts.kernel_args**), or None, in which case the update is
+pruned at compile time. After an accepted swap, **record_flip** updates the contacts from the 3x3 neighbourhood of
+the swapped pixel only. If the list of a cell is full, the overflow flag is raised and the update skipped; the
+**Contacts** object is then rebuilt from the lattice with a larger capacity after the call of the sampler.
+"""
+
+import numpy as np
+from numba import jit
+from scipy import sparse
+
+
+class Contacts:
+    """
+    **Contacts** class. See **CPM.get_contacts**.
+    """
+
+    def __init__(self, cpm, capacity=16):
+        """
+        Initialise **Contacts** class, building the contacts from the sigma field of the CPM object.
+        @param cpm: a CPM object.
+        @param capacity: Initial capacity of the lists of neighbouring cells. Doubled as needed.
+        """
+        self.cpm = cpm
+        self.capacity = capacity
+        self.rebuild()
+
+    def rebuild(self):
+        """
+        Recompute all contacts from the sigma field, enlarging the capacity of the lists until they fit.
+        """
+        cpm = self.cpm
+        self.I = cpm.sigma_field
+        self.cell_type = cpm.cell_type  # referenced, such that changes of cell types are seen by the kernels.
+        while True:
+            self.ids = np.zeros((len(cpm.A), self.capacity), dtype=np.int64)
+            self.lengths = np.zeros((len(cpm.A), self.capacity), dtype=np.int64)
+            self.degree = np.zeros(len(cpm.A), dtype=np.int64)
+            self.medium = np.zeros(len(cpm.A), dtype=np.int64)
+            self.type_contact = np.zeros((cpm.n_types, cpm.n_types), dtype=np.int64)
+            self.overflow = np.zeros(1, dtype=np.bool_)
+            build_contacts(self.I, cpm.num_x, cpm.num_y, self.kernel_args)
+            if not self.overflow[0]:
+                break
+            self.capacity *= 2
+
+    def resize(self):
+        """
+        Enlarge the per-cell arrays to the capacity of the CPM object (see **CPM.grow**), without rebuilding.
+        """
+        n = len(self.cpm.A) - len(self.degree)
+        self.cell_type = self.cpm.cell_type
+        self.ids = np.concatenate((self.ids, np.zeros((n, self.capacity), dtype=np.int64)))
+        self.lengths = np.concatenate((self.lengths, np.zeros((n, self.capacity), dtype=np.int64)))
+        self.degree = np.concatenate((self.degree, np.zeros(n, dtype=np.int64)))
+        self.medium = np.concatenate((self.medium, np.zeros(n, dtype=np.int64)))
+
+    @property
+    def kernel_args(self):
+        """
+        The contacts, as passed to the compiled kernels.
+        """
+        return self.ids, self.lengths, self.degree, self.medium, self.type_contact, self.cell_type, self.overflow
+
+    def is_stale(self, cpm):
+        """
+        True if the sigma field or the cells of the CPM object have been replaced since the contacts were built.
+        """
+        return (self.I is not cpm.sigma_field) or (len(self.degree) != len(cpm.A))
+
+    def get(self, a, b):
+        """
+        Contact length between cells a and b (either may be the medium, 0).
+        """
+        if a == b:
+            return 0
+        if a == 0 or b == 0:
+            return int(self.medium[a + b])
+        k = np.nonzero(self.ids[a, :self.degree[a]] == b)[0]
+        return int(self.lengths[a, k[0]]) if len(k) else 0
+
+    def neighbours(self, a):
+        """
+        @return: ids, lengths: the cells in contact with cell a (excluding the medium), and the contact lengths.
+        """
+        return self.ids[a, :self.degree[a]].copy(), self.lengths[a, :self.degree[a]].copy()
+
+    def to_sparse(self):
+        """
+        @return: (capacity x capacity) scipy.sparse csr matrix of the contact lengths, including the medium.
+        """
+        rows = np.repeat(np.arange(len(self.degree)), self.degree)
+        mask = np.arange(self.capacity) < self.degree[:, None]
+        cells = np.nonzero(self.medium)[0]
+        return sparse.csr_matrix((np.concatenate((self.lengths[mask], self.medium[cells], self.medium[cells])),
+                                  (np.concatenate((rows, cells, np.zeros_like(cells))),
+                                   np.concatenate((self.ids[mask], np.zeros_like(cells), cells)))),
+                                 shape=(len(self.degree), len(self.degree)))
+
+    def type_matrix(self):
+        """
+        @return: (n_types x n_types) symmetric matrix of the contact lengths between cell types (type 0 is the medium).
+        """
+        return self.type_contact.copy()
+
+    def homotypic(self):
+        """
+        Total contact length between distinct cells of the same type (medium excluded).
+        """
+        return int(np.trace(self.type_contact[1:, 1:]))
+
+    def heterotypic(self):
+        """
+        Total contact length between cells of different types (medium excluded).
+        """
+        return int(np.sum(np.triu(self.type_contact[1:, 1:], 1)))
+
+    def sorting_index(self):
+        """
+        Fraction of the contact length between cells that is homotypic. Equals **CPM.get_sorting_index**.
+        """
+        homotypic = self.homotypic()
+        return homotypic / max(homotypic + self.heterotypic(), 1)
+
+
+@jit(nopython=True)
+def update_contact(contacts, a, b, delta):
+    """
+    Add delta to the contact length between cells a != b, and to the aggregate of their types.
+    contacts is the tuple of **Contacts.kernel_args**.
+    """
+    ids, lengths, degree, medium, type_contact, cell_type, overflow = contacts
+    ta, tb = cell_type[a], cell_type[b]
+    type_contact[ta, tb] += delta
+    if ta != tb:
+        type_contact[tb, ta] += delta
+    if a == 0 or b == 0:
+        medium[a + b] += delta
+        return
+    for c, d in ((np.int64(a), np.int64(b)), (np.int64(b), np.int64(a))):  # a and b may differ in integer type.
+        k = 0
+        while (k < degree[c]) and (ids[c, k] != d):
+            k += 1
+        if k < degree[c]:
+            lengths[c, k] += delta
+            if lengths[c, k] == 0:  # remove d from the list of c, by moving the last entry in its place.
+                degree[c] -= 1
+                ids[c, k] = ids[c, degree[c]]
+                lengths[c, k] = lengths[c, degree[c]]
+        elif degree[c] < ids.shape[1]:
+            ids[c, k] = d
+            lengths[c, k] = delta
+            degree[c] += 1
+        else:
+            overflow[0] = True
+
+
+@jit(nopython=True)
+def record_flip(contacts, I, i, j, s, s2):
+    """
+    Update the contacts for the swap of pixel (i,j) from s to s2, before I is modified.
+
+    The Moore neighbours of (i,j) in s2 gain a contact with s, and those in s lose their contact with s2. The contacts
+    of the neighbours in any other cell n move from s to s2. Neighbours are grouped by cell, such that every pair of
+    cells is updated once.
+    contacts is the tuple of **Contacts.kernel_args**.
+    """
+    d_s_s2 = 0
+    for k in range(9):
+        if k != 4:
+            n = I[i - 1 + k // 3, j - 1 + k % 3]
+            if n == s:
+                d_s_s2 += 1
+            elif n == s2:
+                d_s_s2 -= 1
+            else:
+                new = True
+                for l in range(k):
+                    if (l != 4) and (I[i - 1 + l // 3, j - 1 + l % 3] == n):
+                        new = False
+                if new:  # first neighbour in cell n: count all of them.
+                    count = 1
+                    for l in range(k + 1, 9):
+                        if (l != 4) and (I[i - 1 + l // 3, j - 1 + l % 3] == n):
+                            count += 1
+                    update_contact(contacts, s, n, -count)
+                    update_contact(contacts, s2, n, count)
+    if d_s_s2 != 0:
+        update_contact(contacts, s, s2, d_s_s2)
+
+
+@jit(nopython=True)
+def build_contacts(I, num_x, num_y, contacts):
+    """
+    Compute all contacts from the lattice, enumerating every pair of Moore neighbours once.
+    contacts is the tuple of **Contacts.kernel_args**, initialised to zero.
+    """
+    for i in range(num_x):
+        for j in range(num_y):
+            s = I[i, j]
+            for a, b in ((1, 0), (0, 1), (1, 1), (1, -1)):
+                if (i + a < num_x) and (0 <= j + b < num_y):
+                    n = I[i + a, j + b]
+                    if n != s:
+                        update_contact(contacts, s, n, 1)
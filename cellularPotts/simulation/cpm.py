@@ -9,14 +9,20 @@ GitHub repository: https://github.com/jakesorel/CPM_ETX_2022
 
 import _pickle as cPickle
 import bz2
-import random
+import shutil
 from pathlib import Path
 
 import numpy as np
 from matplotlib import colors
 from scipy import sparse
+from scipy.spatial import cKDTree
 
+from .cache import TissueCache
+from .population import split_pixels
+from .rng import make_stream, permutation, uniform
 from .sample import Sample
+from .snapshots import SnapshotReader, SnapshotWriter
+from .tiles import TiledLattice
 
 #
 class CPM:
@@ -30,21 +36,35 @@ class CPM:
     def __init__(self, params=None):
         """
         Initialisation of the CPM class.
-        @param params: dictionary of parameters
+        @param params: dictionary of parameters. The optional entries "seed" and "stream" set the random number stream,
+        see **set_seed**. The optional entry "init_cache" is the directory of a cache of initialised tissues, bounded
+        to "init_cache_bytes" bytes (see **initialize**).
         """
         assert params is not None, "Specify params"
         self.params = params
+        self.init_cache = None  # the **TissueCache** of initialised tissues, if any.
+        if self.params.get("init_cache") is not None:
+            self.init_cache = TissueCache(self.params["init_cache"], self.params.get("init_cache_bytes", 2 ** 30))
+        self.rng = make_stream(self.params.get("seed"), self.params.get("stream", 0))
         self.num_x, self.num_y = None, None
         self.sigma_field   = None
+        self.lattice       = None  # the **TiledLattice** that replaces the sigma field, if any. See **make_grid**.
         self.boundary_mask = None
 
         self.A, self.P, self.A0, self.P0 = None, None, None, None
+        self.cell_type = None
         self.lambda_P, self.lambda_A = None, None
+        # Total energy, kept up to date by the samplers. See **get_energy**. Reset to None if the sigma field or the
+        # energy functional are modified other than through the CPM methods, such that it is recomputed.
+        self.energy = None
+        self.energy_terms = []  # extra terms of the energy functional. See **add_energy_term**.
+        self.snapshot_writer = None  # the **SnapshotWriter** of the snapshots being streamed to disk, if any.
 
         self.Moore, self.perim_neighbour = None, None
         self.define_neighbourhood()
         self.sample = Sample(self)
         self.do_steps = self.sample.do_steps
+        self.do_mcs = self.sample.do_mcs
 
         # Neumann neighbors -- used for graphics
         self.boundary_calc_ns = np.array([
@@ -55,6 +75,19 @@ class CPM:
                                             ])
 
 
+    def set_seed(self, seed=None, stream=0):
+        """
+        Reset the random number stream used by the initialisation and by all samplers (see the **rng** module).
+
+        Runs with the same seed and stream are identical. Replicas that share a seed but have different stream indices
+        draw independent random numbers, without sharing any global random state.
+
+        @param seed: Integer seed. If None, a seed is drawn from the entropy of the operating system.
+        @param stream: Index of the stream, e.g. of the replica.
+        """
+        self.rng[:] = make_stream(seed, stream)  # in place, such that the samplers keep referencing self.rng.
+
+
     def define_neighbourhood(self):
         """
         Define the multiple neighbourhoods used in calculations.
@@ -69,19 +102,52 @@ class CPM:
         self.perim_neighbour = np.array([i_2, j_2]).T
 
 
-    def make_grid(self, num_x=300, num_y=300):
+    def make_grid(self, num_x=300, num_y=300, tile_size=None):
         """
         Makes the initial square grid, where the CPM formulation of cellular objects and tissues is housed.
 
         Initialises I with zeros (ints).
         I is the (num_x x num_y) matrix of ints. Each int is the index corresponds to a cell. Thus each index is Moore
-        contiguous within I.
+        contiguous within I. Its integer type is the narrowest that holds all cell indices, see **fit_sigma_dtype**.
+
+        For a tissue that fills a small fraction of a large lattice, I can instead be stored as tiles, of which only
+        those in contact with cells are stored and sampled (see the **tiles** module), such that the memory and the
+        cost of an MCS are proportional to the area of the tissue. self.sigma_field is then None, and self.lattice the
+        **TiledLattice**, sampled by the "tiled" sampler. The extra terms of the energy functional, the contacts, the
+        geometry and the statistics of the samplers are not available on a tiled lattice.
 
         @param num_x: Number of pixels in the x-dimension of I.
         @param num_y: Number of pixels in the y-dimension of I.
+        @param tile_size: If given, store I as a **TiledLattice** of tiles of tile_size x tile_size pixels.
         """
         self.num_x, self.num_y = num_x, num_y
-        self.sigma_field = np.zeros([num_x, num_y]).astype(int)
+        if tile_size is None:
+            self.sigma_field, self.lattice = np.zeros([num_x, num_y], dtype=self.get_sigma_dtype()), None
+        else:
+            self.sigma_field, self.lattice = None, TiledLattice(num_x, num_y, tile_size, self.get_sigma_dtype())
+            self.sample.sampler = "tiled"
+
+
+    def get_sigma_dtype(self):
+        """
+        The narrowest unsigned integer type that holds all cell indices, up to the capacity of the per-cell arrays (see
+        **grow**): uint16 up to index 65,535, else uint32. Compared with int64, this divides the memory and cache
+        footprint of the sigma field and of its snapshots by 4 or 2.
+        """
+        capacity = len(self.cell_type) if self.cell_type is not None else 1
+        return np.dtype(np.uint16) if capacity <= 2 ** 16 else np.dtype(np.uint32)
+
+
+    def fit_sigma_dtype(self):
+        """
+        Convert the sigma field to the type of **get_sigma_dtype**, if it differs, e.g. when the number of cells grows.
+        The samplers then rebuild their incremental state for the new array, and compile their kernels for its type on
+        first use.
+        """
+        if (self.sigma_field is not None) and (self.sigma_field.dtype != self.get_sigma_dtype()):
+            self.sigma_field = self.sigma_field.astype(self.get_sigma_dtype())
+        if self.lattice is not None:
+            self.lattice.astype(self.get_sigma_dtype())
 
 
     def generate_cells(self, N_cell_dict):
@@ -96,6 +162,10 @@ class CPM:
         Additionally, defines the number of cells, self.n_cells.
         And the cell_ids, which count up from 1. 0 is reserved for the 'medium' pseudo-cell.
 
+        Cells may be added and removed later (see **add_cell**, **divide_cell** and **remove_cell**). self.n_cells is
+        then the largest cell index in use, and the indices of removed cells, which have type 0 until they are reused,
+        are excluded from self.cell_ids.
+
         @param N_cell_dict: A dictionary of cell-types and corresponding numbers of each cell.
          e.g. {"E": 8, "T": 8,"X":6}
         @return:
@@ -105,29 +175,40 @@ class CPM:
             for i in range(n_i):
                 self.c_types += [type_i + 1]
         self.n_cells = len(self.c_types)
-        self.cell_ids = np.arange(1, self.n_cells + 1)
+        self.n_types = len(N_cell_dict) + 1  # including the medium, type 0.
+        self.free_ids = []  # indices of removed cells, reused by **add_cell**.
         self.set_cell_params()
 
 
+    @property
+    def cell_ids(self):
+        """
+        Indices of the cells in the tissue, excluding removed cells.
+        """
+        return np.nonzero(self.cell_type[:self.n_cells + 1])[0]
+
+
     def set_cell_params(self):
         """
         Converts the parameters of the energy functional, prescribed in the dictionary self.params, into vectors of size
         (n_cells +1). N.b. +1, as considers also the medium pseudo-cell.
 
         e.g. if self.params["A0"] = (5,6,7), then self.A0 will be 5, for cell-type 1, will be 6 for cell-type 2 etc.
+
+        Also defines self.cell_type, the cell type of every cell index (0 for the medium). All per-cell vectors may hold
+        spare entries beyond n_cells + 1, see **grow**.
         """
         self.A0       = np.zeros(self.n_cells + 1)
         self.P0       = np.zeros(self.n_cells + 1)
         self.lambda_A = np.zeros(self.n_cells + 1)
         self.lambda_P = np.zeros(self.n_cells + 1)
+        self.cell_type = np.zeros(self.n_cells + 1, dtype=np.int64)
 
         for i, c_type in enumerate(self.c_types):
-            self.A0[i + 1] = self.params["A0"][c_type - 1]
-            self.P0[i + 1] = self.params["P0"][c_type - 1]
-            self.lambda_A[i + 1] = self.params["lambda_A"][c_type - 1]
-            self.lambda_P[i + 1] = self.params["lambda_P"][c_type - 1]
+            self.set_params(i + 1, c_type)
 
         self.make_J()
+        self.fit_sigma_dtype()
 
 
     def make_J(self):
@@ -138,31 +219,178 @@ class CPM:
 
         This is derived from the self.params dictionary.
 
-        self.J then is a (n_cell x n_cell) matrix of interfacial energy coefficients.
-        (more negative = stronger affinity).
-
-        Additionally calculates J_diff via the below function.
+        self.adhesion_table then is the matrix of interfacial energy coefficients between cell types
+        (more negative = stronger affinity). The interfacial energy J between two cells is looked up from their types
+        (see **get_J**), such that memory is linear in the number of cells. Interfacial energies of specific pairs of
+        cells can be overridden with **set_J**.
         @return:
         """
-        self.J = np.zeros([self.n_cells + 1, self.n_cells + 1])
-        c_types = np.concatenate(((0,), self.c_types))
-        for i in range(len(c_types)):
-            for j in range(len(c_types)):
-                if i != j:
-                    self.J[i, j] = -self.params["W"][c_types[i], c_types[j]]
-        self.get_J_diff()
+        self.adhesion_table = -np.asarray(self.params["W"], dtype=np.float64)
+        self.J_overrides = {}  # interfacial energies of pairs of cells (s1, s2), s1 < s2, overriding their types.
+        self.update_adhesion()
+        self.energy = None  # the energy functional has changed; recomputed by the samplers on their next call.
+
+
+    def update_adhesion(self):
+        """
+        Define self.adhesion, the interfacial energies as passed to the compiled kernels: the tuple (adhesion_table,
+        cell_type, override_keys, override_J), where override_keys is the sorted array of the keys
+        (s1 << 32) + s2 of the overridden pairs, and override_J their interfacial energies (see **kernels.get_J**).
+        Without overrides, both are None, and the kernels are compiled without their lookup.
+        Called whenever one of these arrays is replaced.
+        """
+        keys, values = None, None
+        if self.J_overrides:
+            pairs = sorted(self.J_overrides)
+            keys = np.array([(s1 << 32) + s2 for s1, s2 in pairs], dtype=np.int64)
+            values = np.array([self.J_overrides[pair] for pair in pairs], dtype=np.float64)
+        self.adhesion = (self.adhesion_table, self.cell_type, keys, values)
+
+
+    def get_J(self, I1, I2):
+        """
+        Interfacial energies between the cell indices of two arrays, elementwise and vectorised: 0 within a cell, else
+        the override of the pair (see **set_J**) if any, else the energy between their cell types.
+        """
+        I1, I2 = np.asarray(I1), np.asarray(I2)
+        J = self.adhesion_table[self.cell_type[I1], self.cell_type[I2]] * (I1 != I2)
+        keys = self.adhesion[2]
+        if keys is not None:
+            pair_keys = (np.minimum(I1, I2).astype(np.int64) << 32) + np.maximum(I1, I2)
+            k = np.minimum(np.searchsorted(keys, pair_keys), len(keys) - 1)
+            found = (keys[k] == pair_keys) & (I1 != I2)
+            J = np.where(found, self.adhesion[3][k], J)
+        return J
+
+
+    def set_J(self, s1, s2, J=None):
+        """
+        Override the interfacial energy between cells s1 and s2, e.g. for cells adhering through a specific junction.
+        Overrides are stored sparsely, one entry per pair, and dropped when a cell is removed (see **remove_cell**).
+        @param s1, s2: Indices of the two (distinct) cells. 0 for the medium.
+        @param J: Interfacial energy of the pair. None removes the override, such that the energy between the types of
+        the cells applies again.
+        """
+        assert s1 != s2, "The interfacial energy within a cell is 0"
+        pair = (int(min(s1, s2)), int(max(s1, s2)))
+        if J is None:
+            self.J_overrides.pop(pair, None)
+        else:
+            self.J_overrides[pair] = float(J)
+        self.update_adhesion()
+        self.energy = None
+
+
+    def set_params(self, s, c_type):
+        """
+        Set the type of cell s, and its parameters of the energy functional from the dictionary self.params.
+        Type 0 marks a removed cell, and zeroes its parameters.
+        """
+        self.cell_type[s] = c_type
+        if c_type == 0:
+            self.A0[s], self.P0[s], self.lambda_A[s], self.lambda_P[s] = 0., 0., 0., 0.
+            return
+        self.A0[s] = self.params["A0"][c_type - 1]
+        self.P0[s] = self.params["P0"][c_type - 1]
+        self.lambda_A[s] = self.params["lambda_A"][c_type - 1]
+        self.lambda_P[s] = self.params["lambda_P"][c_type - 1]
+
+
+    def grow(self, capacity):
+        """
+        Enlarge all per-cell arrays to **capacity** cell indices (including the medium), copying their contents. The
+        tracked contacts and geometry of the cells are enlarged likewise (see **Sample.resize**).
+        """
+        n = len(self.cell_type)
+        if capacity <= n:
+            return
+
+        def pad(x):
+            return np.concatenate((x, np.zeros(capacity - n, dtype=x.dtype)))
+
+        self.A0, self.P0, self.cell_type = pad(self.A0), pad(self.P0), pad(self.cell_type)
+        self.lambda_A, self.lambda_P = pad(self.lambda_A), pad(self.lambda_P)
+        if self.A is not None:
+            self.A, self.P = pad(self.A), pad(self.P)
+        self.update_adhesion()
+        self.fit_sigma_dtype()
+        self.sample.resize()
 
 
-    def get_J_diff(self):
+    def add_cell(self, c_type, pixels=None):
         """
-        J_diff: Change in the interfacial energy when a pixel is replaced from cell index i to cell index j.
-        Jdiff is a (nc x nc x nc) array, where the first two dimensions are indices of cells i and j, and the third
-        dimension can be used to index of all neighbouring cells of the pixel that is being flipped.
+        Add a cell of type c_type to the tissue, reusing the index of a removed cell if any. When the per-cell arrays are
+        full, their capacity is doubled (see **grow**), such that adding cells costs amortised O(1) reallocations.
+        @param c_type: Cell type, 1, 2, ... as in **generate_cells**.
+        @param pixels: (n x 2) array of the (x, y) coordinates of the pixels assigned to the cell, which should be
+        Moore contiguous and must not lie on the border of the lattice. None for a cell without pixels.
+        @return: s, the index of the new cell.
         """
-        self.J_diff = np.expand_dims(self.J, 1) - np.expand_dims(self.J, 0)
+        assert 0 < c_type < self.n_types, "Unknown cell type %d" % c_type
+        if self.free_ids:
+            s = self.free_ids.pop()
+        else:
+            self.n_cells += 1
+            s = self.n_cells
+            self.c_types.append(0)
+            if s >= len(self.cell_type):
+                self.grow(2 * len(self.cell_type))
+        self.c_types[s - 1] = c_type
+        self.set_params(s, c_type)
+        if self.energy is not None:  # the new cell has no pixels yet.
+            self.energy += self.lambda_A[s] * self.A0[s] ** 2 + self.lambda_P[s] * self.P0[s] ** 2
+        if pixels is not None:
+            self.sample.assign_pixels(pixels, s)
+        return s
+
+
+    def divide_cell(self, s, c_type=None):
+        """
+        Divide cell s into two, along the line through its centroid perpendicular to its major axis (see
+        **population.split_pixels**). The pixels on one side of the line are assigned to a new cell. Costs O(cell size)
+        if the geometry of the cells is tracked (see **get_geometry**), else O(lattice) to find its pixels.
+        @param s: Index of the dividing cell.
+        @param c_type: Cell type of the daughter cell. Defaults to the type of cell s.
+        @return: The index of the daughter cell.
+        """
+        pixels = split_pixels(self.get_cell_pixels(s))
+        return self.add_cell(self.cell_type[s] if c_type is None else c_type, pixels)
 
 
-    def make_init(self, init_type="circle", r=3, spacing=0.25):
+    def remove_cell(self, s):
+        """
+        Remove cell s from the tissue, e.g. on cell death, assigning its pixels to the medium. Its index is reused by
+        the next **add_cell**.
+        @param s: Index of the cell.
+        """
+        assert self.cell_type[s] != 0, "Cell %d does not exist" % s
+        self.sample.assign_pixels(self.get_cell_pixels(s), 0)
+        if self.energy is not None:  # the cell, now without pixels, leaves the energy functional.
+            self.energy -= self.lambda_A[s] * self.A0[s] ** 2 + self.lambda_P[s] * self.P0[s] ** 2
+        self.c_types[s - 1] = 0
+        self.set_params(s, 0)
+        self.free_ids.append(int(s))
+        overrides = [pair for pair in self.J_overrides if s in pair]
+        if overrides:
+            for pair in overrides:
+                del self.J_overrides[pair]
+            self.update_adhesion()
+
+
+    def get_cell_pixels(self, s):
+        """
+        @return: (A x 2) array of the (x, y) coordinates of the pixels of cell s. O(cell size) if the geometry of the
+        cells is tracked (see **get_geometry**), O(tissue) on a tiled lattice, else O(lattice).
+        """
+        geometry = self.sample.geometry
+        if (geometry is not None) and not geometry.is_stale(self):
+            return geometry.get_pixels(s)
+        if self.lattice is not None:
+            return self.lattice.get_pixels(s)
+        return np.argwhere(self.sigma_field == s)
+
+
+    def make_init(self, init_type="circle", r=3, spacing=0.25, n_lloyd=1):
         """
         Initialise the I matrix with 'cells' (i.e. regions of the I matrix with a given cell index).
 
@@ -170,16 +398,27 @@ class CPM:
         grid-tiled in the I matrix. These have the same radius, r. Cell indices and cell centres are shuffled, such that
         the initial distribution of cells is random. Extra cells are added, and then are removed from the centre of the
         I matrix outward until the appropriate number of cells, prescribed in **generate_cells**, is achieved.
+        Each circle is only painted within its bounding box, such that the cost is O(total area of the cells).
+
+        Alternatively, cells are prescribed as a dense packing, the Voronoi tessellation of a disc, centred in the I
+        matrix, whose area is the total target area of the cells. Seeds are placed on a jittered hexagonal grid in the
+        disc, relaxed by **n_lloyd** iterations of Lloyd's algorithm (moving every seed to the centroid of its region),
+        and every pixel is assigned to its nearest seed with a k-d tree, in O(total area x log(n_cells)).
+
+        On a tiled lattice (see **make_grid**), the pixels are written to the tiles, which are created as needed.
 
-        @param init_type: choose the type of initial cell shape. Currently, only circle.
+        @param init_type: choose the type of initial cell shape, "circle" or "voronoi".
         @param r: Radius of the circle that prescribes the contiguous region that a cell is initialised to.
         @param spacing: spacing between the circles.
+        @param n_lloyd: Number of iterations of Lloyd's algorithm of the "voronoi" initialisation.
         """
-        self.sigma_temp = np.zeros_like(self.sigma_field)
+        if self.lattice is None:
+            self.sigma_temp = np.zeros_like(self.sigma_field)
+        else:
+            self.lattice.clear()
 
         if init_type == "circle":
             # Define a regular grid to place circles
-            X, Y   = np.meshgrid(np.arange(self.num_x), np.arange(self.num_y), indexing="ij")
             sq_n_x =  int(np.ceil(np.sqrt(self.n_cells))) - 1
             sq_n_y = (int(np.ceil(np.sqrt(self.n_cells)))) / 2
             x_mid, y_mid = int(self.num_x / 2), int(self.num_y / 2)
@@ -195,23 +434,66 @@ class CPM:
                 [Y0[::2, ::2].ravel(), Y0[1::2, 1::2].ravel()])
             
             # Add small amount of noise to circle centers 
-            X0 += np.random.uniform(0, 0.01, X0.shape)
-            Y0 += np.random.uniform(0, 0.01, Y0.shape)
+            X0 += uniform(self.rng, 0, 0.01, len(X0))
+            Y0 += uniform(self.rng, 0, 0.01, len(Y0))
 
             dist_to_mid = (X0 - x_mid) ** 2 + (X0 - y_mid) ** 2
             grid_choice = np.argsort(dist_to_mid)
 
             k = 0
-            cell_index = np.arange(self.n_cells)
-            random.shuffle(cell_index)
+            cell_index = permutation(self.rng, self.n_cells)
 
             while k < self.n_cells:
                 x0, y0 = X0[grid_choice[k]], Y0[grid_choice[k]]
                 cll_r = np.sqrt(self.A0[k + 1] / np.pi) * 0.8
-                self.sigma_temp[(X - x0 + 0.5) ** 2 + (Y - y0 + 0.5) ** 2 <= cll_r ** 2] = cell_index[k] + 1
+                # Paint the pixels (x, y) with (x - x0 + 0.5)^2 + (y - y0 + 0.5)^2 <= cll_r^2, within their bounding box.
+                x_min = max(int(np.ceil(x0 - 0.5 - cll_r)), 0)
+                x_max = min(int(np.floor(x0 - 0.5 + cll_r)) + 1, self.num_x)
+                y_min = max(int(np.ceil(y0 - 0.5 - cll_r)), 0)
+                y_max = min(int(np.floor(y0 - 0.5 + cll_r)) + 1, self.num_y)
+                X, Y = np.meshgrid(np.arange(x_min, x_max), np.arange(y_min, y_max), indexing="ij")
+                inside = (X - x0 + 0.5) ** 2 + (Y - y0 + 0.5) ** 2 <= cll_r ** 2
+                if self.lattice is None:
+                    self.sigma_temp[x_min:x_max, y_min:y_max][inside] = cell_index[k] + 1
+                else:
+                    self.lattice.set_pixels(X[inside], Y[inside], cell_index[k] + 1)
                 k += 1
-            
-        self.sigma_field = self.sigma_temp.copy()
+
+        elif init_type == "voronoi":
+            # Pixels of the disc, away from the border of the lattice.
+            x_mid, y_mid = self.num_x / 2, self.num_y / 2
+            R = np.sqrt(np.sum(self.A0[self.cell_ids]) / np.pi)
+            X, Y = np.meshgrid(np.arange(max(int(x_mid - R), 1), min(int(np.ceil(x_mid + R)) + 1, self.num_x - 1)),
+                               np.arange(max(int(y_mid - R), 1), min(int(np.ceil(y_mid + R)) + 1, self.num_y - 1)),
+                               indexing="ij")
+            inside = (X + 0.5 - x_mid) ** 2 + (Y + 0.5 - y_mid) ** 2 <= R ** 2
+            pixels = np.stack((X[inside], Y[inside]), axis=1).astype(np.float64)
+            assert len(pixels) >= self.n_cells, "The lattice is too small for the cells"
+
+            # Seeds: the points of a hexagonal grid with a cell of the mean area per point closest to the centre, with a
+            # random jitter, relaxed by Lloyd's algorithm.
+            a = np.sqrt(2 * len(pixels) / (np.sqrt(3) * self.n_cells))
+            n_a = int(2 * R / a) + 2
+            U, V = np.meshgrid(np.arange(-n_a, n_a + 1), np.arange(-n_a, n_a + 1), indexing="ij")
+            seeds = np.stack(((U + V / 2).ravel() * a, V.ravel() * a * np.sqrt(3) / 2), axis=1)
+            seeds = seeds[np.argsort(np.sum(seeds ** 2, axis=1), kind="stable")[:self.n_cells]]
+            seeds += uniform(self.rng, -a / 4, a / 4, seeds.size).reshape(seeds.shape) + (x_mid - 0.5, y_mid - 0.5)
+            for _ in range(n_lloyd):
+                nearest = cKDTree(seeds).query(pixels)[1]
+                counts = np.bincount(nearest, minlength=self.n_cells)
+                filled = counts > 0
+                for d in range(2):
+                    seeds[filled, d] = np.bincount(nearest, pixels[:, d], self.n_cells)[filled] / counts[filled]
+            nearest = cKDTree(seeds).query(pixels)[1]
+
+            cell_index = permutation(self.rng, self.n_cells)
+            if self.lattice is None:
+                self.sigma_temp[X[inside], Y[inside]] = cell_index[nearest] + 1
+            else:
+                self.lattice.set_pixels(X[inside], Y[inside], cell_index[nearest] + 1)
+
+        if self.lattice is None:
+            self.sigma_field = self.sigma_temp.copy()
         self.assign_AP()
 
 
@@ -223,18 +505,47 @@ class CPM:
         the indices of cells in I. The first value is that of the medium, which is essentially ignored throughout the
         base, as we do not consider the area and perimeter of the medium pseudo-cell in the energy functional.
         """
-        self.A = np.zeros(self.n_cells + 1, dtype=int)
-        self.P = np.zeros(self.n_cells + 1, dtype=int)
-        for cll in self.cell_ids:
-            self.P[cll], self.A[cll] = self.get_perimeter_and_area(self.sigma_field, cll)
+        if self.lattice is not None:
+            self.P, self.A = self.lattice.get_perimeters_and_areas(self.perim_neighbour, len(self.cell_type))
+        else:
+            self.P, self.A = self.get_perimeters_and_areas(self.sigma_field, len(self.cell_type))
+        self.energy = None
+
+
+    def get_perimeters_and_areas(self, I, n=None):
+        """
+        Calculates the areas and perimeters of all cells at once, given the matrix of pixels, I, in O(lattice)
+        independent of the number of cells: a pixel count per index, and for each of the Moore neighbours, a count of
+        the pixels of every index that differ from that neighbour. Gives the same values as **get_perimeter_and_area**.
+        Serves the initialisation and restarts of the tissue, and the analysis of saved frames.
+        @param I: The (num_x x num_y) matrix of ints. Each int is the index corresponds to a cell. Thus each index is Moore contiguous within I.
+        @param n: Length of the returned vectors, at least the largest index in I + 1. Defaults to the largest index
+        in I + 1.
+        @return: P, A: vectors of perimeters and areas, indexed by cell index. Those of the medium, index 0, are 0.
+        """
+        labels = I.ravel()
+        n = max(n if n is not None else 0, labels.max() + 1)
+        A = np.bincount(labels, minlength=n)
+        P = np.zeros(n, dtype=A.dtype)
+        for i, j in self.perim_neighbour:
+            P += np.bincount(I[I != np.roll(np.roll(I, i, axis=0), j, axis=1)], minlength=n)
+        A[0], P[0] = 0, 0
+        return P, A
 
 
     def get_perimeter_and_area(self, I, s):
         """
         Calculates the area and perimeter of a given cell id, s, given the matrix of pixels, I.
+        If the geometry of the cells is tracked (see **get_geometry**), only the bounding box of the cell is scanned.
         @param I: The (num_x x num_y) matrix of ints. Each int is the index corresponds to a cell. Thus each index is Moore contiguous within I.
         @param s: Index of the pixel in question.
         """
+        geometry = self.sample.geometry
+        if (I is self.sigma_field) and (geometry is not None) and not geometry.is_stale(self):
+            # Restrict to the bounding box of the cell, with a margin of one pixel, unless it touches the lattice edge.
+            x_min, x_max, y_min, y_max = geometry.get_box(s)
+            if (x_min > 0) and (y_min > 0) and (x_max < self.num_x - 1) and (y_max < self.num_y - 1):
+                I = I[x_min - 1:x_max + 2, y_min - 1:y_max + 2]
         M = I == s
         PI = np.sum(np.array([M != np.roll(np.roll(M, i, axis=0), j, axis=1) for i, j in self.perim_neighbour]), axis=0)
         P = np.sum(PI * M)
@@ -254,35 +565,315 @@ class CPM:
         return (PI != 0)
     
 
-    def initialize(self, J0, n_initialise_steps=10000):
+    def get_neighbour_pairs(self, X):
+        """
+        Views of a lattice-shaped array X at both ends of every pair of Moore neighbours, such that each pair is
+        enumerated once (via the shifts (1,0), (0,1), (1,1) and (1,-1)). The lattice is not periodic.
+        @param X: (num_x x num_y) array, e.g. the sigma field.
+        @return: list of four (X1, X2) tuples of views of X, where X2 holds the neighbours of the pixels of X1.
+        """
+        pairs = []
+        for di, dj in ((1, 0), (0, 1), (1, 1), (1, -1)):
+            pairs.append((X[:self.num_x - di, max(-dj, 0):self.num_y - max(dj, 0)],
+                          X[di:, max(dj, 0):self.num_y - max(-dj, 0)]))
+        return pairs
+
+
+    def get_sigma_pairs(self):
+        """
+        Cell indices at both ends of every pair of Moore neighbours of the sigma field, as **get_neighbour_pairs**, or
+        from the tiles of a tiled lattice, leaving out pairs of medium pixels that are not stored (see
+        **TiledLattice.get_neighbour_pairs**).
+        @return: list of (I1, I2) tuples of arrays of the same shape.
+        """
+        if self.lattice is not None:
+            return self.lattice.get_neighbour_pairs()
+        return self.get_neighbour_pairs(self.sigma_field)
+
+
+    def get_field(self, x0=0, x1=None, y0=0, y1=None):
+        """
+        Dense copy of the window [x0, x1) x [y0, y1) of the sigma field, e.g. to render part of a large lattice with
+        **generate_image**. On a tiled lattice, only the tiles overlapping the window are read.
+        """
+        if self.lattice is not None:
+            return self.lattice.get_window(x0, x1, y0, y1)
+        return self.sigma_field[x0:x1, y0:y1].copy()
+
+
+    def get_snapshot(self):
+        """
+        Copy of the sigma field, as saved in self.sigma_save: a dense array, or a csr sparse matrix (scipy.sparse
+        module) built from the tiles of a tiled lattice.
+        """
+        if self.lattice is not None:
+            return self.lattice.to_sparse()
+        return self.sigma_field.copy()
+
+
+    def open_snapshots(self, path):
+        """
+        Stream the snapshots of the simulation to the file **path** (see the **snapshots** module), rather than keeping
+        them in memory in self.sigma_save, which is None until **close_snapshots**.
+        """
+        self.close_snapshots()
+        self.snapshot_writer = SnapshotWriter(path, (self.num_x, self.num_y), self.get_sigma_dtype())
+        self.sigma_save = None
+
+
+    def save_snapshot(self, i):
+        """
+        Save the current sigma field as snapshot i: streamed to disk if **open_snapshots** was called, else in
+        self.sigma_save.
+        """
+        if self.snapshot_writer is not None:
+            self.snapshot_writer.append(self.sigma_field if self.lattice is None else self.get_field())
+        else:
+            self.sigma_save[i] = self.get_snapshot()
+
+
+    def close_snapshots(self):
+        """
+        Finish streaming the snapshots to disk, if they are, and open them for reading as self.sigma_save, a
+        **SnapshotReader**, a sequence of (num_x x num_y) arrays.
+        """
+        if self.snapshot_writer is not None:
+            writer, self.snapshot_writer = self.snapshot_writer, None
+            writer.close()
+            self.sigma_save = SnapshotReader(writer.path)
+
+
+    def get_energy(self):
+        """
+        Calculate the total energy of the tissue from scratch, vectorised over the lattice: the area and perimeter terms
+        of every cell, plus the interfacial energy J of every pair of Moore neighbours.
+
+        The samplers keep **self.energy** up to date incrementally, with the change in energy of every accepted swap.
+        This function initialises it, and verifies it (see **check_energy**).
+        @return: H, the total energy.
+        """
+        cells = self.cell_ids
+        H = np.sum(self.lambda_A[cells] * (self.A[cells] - self.A0[cells]) ** 2
+                   + self.lambda_P[cells] * (self.P[cells] - self.P0[cells]) ** 2)
+        for I1, I2 in self.get_sigma_pairs():
+            H += np.sum(self.get_J(I1, I2))
+        for term in self.energy_terms:
+            if term.energy is not None:
+                H += term.energy(self)
+        return H
+
+
+    def add_energy_term(self, term):
+        """
+        Add an extra term to the energy functional, e.g. **energy.field_term** or **energy.length_term** (see the
+        **energy** module). All samplers are recompiled once for the new set of terms, which are then evaluated inside
+        the compiled kernels.
+        @param term: an **EnergyTerm**.
+        @return: the **EnergyTerm**.
+        """
+        self.energy_terms.append(term)
+        self.energy = None  # the energy functional has changed; recomputed by the samplers on their next call.
+        return term
+
+
+    def clear_energy_terms(self):
+        """
+        Remove all extra terms of the energy functional.
+        """
+        self.energy_terms = []
+        self.energy = None
+
+
+    def check_energy(self, rtol=1e-6):
+        """
+        Verify the incrementally tracked energy, **self.energy**, against **get_energy**, and resynchronise it.
+        @param rtol: Tolerated difference, relative to the magnitude of the energy.
+        @return: drift, the difference between the tracked and the recomputed energy.
+        """
+        H = self.get_energy()
+        drift = 0. if self.energy is None else self.energy - H
+        assert abs(drift) <= rtol * max(abs(H), 1.), "Tracked energy %g differs from %g" % (self.energy, H)
+        self.energy = H
+        return drift
+
+
+    def get_sorting_index(self):
+        """
+        Fraction of the contacts between cells (pairs of Moore neighbours in different cells, medium excluded) that are
+        between cells of the same type. Increases as the cell types sort.
+        @return: The sorting index, between 0 and 1.
+        """
+        n_contacts, n_homotypic = 0, 0
+        for I1, I2 in self.get_sigma_pairs():
+            contact = (I1 != I2) & (I1 != 0) & (I2 != 0)
+            n_contacts += np.sum(contact)
+            n_homotypic += np.sum(contact & (self.cell_type[I1] == self.cell_type[I2]))
+        return n_homotypic / max(n_contacts, 1)
+
+
+    def get_contacts(self):
+        """
+        Contact lengths between cells and between cell types (see the **contacts** module).
+
+        On the first call, the contacts are computed from the sigma field. They are then maintained by the samplers
+        after every accepted swap, such that subsequent calls, and sorting metrics such as
+        **Contacts.sorting_index**, are O(1).
+        @return: the **Contacts** object.
+        """
+        return self.sample.enable_contacts()
+
+
+    def get_geometry(self, pixel_list=False):
+        """
+        Bounding boxes, centroids and second moments of the cells, and optionally their lists of pixels (see the
+        **geometry** module).
+
+        On the first call, these are computed from the sigma field. They are then maintained by the samplers after every
+        accepted swap, such that per-cell queries cost O(cell size) rather than O(lattice).
+        @param pixel_list: Boolean. If True, also maintain the list of pixels of every cell.
+        @return: the **CellGeometry** object.
+        """
+        return self.sample.enable_geometry(pixel_list)
+
+
+    def has_converged(self, metric, window, tolerance):
+        """
+        Plateau criterion for early stopping: the means of **metric** over the last two windows differ by less than
+        **tolerance** times the range of **metric** so far.
+        @param metric: Sequence of the values of the metric, one per snapshot.
+        @param window: Number of snapshots per window.
+        @param tolerance: Tolerated change, relative to the range of the metric.
+        @return: True if the metric has plateaued.
+        """
+        if len(metric) < 2 * window + 1:  # the first value is that of the initial state.
+            return False
+        metric = np.asarray(metric)
+        change = abs(metric[-window:].mean() - metric[-2 * window:-window].mean())
+        return change <= tolerance * (metric.max() - metric.min())
+
+
+    def initialize(self, J0, n_initialise_steps=10000, coarsen=None, n_polish_steps=None):
         """
         Initialise the I matrix by performing M-H steps, after defining the approximate initialisation in **make_init**.
 
         See self.simulate function for more details, as these two functions are very analogous.
 
+        With a downsampling factor **coarsen** f > 1, the tissue is first relaxed on a lattice downsampled by f (see
+        **relax_coarse**), for the same number of MCS as n_initialise_steps at full resolution, i.e. for
+        n_initialise_steps / f^2 steps, then upsampled and polished by **n_polish_steps** steps at full resolution.
+        With the default polish, this costs about 2 / f^2 of the initialisation at full resolution. f should leave the
+        coarse target areas, A0 / f^2, at several pixels.
+
+        If the CPM object has a cache of initialised tissues (see the **cache** module), the initialised tissue is
+        loaded from the cache when the same initialisation has run before, from the same sigma field and random number
+        stream, and stored in it otherwise. Not on a tiled lattice, nor with extra terms of the energy functional.
+
         @param J0: Definition of the J-matrix for the initialisation steps.
         @param n_initialise_steps: Number of initialisation steps.
+        @param coarsen: Downsampling factor f. Defaults to the "init_coarsen" entry of the CPM parameters, else 1.
+        @param n_polish_steps: Number of steps at full resolution after a coarse relaxation. Defaults to
+        n_initialise_steps / f^2.
         """
 
         print("\nInitializing...")
 
-        J = self.J.copy()
+        coarsen = coarsen if coarsen is not None else self.params.get("init_coarsen", 1)
+        cache, key = self.init_cache, None
+        if (cache is not None) and (self.lattice is None) and not self.energy_terms:
+            key = cache.get_key(self, J0, n_initialise_steps, coarsen, n_polish_steps)
+            if cache.load(self, key):
+                print("Loaded from the cache of initialised tissues.\n")
+                return
+
+        if coarsen > 1:
+            self.relax_coarse(J0, int(n_initialise_steps / coarsen ** 2), coarsen)
+            n_initialise_steps = int(n_initialise_steps / coarsen ** 2) if n_polish_steps is None else n_polish_steps
+        self.relax(J0, n_initialise_steps)
+        if key is not None:
+            cache.store(self, key)
+
+        print("Done with initialisation.\n")
+
+
+    def relax(self, J0, n_steps):
+        """
+        Perform n_steps M-H steps with the interfacial energies of the initialisation: J0 between all cells, 0 with the
+        medium, and the largest lambda_P for all cells. The energy functional is restored afterwards.
+        """
+        adhesion_table, J_overrides = self.adhesion_table, self.J_overrides
         lambda_P = self.lambda_P.copy()
         self.lambda_P[:] = np.max(self.lambda_P)
-        self.J = np.zeros_like(self.J)
-        self.J[1:, 1:] = J0 # Set temporary cell-cell adhesion values
-        self.J = self.J * (1 - np.eye(self.J.shape[0]))
-        self.get_J_diff()
-        self.sample.n_steps = n_initialise_steps
+        self.adhesion_table = np.zeros_like(adhesion_table)
+        self.adhesion_table[1:, 1:] = J0 # Set temporary cell-cell adhesion values
+        self.J_overrides = {}
+        self.update_adhesion()
+        self.energy = None
+        self.sample.n_steps = n_steps
         self.sample.do_steps()
-        self.J = J.copy()
+        self.adhesion_table, self.J_overrides = adhesion_table, J_overrides
         self.lambda_P = lambda_P.copy()
-        self.get_J_diff()
+        self.update_adhesion()
+        self.energy = None
 
-        print("Done with initialisation.\n")
 
+    def relax_coarse(self, J0, n_steps, coarsen):
+        """
+        Relax the tissue by **relax** on a lattice downsampled by a factor f = **coarsen**, then upsample it back into
+        the sigma field.
+
+        The coarse lattice holds the centre pixel of every f x f block of the sigma field. Cells that lose all their
+        pixels are reseeded with a single pixel near their centroid. The target areas and perimeters are divided by f^2
+        and f, and lambda_A and lambda_P multiplied by f^3 and f, such that the energy of every coarse shape is that of
+        its fine counterpart divided by f, for the same interfacial energies. The temperature is divided by f as well,
+        such that every coarse swap is accepted with the probability of its fine counterpart at the temperature of
+        **sample**. Every coarse pixel is then upsampled to a block of f x f pixels, which keeps every cell contiguous,
+        and its staircase boundaries are left to the polish at full resolution. The coarse lattice is sampled with the
+        same sampler and random number stream, without the extra terms of the energy functional.
+        @param J0: Definition of the J-matrix for the initialisation steps.
+        @param n_steps: Number of steps on the coarse lattice.
+        @param coarsen: Downsampling factor f.
+        """
+        assert self.lattice is None, "Coarse initialisation requires a dense sigma field"
+        f = coarsen
+        coarse = CPM(self.params)
+        coarse.rng = self.rng
+        coarse.sample.sampler, coarse.sample.T = self.sample.sampler, self.sample.T / f
+        coarse.make_grid(-(-self.num_x // f), -(-self.num_y // f))
+        coarse.c_types, coarse.n_cells, coarse.n_types = self.c_types, self.n_cells, self.n_types
+        coarse.cell_type, coarse.A0, coarse.P0 = self.cell_type, self.A0 / f ** 2, self.P0 / f
+        coarse.lambda_A, coarse.lambda_P = self.lambda_A * f ** 3, self.lambda_P * f
+        coarse.make_J()
+        coarse.fit_sigma_dtype()
+
+        I = self.sigma_field[f // 2::f, f // 2::f]
+        n_x, n_y = min(I.shape[0], coarse.num_x - 1), min(I.shape[1], coarse.num_y - 1)
+        coarse.sigma_field[1:n_x, 1:n_y] = I[1:n_x, 1:n_y]
+        A = np.bincount(coarse.sigma_field.ravel(), minlength=len(self.cell_type))
+        missing = self.cell_ids[A[self.cell_ids] == 0]
+        if len(missing):
+            x, y = np.indices(self.sigma_field.shape)
+            labels, n = self.sigma_field.ravel(), len(self.cell_type)
+            n_pixels = np.maximum(np.bincount(labels, minlength=n), 1)
+            cx = np.bincount(labels, x.ravel(), n) / n_pixels / f
+            cy = np.bincount(labels, y.ravel(), n) / n_pixels / f
+            for s in missing:
+                # Nearest pixel of the medium, or of a cell with other pixels, away from the border of the lattice.
+                free = (A[coarse.sigma_field] > 1) | (coarse.sigma_field == 0)
+                free[[0, -1], :], free[:, [0, -1]] = False, False
+                X, Y = np.nonzero(free)
+                k = np.argmin((X - cx[s]) ** 2 + (Y - cy[s]) ** 2)
+                A[coarse.sigma_field[X[k], Y[k]]] -= 1
+                coarse.sigma_field[X[k], Y[k]], A[s] = s, 1
+        coarse.assign_AP()
+        coarse.relax(J0, n_steps)
+
+        I = np.repeat(np.repeat(coarse.sigma_field, f, axis=0), f, axis=1)
+        self.sigma_field = I[:self.num_x, :self.num_y].copy()
+        self.assign_AP()
 
-    def simulate(self, n_step, n_save, initialize=True, J0=None, n_initialise_steps=10000):
+
+    def simulate(self, n_step, n_save, initialize=True, J0=None, n_initialise_steps=10000, stop_metric=None,
+                 stop_window=10, stop_tolerance=0.01, verify_energy=False, snapshot_path=None):
         """
         Simulate the CPM algorithm.
 
@@ -298,12 +889,28 @@ class CPM:
 
         Prints the percentage of the simulation that is complete every time that a snapshot is saved.
 
+        On a tiled lattice, the snapshots are csr sparse matrices (see **get_snapshot**). With **snapshot_path**, the
+        snapshots are instead streamed to disk as they are produced, from a background thread, such that the memory of
+        the simulation does not grow with the number of snapshots, and a crash only loses the last few snapshots. When
+        the simulation ends, self.sigma_save reads them back (see **close_snapshots**).
+
+        The total energy at every snapshot is saved in self.energy_save. If **stop_metric** is given, the simulation
+        stops early once the metric has plateaued (see **has_converged**), and the snapshots are truncated accordingly.
+
         @param n_step: Total number of iterations of the M-H algorithm (not including initialization steps)
         @param n_save: Number of snapshots saved for further analysis.
         @param initialize: Boolean. If True, then initialise under the M-H algorithm with self.initialize.
         @param J0: Definition of the J-matrix for the initialisation steps.
         @param n_initialise_steps: Number of initialisation steps.
+        @param stop_metric: None (run all n_step), "energy" (total energy) or "sorting" (see **get_sorting_index**).
+        @param stop_window: Number of snapshots over which the metric is averaged.
+        @param stop_tolerance: Tolerated change of the windowed metric, relative to its range.
+        @param verify_energy: Boolean. If True, verify the tracked energy at every snapshot (see **check_energy**).
+        @param snapshot_path: Path of the file of the snapshots. Defaults to the "snapshot_path" entry of the CPM
+        parameters, else None, keeping the snapshots in memory.
         """
+        assert stop_metric in (None, "energy", "sorting"), "Unknown stop_metric %s" % stop_metric
+        snapshot_path = snapshot_path if snapshot_path is not None else self.params.get("snapshot_path")
         if initialize:
             self.initialize(J0, n_initialise_steps)
 
@@ -313,18 +920,43 @@ class CPM:
         self.t = np.arange(n_step)
         self.t_save = self.t[::self.skip]
         self.n_save = len(self.t_save)
-        self.sigma_save = np.zeros((self.n_save + 1, self.num_x, self.num_y), dtype=int)
+        if snapshot_path is not None:
+            self.open_snapshots(snapshot_path)
+        elif self.lattice is None:
+            self.sigma_save = np.zeros((self.n_save + 1, self.num_x, self.num_y), dtype=self.sigma_field.dtype)
+        else:
+            self.sigma_save = [None] * (self.n_save + 1)
 
         n_steps = int(n_step / self.skip)
-        self.sigma_save[0] = self.sigma_field.copy()
-
-        for i in range(n_steps):
-            self.sample.do_steps()
-            self.sigma_save[i + 1] = self.sigma_field.copy()
-            print("Progress: %.1f %% " % (100 * ((i+1) / n_steps)))
-
-
-    def simulate_with_gui(self, n_step, n_save, step, initialize=True, J0=None, n_initialise_steps=10000):
+        self.save_snapshot(0)
+        if self.energy is None:
+            self.energy = self.get_energy()
+        self.energy_save = [self.energy]
+        metric = [self.get_sorting_index()] if stop_metric == "sorting" else self.energy_save
+
+        try:
+            for i in range(n_steps):
+                self.sample.do_steps()
+                self.save_snapshot(i + 1)
+                if verify_energy:
+                    self.check_energy()
+                self.energy_save.append(self.energy)
+                if stop_metric == "sorting":
+                    metric.append(self.get_sorting_index())
+                print("Progress: %.1f %% " % (100 * ((i+1) / n_steps)))
+                if (stop_metric is not None) and self.has_converged(metric, stop_window, stop_tolerance):
+                    if self.snapshot_writer is None:  # streamed snapshots end at the last one written.
+                        self.sigma_save = self.sigma_save[:i + 2]
+                    self.n_step = (i + 1) * self.skip
+                    print("Converged after %d steps." % ((i + 1) * self.skip))
+                    break
+        finally:
+            self.close_snapshots()
+        self.energy_save = np.array(self.energy_save)
+
+
+    def simulate_with_gui(self, n_step, n_save, step, initialize=True, J0=None, n_initialise_steps=10000,
+                          snapshot_path=None):
         """
         Simulate the CPM algorithm when the graphical user interface (GUI) is used. 
         To allow updating of the GUI, only a single step when the function is called.
@@ -341,13 +973,19 @@ class CPM:
 
         Prints the percentage of the simulation that is complete every time that a snapshot is saved.
 
+        With **snapshot_path**, the snapshots are streamed to disk as in **simulate**, until step n_step, or until
+        **close_snapshots** is called, e.g. when the GUI is closed early. They are also closed if a step fails.
+
         @param n_step: Total number of iterations of the M-H algorithm (not including initialization steps)
         @param n_save: Number of snapshots saved for further analysis.
         @param step: Current Monte Carlo step.
         @param initialize: Boolean. If True, then initialise under the M-H algorithm with self.initialize.
         @param J0: Definition of the J-matrix for the initialisation steps.
         @param n_initialise_steps: Number of initialisation steps.
+        @param snapshot_path: Path of the file of the snapshots. Defaults to the "snapshot_path" entry of the CPM
+        parameters, else None, keeping the snapshots in memory.
         """
+        assert self.lattice is None, "The GUI requires a dense sigma field"
         if initialize:
             self.initialize(J0, n_initialise_steps)
 
@@ -359,18 +997,28 @@ class CPM:
             self.t_save  = self.t[::self.skip]
             self.n_save  = len(self.t_save)
             
-            self.sigma_save = np.zeros((self.n_save + 1, self.num_x, self.num_y), dtype=int)
-            self.sigma_save[0] = self.sigma_field.copy()
+            snapshot_path = snapshot_path if snapshot_path is not None else self.params.get("snapshot_path")
+            if snapshot_path is not None:
+                self.open_snapshots(snapshot_path)
+            else:
+                self.sigma_save = np.zeros((self.n_save + 1, self.num_x, self.num_y), dtype=self.sigma_field.dtype)
+            self.save_snapshot(0)
             self.save_index = 1
 
-        self.sample.do_step()
+        try:
+            self.sample.do_step()
 
-        # Save the current sigma field
-        if step in self.t_save:
-            self.sigma_save[self.save_index] = self.sigma_field.copy()
-            self.save_index += 1
+            # Save the current sigma field
+            if step in self.t_save:
+                self.save_snapshot(self.save_index)
+                self.save_index += 1
 
-            print("Progress: %.1f %% " % (100 * (step / self.MCS_total)))
+                print("Progress: %.1f %% " % (100 * (step / self.MCS_total)))
+        except BaseException:
+            self.close_snapshots()
+            raise
+        if step >= self.MCS_total:
+            self.close_snapshots()
 
 
     def save_simulation(self, dir_path, name):
@@ -378,19 +1026,42 @@ class CPM:
         Save the simulation to file. This is the set of I matrices in the snapshots of the self.simulate function
         i.e. of length n_save.
 
-        This heavily compresses the data. Each I matrix is first made a csr sparse matrix (scipy.sparse module).
-        As a list of sparse-matrices, then generate a compressed (pbz2) pickle file. Save to file.
+        The snapshots are written in the binary run format of the **snapshots** module: a keyframe per chunk of
+        snapshots, then only the pixels that changed between consecutive snapshots, compressed with zlib, and an index
+        of the chunks for random access. Snapshots that were streamed to disk during the run are already in this
+        format, and their file is copied. Read back with **load_simulation**.
 
         @param dir_path: Directory path into which the file will be saved.
         @param name: Name of the file (not including the extension, which is added).
+        @return: Path of the file.
         """
-        self.sigma_save_sparse = [None] * len(self.sigma_save)
-        for i, I in enumerate(self.sigma_save):
-            self.sigma_save_sparse[i] = sparse.csr_matrix(I)
-            
-        out_path = Path(dir_path) / f"{name}.pbz2"
-        with bz2.BZ2File(out_path, 'w') as f:
-            cPickle.dump(self.sigma_save_sparse, f)
+        self.close_snapshots()
+        out_path = Path(dir_path) / f"{name}.cpmrun"
+        if isinstance(self.sigma_save, SnapshotReader):
+            if out_path.resolve() != self.sigma_save.path.resolve():
+                shutil.copyfile(self.sigma_save.path, out_path)
+        else:
+            with SnapshotWriter(out_path, (self.num_x, self.num_y), self.get_sigma_dtype()) as writer:
+                for I in self.sigma_save:
+                    writer.append(I.toarray() if sparse.issparse(I) else I)
+        return out_path
+
+
+    def load_simulation(self, path):
+        """
+        Load the snapshots of a simulation saved by **save_simulation** as self.sigma_save, a **SnapshotReader**, which
+        decodes them on access. Files of the former format, a bz2-compressed pickle of csr sparse matrices (.pbz2), are
+        loaded as a list of dense arrays.
+        @param path: Path of the file.
+        @return: self.sigma_save.
+        """
+        path = Path(path)
+        if path.suffix == ".pbz2":
+            with bz2.BZ2File(path, "rb") as f:
+                self.sigma_save = [I.toarray() for I in cPickle.load(f)]
+        else:
+            self.sigma_save = SnapshotReader(path)
+        return self.sigma_save
 
 
     def generate_image(self, I, res=8, col_dict={"E": "red", "T": "blue", "X": "green"},
@@ -419,25 +1090,27 @@ class CPM:
         @return:
         """
         I_scale = np.repeat(np.repeat(I, res, axis=0), res, axis=1)
-        Im = np.zeros([I.shape[0] * res, I.shape[1] * res, 4]).astype(float)
-        Im[:, :, :] = background
 
-        for j in range(1, self.n_cells + 1):
-            cll_mask = I_scale == j
+        # Colour of every cell index, then indexed by the upscaled sigma field in a single pass.
+        cll_colours = np.zeros([self.n_cells + 1, 4])
+        cll_colours[:] = background
+        for j in self.cell_ids:
             cll_type = self.c_types[j - 1]
             col_name = col_dict.get(cll_type)
             if type(col_name) is str:
                 col = np.array(colors.to_rgba(col_name))
             else:
                 col = col_name
-            Im[cll_mask] = col
+            cll_colours[j] = col
+        Im = cll_colours[I_scale]
         boundaries = self.get_perimeter_elements(I_scale)
         I_scale[boundaries] = 0
         Im[boundaries] = 0
         return Im
 
 
-    def generate_image_t(self, res=8, col_dict={"E": "red", "T": "blue"}, background=np.array([0, 0, 0, 0.6])):
+    def generate_image_t(self, res=8, col_dict={"E": "red", "T": "blue"}, background=np.array([0, 0, 0, 0.6]),
+                         window=None):
         """
         Iterate **self.generate_image** over all of the snapshots in I_save (of length n_save).
 
@@ -446,9 +1119,13 @@ class CPM:
         boundaries of cells are with respect to their areas.
         @param col_dict: Dictionary of colours for each of the cell types.
         @param background: RGBA colour of the background/medium.
+        @param window: (x0, x1, y0, y1), to only render the window [x0, x1) x [y0, y1) of the lattice, e.g. around the
+        tissue on a large tiled lattice, whose sparse snapshots are only densified within the window. None for the whole
+        lattice.
         """
-        n_save = self.sigma_save.shape[0]
-        Im_save = np.zeros([n_save, self.sigma_save.shape[1] * res, self.sigma_save.shape[2] * res, 4])
+        x0, x1, y0, y1 = (0, self.num_x, 0, self.num_y) if window is None else window
+        Im_save = np.zeros([len(self.sigma_save), (x1 - x0) * res, (y1 - y0) * res, 4])
         for ni, I in enumerate(self.sigma_save):
-            Im_save[ni] = self.generate_image(I, res, col_dict, background)
+            I = I[x0:x1, y0:y1]
+            Im_save[ni] = self.generate_image(I.toarray() if sparse.issparse(I) else I, res, col_dict, background)
         self.Im_save = Im_save
\ No newline at end of file
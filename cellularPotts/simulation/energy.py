@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+"""
+This module defines extra terms of the energy functional, added to the area, perimeter and adhesion terms of the
+**kernels** module, such as an external field, chemotaxis or a length constraint.
+
+A term is an **EnergyTerm**: a compiled function dH(params, I, i, j, s, s2), giving the change in the energy of the
+term when pixel (i,j) is swapped from cell index s to s2 (before I is modified), together with its parameters params,
+any tuple of arrays and scalars. Terms are registered with **CPM.add_energy_term**.
+
+The registered terms are combined by **compile_terms** into a single compiled function, generated from source such
+that every term is called directly, which is passed to the kernels with the parameters of all terms, concatenated into
+a flat tuple (nested tuples cannot be passed to the parallel loops of the "checkerboard" sampler).
+numba compiles a version of the kernels specialised for the set of terms, in which the terms are inlined like
+hand-written code, so a run with N terms costs the same as a hand-written kernel, and no Python function is called in
+the hot loop. Without terms, None is passed and the evaluation is pruned at compile time.
+
+The terms are only evaluated for swaps permitted by the zmasks. For the "rejection_free" sampler, whose rates are only
+updated around every swap, dH must only depend on the Moore neighbourhood of (i,j) and on the properties of s and s2.
+"""
+
+import numpy as np
+from numba import jit
+
+from .geometry import N, SX, SXX, SXY, SY, SYY
+
+compiled_terms = {}  # combined functions, by the dH functions and numbers of parameters of the terms.
+
+
+class EnergyTerm:
+    """
+    **EnergyTerm** class, an extra term of the energy functional. See **CPM.add_energy_term**.
+    """
+
+    def __init__(self, dH, params=(), energy=None, name=None):
+        """
+        Initialise **EnergyTerm** class.
+        @param dH: Compiled function dH(params, I, i, j, s, s2), the change in energy of swapping pixel (i,j) from s to
+        s2.
+        @param params: Tuple of the parameters of the term, passed to dH. Or a function returning this tuple, called
+        before every call of the samplers, e.g. to reference arrays that may be replaced, such as those of the
+        **CellGeometry**.
+        @param energy: Function energy(cpm), the energy of the term for the current state of the CPM object, included
+        in **CPM.get_energy**. If None, the term is left out of **CPM.get_energy**, and **CPM.check_energy** fails.
+        @param name: Name of the term.
+        """
+        self.dH = dH
+        self.params = params
+        self.energy = energy
+        self.name = name if name is not None else dH.__name__
+
+    def get_params(self):
+        """
+        The parameters, as passed to dH.
+        """
+        return self.params() if callable(self.params) else self.params
+
+
+def compile_terms(dHs, sizes):
+    """
+    Combine the dH functions of several terms into a single compiled function terms_dH(params, I, i, j, s, s2), where
+    params is the flat tuple of the parameters of every term, returning the sum of their changes in energy.
+
+    The function is generated from source, with each term called by name on its slice of params, rather than through a
+    tuple of functions, such that numba resolves every call at compile time. It is compiled once per combination of
+    terms.
+    @param dHs: The dH functions of the terms.
+    @param sizes: The number of parameters of each term.
+    """
+    key = (tuple(dHs), tuple(sizes))
+    if key not in compiled_terms:
+        calls, start = [], 0
+        for k, size in enumerate(sizes):
+            args = "".join("params[%d], " % p for p in range(start, start + size))
+            calls.append("dH_%d((%s), I, i, j, s, s2)" % (k, args))
+            start += size
+        source = "def terms_dH(params, I, i, j, s, s2):\n    return %s\n" % " + ".join(calls)
+        namespace = {"dH_%d" % k: dH for k, dH in enumerate(dHs)}
+        exec(source, namespace)
+        compiled_terms[key] = jit(nopython=True)(namespace["terms_dH"])
+    return compiled_terms[key]
+
+
+def get_kernel_terms(terms):
+    """
+    The terms, as passed to the compiled kernels.
+    @param terms: List of **EnergyTerm** objects.
+    @return: terms_dH, the combined function (see **compile_terms**), and the flat tuple of the parameters of every
+    term. None, None if there are no terms.
+    """
+    if len(terms) == 0:
+        return None, None
+    params = [tuple(term.get_params()) for term in terms]
+    return compile_terms([term.dH for term in terms], [len(p) for p in params]), sum(params, ())
+
+
+def per_cell(cpm, values):
+    """
+    Convert a parameter prescribed per cell type, as in the parameter dictionary, into a vector over all cell indices,
+    with 0 for the medium and for removed cells.
+    """
+    return np.concatenate(((0.,), np.asarray(values, dtype=np.float64)))[cpm.cell_type]
+
+
+@jit(nopython=True)
+def field_dH(params, I, i, j, s, s2):
+    """
+    Change in the energy of an external field, sum over pixels of field[i,j] * strength[I[i,j]].
+    params is the tuple (field, strength).
+    """
+    field, strength = params
+    return field[i, j] * (strength[s2] - strength[s])
+
+
+def field_term(cpm, field, strength):
+    """
+    External field, or chemotaxis along a fixed chemical field: the energy is the sum over pixels of
+    field[i,j] * strength[cell type], such that cells with a positive strength move down the field, and cells with a
+    negative strength up the field. The medium does not couple to the field.
+    @param cpm: a CPM object.
+    @param field: (num_x x num_y) array of the field.
+    @param strength: Coupling of each cell type to the field, as in the parameter dictionary.
+    @return: the **EnergyTerm**.
+    """
+    field = np.asarray(field, dtype=np.float64)
+    assert field.shape == (cpm.num_x, cpm.num_y), "The field must have the shape of the lattice"
+
+    def energy(cpm):
+        return np.sum(field * per_cell(cpm, strength)[cpm.sigma_field])
+
+    return EnergyTerm(field_dH, lambda: (field, per_cell(cpm, strength)), energy, "field")
+
+
+@jit(nopython=True)
+def cell_length(n, sx, sy, sxx, syy, sxy):
+    """
+    Length of a cell from its raw moments (see the **geometry** module): the major axis of the ellipse with the same
+    second moments, 4 * sqrt(largest eigenvalue of the covariance matrix).
+    """
+    if n == 0:
+        return 0.
+    x, y = sx / n, sy / n
+    xx, yy, xy = sxx / n - x * x, syy / n - y * y, sxy / n - x * y
+    return 4. * np.sqrt(max(0.5 * (xx + yy) + np.sqrt(0.25 * (xx - yy) ** 2 + xy ** 2), 0.))
+
+
+@jit(nopython=True)
+def length_change(moments, c, i, j, sign, lambda_L, L0):
+    """
+    Change in lambda_L * (L - L0)^2 when pixel (i,j) is added to (sign = 1) or removed from (sign = -1) cell c.
+    """
+    m = moments[c]
+    L = cell_length(m[N], m[SX], m[SY], m[SXX], m[SYY], m[SXY])
+    L_new = cell_length(m[N] + sign, m[SX] + sign * i, m[SY] + sign * j, m[SXX] + sign * i * i,
+                        m[SYY] + sign * j * j, m[SXY] + sign * i * j)
+    return lambda_L * ((L_new - L0) ** 2 - (L - L0) ** 2)
+
+
+@jit(nopython=True)
+def length_dH(params, I, i, j, s, s2):
+    """
+    Change in the energy of the length constraint. params is the tuple (moments, lambda_L, L0).
+    """
+    moments, lambda_L, L0 = params
+    dH = 0.
+    if s != 0:
+        dH += length_change(moments, s, i, j, -1, lambda_L[s], L0[s])
+    if s2 != 0:
+        dH += length_change(moments, s2, i, j, 1, lambda_L[s2], L0[s2])
+    return dH
+
+
+def length_term(cpm, lambda_L, L0):
+    """
+    Length constraint: the energy is the sum over cells of lambda_L * (L - L0)^2, where L is the length of the cell,
+    the major axis of the ellipse with the same second moments. The moments are read from the **CellGeometry** of
+    the CPM object, which is maintained by the samplers as soon as the term is registered (see **CPM.get_geometry**).
+    @param cpm: a CPM object.
+    @param lambda_L: Coefficient of the (L - L0) term, for each cell type.
+    @param L0: Target length, for each cell type.
+    @return: the **EnergyTerm**.
+    """
+    def energy(cpm):
+        m = cpm.get_geometry().moments.astype(np.float64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            x, y = m[:, SX] / m[:, N], m[:, SY] / m[:, N]
+            xx, yy, xy = m[:, SXX] / m[:, N] - x * x, m[:, SYY] / m[:, N] - y * y, m[:, SXY] / m[:, N] - x * y
+        L = 4 * np.sqrt(np.maximum(0.5 * (xx + yy) + np.sqrt(0.25 * (xx - yy) ** 2 + xy ** 2), 0))
+        L[m[:, N] == 0] = 0
+        return np.sum((per_cell(cpm, lambda_L) * (L - per_cell(cpm, L0)) ** 2)[1:])
+
+    return EnergyTerm(length_dH, lambda: (cpm.get_geometry().moments, per_cell(cpm, lambda_L), per_cell(cpm, L0)),
+                      energy, "length")
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+"""
+This module defines **CellGeometry**, per-cell geometric properties maintained incrementally by the samplers, such that
+per-cell queries cost O(cell size) rather than O(lattice).
+
+For every cell (the medium excluded), the following are kept up to date in O(1) per accepted swap:
+- the raw moments: number of pixels, sums of x, y, x^2, y^2 and xy, as exact integers (moments), from which the
+centroid and the second moments follow;
+- a bounding box, [x_min, x_max, y_min, y_max] (box). The box grows with the cell, but is not shrunk when the cell loses
+a pixel on its edge, which cannot be detected in O(1). It thus always contains the cell, and is tightened on query
+(see **CellGeometry.get_box**), by scanning the box or the pixel list;
+- optionally, the list of pixels of the cell, as intrusive doubly linked lists (next_pixel, prev_pixel, head), with
+O(1) insertion and removal.
+
+Kernels receive either the tuple of these arrays (see **CellGeometry.kernel_args**), or None, in which case the update
+is pruned at compile time.
+"""
+
+import numpy as np
+from numba import jit
+
+# Columns of the raw moments.
+N, SX, SY, SXX, SYY, SXY = range(6)
+
+
+class CellGeometry:
+    """
+    **CellGeometry** class. See **CPM.get_geometry**.
+    """
+
+    def __init__(self, cpm, pixel_list=False):
+        """
+        Initialise **CellGeometry** class, building the properties from the sigma field of the CPM object.
+        @param cpm: a CPM object.
+        @param pixel_list: Boolean. If True, also maintain the list of pixels of every cell.
+        """
+        self.cpm = cpm
+        self.pixel_list = pixel_list
+        self.rebuild()
+
+    def rebuild(self):
+        """
+        Recompute all properties from the sigma field.
+        """
+        cpm = self.cpm
+        self.I = cpm.sigma_field
+        self.moments = np.zeros((len(cpm.A), 6), dtype=np.int64)
+        self.box = np.zeros((len(cpm.A), 4), dtype=np.int64)
+        n_pixels = cpm.num_x * cpm.num_y if self.pixel_list else 0
+        self.next_pixel = np.full(n_pixels, -1, dtype=np.int64)
+        self.prev_pixel = np.full(n_pixels, -1, dtype=np.int64)
+        self.head = np.full(len(cpm.A) if self.pixel_list else 0, -1, dtype=np.int64)
+        build_geometry(self.I, cpm.num_x, cpm.num_y, self.kernel_args)
+
+    def resize(self):
+        """
+        Enlarge the per-cell arrays to the capacity of the CPM object (see **CPM.grow**), without rebuilding.
+        """
+        n = len(self.cpm.A) - len(self.moments)
+        self.moments = np.concatenate((self.moments, np.zeros((n, 6), dtype=np.int64)))
+        self.box = np.concatenate((self.box, np.zeros((n, 4), dtype=np.int64)))
+        if self.pixel_list:
+            self.head = np.concatenate((self.head, np.full(n, -1, dtype=np.int64)))
+
+    @property
+    def kernel_args(self):
+        """
+        The properties, as passed to the compiled kernels.
+        """
+        return self.moments, self.box, self.next_pixel, self.prev_pixel, self.head, self.cpm.num_y
+
+    def is_stale(self, cpm):
+        """
+        True if the sigma field or the cells of the CPM object have been replaced since the properties were built.
+        """
+        return (self.I is not cpm.sigma_field) or (len(self.moments) != len(cpm.A))
+
+    def area(self, s):
+        """
+        Number of pixels of cell s.
+        """
+        return int(self.moments[s, N])
+
+    def centroid(self, s):
+        """
+        @return: (x, y) centroid of cell s.
+        """
+        n = self.moments[s, N]
+        return self.moments[s, SX] / n, self.moments[s, SY] / n
+
+    def centroids(self):
+        """
+        @return: (capacity x 2) array of the centroids of all cell indices (NaN for the medium, and for empty cells).
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            c = self.moments[:, SX:SY + 1] / self.moments[:, N:N + 1]
+        c[0] = np.nan
+        return c
+
+    def second_moments(self, s):
+        """
+        @return: (2 x 2) covariance matrix of the pixel coordinates of cell s, about its centroid. Its eigenvalues and
+        eigenvectors give the elongation and orientation of the cell.
+        """
+        n = self.moments[s, N]
+        x, y = self.centroid(s)
+        xx = self.moments[s, SXX] / n - x ** 2
+        yy = self.moments[s, SYY] / n - y ** 2
+        xy = self.moments[s, SXY] / n - x * y
+        return np.array([[xx, xy], [xy, yy]])
+
+    def get_box(self, s):
+        """
+        Tight bounding box of cell s, in O(cell size). The stored box is tightened in place.
+        @return: x_min, x_max, y_min, y_max (inclusive).
+        """
+        assert self.moments[s, N] > 0, "Cell %d has no pixels" % s
+        if self.pixel_list:
+            pixels = self.get_pixels(s)
+            box = (pixels[:, 0].min(), pixels[:, 0].max(), pixels[:, 1].min(), pixels[:, 1].max())
+        else:
+            x_min, x_max, y_min, y_max = self.box[s]
+            x, y = np.nonzero(self.I[x_min:x_max + 1, y_min:y_max + 1] == s)
+            box = (x_min + x.min(), x_min + x.max(), y_min + y.min(), y_min + y.max())
+        self.box[s] = box
+        return tuple(int(b) for b in box)
+
+    def get_mask(self, s):
+        """
+        Mask of cell s within its tight bounding box, in O(cell size).
+        @return: x_min, y_min, the origin of the box, and mask, the boolean mask of the cell within the box.
+        """
+        x_min, x_max, y_min, y_max = self.get_box(s)
+        return x_min, y_min, self.I[x_min:x_max + 1, y_min:y_max + 1] == s
+
+    def get_pixels(self, s):
+        """
+        @return: (A x 2) array of the (x, y) coordinates of the pixels of cell s, in O(cell size).
+        """
+        if not self.pixel_list:
+            x_min, y_min, mask = self.get_mask(s)
+            x, y = np.nonzero(mask)
+            return np.stack((x_min + x, y_min + y), axis=1)
+        p = get_pixel_list(self.next_pixel, self.head, s, self.moments[s, N])
+        return np.stack((p // self.cpm.num_y, p % self.cpm.num_y), axis=1)
+
+
+@jit(nopython=True)
+def record_pixel(geometry, i, j, s, sign):
+    """
+    Add (sign = 1) or remove (sign = -1) pixel (i,j) to the properties of cell s != 0.
+    geometry is the tuple of **CellGeometry.kernel_args**.
+    """
+    moments, box, next_pixel, prev_pixel, head, num_y = geometry
+    moments[s, N] += sign
+    moments[s, SX] += sign * i
+    moments[s, SY] += sign * j
+    moments[s, SXX] += sign * i * i
+    moments[s, SYY] += sign * j * j
+    moments[s, SXY] += sign * i * j
+    if sign > 0:
+        if moments[s, N] == 1:
+            box[s, 0], box[s, 1], box[s, 2], box[s, 3] = i, i, j, j
+        else:
+            box[s, 0], box[s, 1] = min(box[s, 0], i), max(box[s, 1], i)
+            box[s, 2], box[s, 3] = min(box[s, 2], j), max(box[s, 3], j)
+    if len(head) > 0:  # pixel lists are maintained.
+        p = i * num_y + j
+        if sign > 0:
+            next_pixel[p] = head[s]
+            prev_pixel[p] = -1
+            if head[s] != -1:
+                prev_pixel[head[s]] = p
+            head[s] = p
+        else:
+            if prev_pixel[p] != -1:
+                next_pixel[prev_pixel[p]] = next_pixel[p]
+            else:
+                head[s] = next_pixel[p]
+            if next_pixel[p] != -1:
+                prev_pixel[next_pixel[p]] = prev_pixel[p]
+            next_pixel[p], prev_pixel[p] = -1, -1
+
+
+@jit(nopython=True)
+def record_flip_geometry(geometry, i, j, s, s2):
+    """
+    Update the properties for the swap of pixel (i,j) from s to s2. geometry is the tuple of
+    **CellGeometry.kernel_args**.
+    """
+    if s != 0:
+        record_pixel(geometry, i, j, s, -1)
+    if s2 != 0:
+        record_pixel(geometry, i, j, s2, 1)
+
+
+@jit(nopython=True)
+def build_geometry(I, num_x, num_y, geometry):
+    """
+    Compute all properties from the lattice. geometry is the tuple of **CellGeometry.kernel_args**, initialised to
+    zero (and -1 for the pixel lists).
+    """
+    for i in range(num_x):
+        for j in range(num_y):
+            if I[i, j] != 0:
+                record_pixel(geometry, i, j, I[i, j], 1)
+
+
+@jit(nopython=True)
+def get_pixel_list(next_pixel, head, s, n):
+    """
+    Flat indices of the n pixels of cell s, following its linked list.
+    """
+    pixels = np.zeros(n, dtype=np.int64)
+    p = head[s]
+    for k in range(n):
+        pixels[k] = p
+        p = next_pixel[p]
+    return pixels
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+"""
+This module defines a heat-bath update for the CPM, as an alternative to the Metropolis-Hastings update of the
+**kernels** module.
+
+**kernels.do_step** proposes the index of a single, randomly chosen Neumann neighbour, s2, which is often rejected as
+s2 == s or as the zmasks forbid the swap. Instead, the heat-bath update chooses a pixel (i,j) with at least one
+Neumann neighbour of a different index, evaluates the change in energy dH for every distinct index among the Neumann
+neighbours, and samples the new state of (i,j), including keeping its current index s, from the Boltzmann weights
+exp(-dH / T) (dH = 0 for s, and a weight of 0 for swaps forbidden by the zmasks).
+
+Every index is weighted by its multiplicity, its number of Neumann neighbours, as the neighbour copied by
+**kernels.do_step** proposes each index in proportion to its multiplicity. The odds of swapping (i,j) from s to s2,
+and back, are then those of **kernels.do_step**, m(s2) exp(-dH / T) / m(s), such that the heat-bath update relaxes
+to the same states as the Metropolis-Hastings update. It takes about as many Monte Carlo Steps to do so, but each step
+is cheaper in wall-clock time, as no draw is spent on a neighbour of the same index (see **bench_convergence** in
+benchmark.py).
+"""
+
+import numpy as np
+from numba import jit
+
+from .interface import is_interface
+from .kernels import apply_flip, get_flip
+from .rng import random
+
+
+@jit(nopython=True)
+def pick_interface_pixel(I, num_x, num_y, rng):
+    """
+    Randomly choose a pixel (i,j), until it is not a boundary pixel and has a Neumann neighbour of a different index.
+    @return: i: Chosen pixel x-component. j: Chosen pixel y-component.
+    """
+    while True:
+        i = int(random(rng) * num_x)
+        j = int(random(rng) * num_y)
+        if is_interface(I, i, j, num_x, num_y):
+            return i, j
+
+
+@jit(nopython=True)
+def heat_bath_step(I, i, j, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T, allowed, rng, candidates,
+                   multiplicities, dHs, contacts, geometry, terms_dH, terms):
+    """
+    Sample the new state of pixel (i,j) from the Boltzmann weights of its current index and of the distinct indices of
+    its Neumann neighbours, each multiplied by its number of Neumann neighbours.
+
+    @param candidates: Preallocated (4,) int array, holding the distinct indices of the Neumann neighbours.
+    @param multiplicities: Preallocated (4,) int array, holding the number of Neumann neighbours of each candidate.
+    @param dHs: Preallocated (4,) float array, holding the changes in energy of swapping to each candidate.
+    @param contacts: Tuple of the arrays of a **Contacts** object, or None.
+    @param geometry: Tuple of the arrays of a **CellGeometry** object, or None.
+    @param terms_dH, terms: The extra terms of the energy functional, or None. See the **energy** module.
+    For the remaining parameters, see **kernels.do_step**.
+    @return: dH, the change in energy (0 if the index of (i,j) was kept).
+    """
+    s = I[i, j]
+
+    # Collect the distinct indices among the Neumann neighbours, and their multiplicities.
+    n_candidates = 0
+    n_same = 0  # multiplicity of the current index.
+    for d in range(4):
+        if d == 0:
+            s2 = I[i + 1, j]
+        elif d == 1:
+            s2 = I[i - 1, j]
+        elif d == 2:
+            s2 = I[i, j + 1]
+        else:
+            s2 = I[i, j - 1]
+        if s2 == s:
+            n_same += 1
+            continue
+        new = True
+        for k in range(n_candidates):
+            if candidates[k] == s2:
+                multiplicities[k] += 1
+                new = False
+        if new:
+            candidates[n_candidates] = s2
+            multiplicities[n_candidates] = 1
+            n_candidates += 1
+
+    # Evaluate the change in energy for each candidate. Forbidden swaps are marked by infinite dH.
+    dH_min = 0. if n_same > 0 else np.inf  # the current index has dH = 0, but no weight without neighbours.
+    for k in range(n_candidates):
+        ok, dH, dA_1, dA_2, dP_1, dP_2 = get_flip(I, i, j, s, candidates[k], dP_table, A, P, lambda_A, lambda_P, A0,
+                                                  P0, adhesion, allowed, terms_dH, terms)
+        dHs[k] = dH if ok else np.inf
+        dH_min = min(dH_min, dHs[k])
+    if dH_min == np.inf:  # no state has any weight.
+        return 0.
+
+    # Sample from the weights, shifted by the lowest energy to avoid overflow.
+    w_same = n_same * np.exp(dH_min / T)
+    total = w_same
+    for k in range(n_candidates):
+        total += multiplicities[k] * np.exp(-(dHs[k] - dH_min) / T)
+    x = random(rng) * total - w_same
+    for k in range(n_candidates):
+        if x < 0:
+            break
+        w = multiplicities[k] * np.exp(-(dHs[k] - dH_min) / T)
+        if (x < w) and (w > 0):
+            s2 = candidates[k]
+            ok, dH, dA_1, dA_2, dP_1, dP_2 = get_flip(I, i, j, s, s2, dP_table, A, P, lambda_A, lambda_P, A0, P0,
+                                                      adhesion, allowed, terms_dH, terms)
+            apply_flip(I, i, j, s, s2, A, P, dA_1, dA_2, dP_1, dP_2, contacts, geometry)
+            return dH
+        x -= w
+    return 0.
+
+
+@jit(nopython=True)
+def do_steps_heat_bath(n_steps, I, num_x, num_y, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T, allowed, rng,
+                       contacts=None, geometry=None, terms_dH=None, terms=None):
+    """
+    Perform n_steps heat-bath updates. I, A and P are modified in place.
+
+    For the parameters, see **kernels.do_steps**.
+    @return: dE, the change in the total energy.
+    """
+    candidates = np.zeros(4, dtype=np.int64)
+    multiplicities = np.zeros(4, dtype=np.int64)
+    dHs = np.zeros(4)
+    dE = 0.
+    for _ in range(n_steps):
+        i, j = pick_interface_pixel(I, num_x, num_y, rng)
+        dE += heat_bath_step(I, i, j, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T, allowed, rng, candidates,
+                             multiplicities, dHs, contacts, geometry, terms_dH, terms)
+    return dE
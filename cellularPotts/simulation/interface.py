@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+"""
+This module defines an alternative way of choosing pixels for the Metropolis-Hastings algorithm, which only draws from
+the set of interface pixels.
+
+**pick_pixel** in the **kernels** module draws pixels uniformly over the whole lattice, and rejects the draw unless the
+pixel is not on the border of the lattice and a randomly chosen Neumann neighbour belongs to a different cell. In a
+tissue of compact cells almost all draws fall into the interior of cells or of the medium and are rejected.
+
+Here, the set of interface pixels (non-border pixels with at least one Neumann neighbour of a different index) is
+maintained incrementally. A pixel is drawn uniformly from this set and a Neumann neighbour is chosen as before,
+rejecting the draw if the neighbour has the same index. Conditioned on acceptance, each (pixel, neighbour) pair with
+differing indices is then proposed with the same probability as under **pick_pixel**, such that the Metropolis
+acceptance is unchanged and each step is statistically equivalent to a step of **kernels.do_step**.
+
+As for **kernels.do_steps**, a step is a proposal, i.e. a draw with differing indices, and the draws rejected for s == s2
+are not counted, such that n steps of either sampler cover the same time of n / (num_x * num_y) Monte Carlo Steps (see
+**Sample.do_mcs**).
+"""
+
+import numpy as np
+from numba import jit
+
+from .kernels import attempt_flip, get_s2
+from .rng import random
+from .stats import record_pick_rejection
+
+
+class InterfaceSet:
+    """
+    **InterfaceSet** class, holding the set of interface pixels of a sigma field.
+
+    The set is stored as a dense list of flat pixel indices (**members**, of which the first **n_members** are valid)
+    and the inverse map (**position**, -1 for pixels not in the set), allowing O(1) draws, insertions and removals.
+    """
+
+    def __init__(self, I):
+        """
+        Initialise the **InterfaceSet** class from the sigma field I.
+        @param I: The (num_x x num_y) matrix of ints. Each int is the index corresponds to a cell.
+        """
+        self.I = I  # the sigma field the set was built for.
+        num_x, num_y = I.shape
+        self.members = np.zeros(num_x * num_y, dtype=np.int64)
+        self.position = np.zeros(num_x * num_y, dtype=np.int64)
+        self.n_members = build_interface(I, num_x, num_y, self.members, self.position)
+
+    def is_stale(self, I):
+        """
+        True if the set was built for a different sigma field array, e.g. after **CPM.make_init**. Changes made to the
+        sigma field in place outside the samplers are not detected, call **Sample.reset_interface** after these.
+        """
+        return self.I is not I
+
+
+@jit(nopython=True)
+def is_interface(I, i, j, num_x, num_y):
+    """
+    True if pixel (i,j) is not on the border of the lattice, and one of its Neumann neighbours has a different index.
+    """
+    if (i == 0) or (j == 0) or (i == num_x - 1) or (j == num_y - 1):
+        return False
+    s = I[i, j]
+    return (I[i + 1, j] != s) or (I[i - 1, j] != s) or (I[i, j + 1] != s) or (I[i, j - 1] != s)
+
+
+@jit(nopython=True)
+def build_interface(I, num_x, num_y, members, position):
+    """
+    Fill **members** and **position** with the interface pixels of I.
+    @return: n_members, the number of interface pixels.
+    """
+    n_members = 0
+    for i in range(num_x):
+        for j in range(num_y):
+            p = i * num_y + j
+            if is_interface(I, i, j, num_x, num_y):
+                members[n_members] = p
+                position[p] = n_members
+                n_members += 1
+            else:
+                position[p] = -1
+    return n_members
+
+
+@jit(nopython=True)
+def update_pixel(I, i, j, num_x, num_y, members, position, n_members):
+    """
+    Insert or remove pixel (i,j) from the set according to its current neighbourhood.
+    @return: n_members, the updated number of interface pixels.
+    """
+    p = i * num_y + j
+    if is_interface(I, i, j, num_x, num_y):
+        if position[p] == -1:
+            members[n_members] = p
+            position[p] = n_members
+            n_members += 1
+    elif position[p] != -1:
+        # Move the last member into the freed slot.
+        n_members -= 1
+        last = members[n_members]
+        members[position[p]] = last
+        position[last] = position[p]
+        position[p] = -1
+    return n_members
+
+
+@jit(nopython=True)
+def update_interface(I, i, j, num_x, num_y, members, position, n_members):
+    """
+    After a swap of pixel (i,j), update the set for (i,j) and its Neumann neighbours, the only pixels whose interface
+    status can change.
+    @return: n_members, the updated number of interface pixels.
+    """
+    n_members = update_pixel(I, i, j, num_x, num_y, members, position, n_members)
+    n_members = update_pixel(I, i + 1, j, num_x, num_y, members, position, n_members)
+    n_members = update_pixel(I, i - 1, j, num_x, num_y, members, position, n_members)
+    n_members = update_pixel(I, i, j + 1, num_x, num_y, members, position, n_members)
+    n_members = update_pixel(I, i, j - 1, num_x, num_y, members, position, n_members)
+    return n_members
+
+
+@jit(nopython=True)
+def do_steps_interface(n_steps, I, num_x, num_y, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T, allowed, rng,
+                       members, position, n_members, stats=None, contacts=None, geometry=None, terms_dH=None,
+                       terms=None):
+    """
+    Perform n_steps iterations of the Metropolis-Hastings algorithm, drawing pixels from the interface set.
+    I, A and P, as well as the interface set, are modified in place.
+
+    @param members: Flat indices of interface pixels. See **InterfaceSet**.
+    @param position: Position of each pixel within **members**, -1 if not an interface pixel.
+    @param n_members: Number of interface pixels.
+    @param stats: Tuple (counts, cell_type) of a **Stats** object, or None. Draws with s == s2 count as rejections.
+    @param contacts: Tuple of the arrays of a **Contacts** object, or None.
+    @param geometry: Tuple of the arrays of a **CellGeometry** object, or None.
+    @param terms_dH, terms: The extra terms of the energy functional, or None. See the **energy** module.
+    For the remaining parameters, see **kernels.do_steps**.
+    @return: n_members, the updated number of interface pixels. n_proposals, the number of steps performed, fewer than
+    n_steps only if the lattice has no interface. dE, the change in the total energy.
+    """
+    n_proposals = 0
+    dE = 0.
+    for _ in range(n_steps):
+        if n_members == 0:  # a lattice without interfaces cannot change.
+            break
+        n_proposals += 1
+        picked = False
+        while picked is False:
+            p = members[int(random(rng) * n_members)]
+            i, j = p // num_y, p % num_y
+            s = I[i, j]
+            s2 = get_s2(I, i, j, num_x, num_y, rng)
+            if s != s2:
+                picked = True
+            elif stats is not None:
+                record_pick_rejection(stats)
+        accepted, dH = attempt_flip(I, i, j, s, s2, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T, allowed,
+                                    rng, stats, contacts, geometry, terms_dH, terms)
+        if accepted:
+            dE += dH
+            n_members = update_interface(I, i, j, num_x, num_y, members, position, n_members)
+    return n_members, n_proposals, dE
@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+
+"""
+This module defines the numba kernels of the Metropolis-Hastings algorithm: the iteration steps of the "uniform"
+sampler (**do_step**, **do_steps**), and the kernels that are shared by all samplers: the evaluation of the change in
+energy of a putative swap of a pixel from one cell index to another, the Metropolis criterion, and the swap itself.
+
+The samplers (see the **sample** module) differ only in how pixels and neighbours are chosen.
+"""
+
+import numpy as np
+from numba import jit
+
+from .contacts import record_flip
+from .geometry import record_flip_geometry
+from .rng import random
+from .stats import record_pick_rejection, record_proposal
+
+
+@jit(nopython=True)
+def do_step(I, num_x, num_y, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T, allowed, rng, stats, contacts,
+            geometry, terms_dH, terms):
+    """
+    Performs one iteration of the Metropolis-Hastings algorithm.
+
+    I, A and P are modified in place, such that the cost of an iteration is independent of the size of the lattice.
+
+    @param I: The (num_x x num_y) matrix of ints. Each int is the index corresponds to a cell. Thus each index is Moore contiguous within I.
+    @param num_x: Number of pixels in the x-dimension of I.
+    @param num_y: Number of pixels in the y-dimension of I.
+    @param dP_table: The change of perimeter given a specific type of swap. Indexed with respect to the hash of the zmask (see documentation in the **zmasks** module).
+    @param A: Vector of areas, indexed with respect to cell indices prescribed in I.
+    @param P: Vector of cell perimeters, indexed with respect to cell indices prescribed in I.
+    @param lambda_A: The coefficient for the (A-A0) term in the energy functional. Cell-wise.
+    @param lambda_P: The coefficient for the (P-P0) term in the energy functional. Cell wise.
+    @param A0: Optimal area for each cell. Cell wise.
+    @param P0: Optimal perimeter for each cell. Cell wise.
+    @param adhesion: Interfacial energies, the tuple (J_table, cell_type, override_keys, override_J) of
+    **CPM.adhesion**, with override_keys and override_J None without overrides. See **get_J**.
+    @param T: Psuedo-temperature, used in the Metropolis-Hastings algorithm.
+    @param allowed: Boolean table, indexed by hash, of the accepted local Moore neighbourhoods.
+    @param rng: Random number stream, see the **rng** module. Advanced in place.
+    @param stats: Tuple (counts, cell_type) of a **Stats** object, recording where the attempts go, or None.
+    @param contacts: Tuple of the arrays of a **Contacts** object, updated after every accepted swap, or None.
+    @param geometry: Tuple of the arrays of a **CellGeometry** object, updated after every accepted swap, or None.
+    @param terms_dH: Compiled function of the change in energy of the extra terms of the energy functional, or None.
+    @param terms: Tuple of the parameters of the extra terms, or None. See the **energy** module.
+    @return: accepted, True if the swap was accepted. dH, the change in energy of the swap (0 if rejected).
+    """
+    ##Given an existing I matrix, sample a random point, and then select the state of one of its Neumann neighbours.
+    # (i,j) is the coordinate in the I matrix of the selected pixel.
+    # s is the cell index of the chosen pixel
+    # s2 is the cell index of the chosen neighbour
+    i, j, s, s2 = pick_pixel(I, num_x, num_y, rng, stats)
+
+    return attempt_flip(I, i, j, s, s2, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T, allowed, rng, stats,
+                        contacts, geometry, terms_dH, terms)
+
+
+@jit(nopython=True)
+def do_steps(n_steps, I, num_x, num_y, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T, allowed, rng,
+             stats=None, contacts=None, geometry=None, terms_dH=None, terms=None):
+    """
+    Iterate **do_step** for n_steps. I, A and P are modified in place.
+
+    @param n_steps: Number of iteration steps.
+    @param I: The (num_x x num_y) matrix of ints. Each int is the index corresponds to a cell. Thus each index is Moore contiguous within I.
+    @param num_x: Number of pixels in the x-dimension of I.
+    @param num_y: Number of pixels in the y-dimension of I.
+    @param dP_table: The change of perimeter given a specific type of swap. Indexed with respect to the hash of the zmask (see documentation in the **zmasks** module).
+    @param A: Vector of areas, indexed with respect to cell indices prescribed in I.
+    @param P: Vector of cell perimeters, indexed with respect to cell indices prescribed in I.
+    @param lambda_A: The coefficient for the (A-A0) term in the energy functional. Cell-wise.
+    @param lambda_P: The coefficient for the (P-P0) term in the energy functional. Cell wise.
+    @param A0: Optimal area for each cell. Cell wise.
+    @param P0: Optimal perimeter for each cell. Cell wise.
+    @param adhesion: Interfacial energies, the tuple (J_table, cell_type, override_keys, override_J) of
+    **CPM.adhesion**, with override_keys and override_J None without overrides. See **get_J**.
+    @param T: Psuedo-temperature, used in the Metropolis-Hastings algorithm.
+    @param allowed: Boolean table, indexed by hash, of the accepted local Moore neighbourhoods.
+    @param rng: Random number stream, see the **rng** module. Advanced in place.
+    @param stats: Tuple (counts, cell_type) of a **Stats** object, recording where the attempts go, or None.
+    @param contacts: Tuple of the arrays of a **Contacts** object, updated after every accepted swap, or None.
+    @param geometry: Tuple of the arrays of a **CellGeometry** object, updated after every accepted swap, or None.
+    @param terms_dH: Compiled function of the change in energy of the extra terms of the energy functional, or None.
+    @param terms: Tuple of the parameters of the extra terms, or None. See the **energy** module.
+    @return: dE, the change in the total energy, i.e. the sum of dH over the accepted swaps.
+    """
+    dE = 0.
+    for i in range(n_steps):
+        accepted, dH = do_step(I, num_x, num_y, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T, allowed, rng,
+                               stats, contacts, geometry, terms_dH, terms)
+        dE += dH
+    return dE
+
+
+@jit(nopython=True)
+def pick_pixel(I, num_x, num_y, rng, stats):
+    """
+    Algorithm to choose pixels.
+
+    1. Randomly choose a pixel (i,j)
+    2. Continue if: not a boundary pixel, else return to 1.
+    3. Define the cell index of the pixel (i,j) as s
+    4. Pick one of the indices of the neighbouring pixels (Neumann). s2.
+    5. Accept if s=/=s2. Else return to 1.
+
+    @param I: The (num_x x num_y) matrix of ints. Each int is the index corresponds to a cell. Thus each index is Moore contiguous within I.
+    @param num_x: Number of pixels in the x-dimension of I.
+    @param num_y: Number of pixels in the y-dimension of I.
+    @param rng: Random number stream, see the **rng** module. Advanced in place.
+    @param stats: Tuple (counts, cell_type) of a **Stats** object, recording where the attempts go, or None.
+    @return: i: Chosen pixel x-component.
+    j: Chosen pixel y-component.
+    s: Index of the pixel in question.
+    s2: Index of the neighbouring.
+    """
+    picked = False
+    while picked is False:
+        i = int(random(rng) * num_x)
+        j = int(random(rng) * num_y)
+        if not ((i * j == 0) or (((i - num_x + 1) * (j - num_y + 1)) == 0)):
+            s = I[i, j]
+            s2 = get_s2(I, i, j, num_x, num_y, rng)
+            if s != s2:
+                picked = True
+        if (stats is not None) and not picked:
+            record_pick_rejection(stats)
+    return i, j, s, s2
+
+
+@jit(nopython=True)
+def attempt_flip(I, i, j, s, s2, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T, allowed, rng, stats,
+                 contacts, geometry, terms_dH, terms):
+    """
+    Propose to swap the state of pixel (i,j) from s to s2, and accept or reject it under the Metropolis criterion.
+
+    Shared by all samplers, which differ only in how (i,j) and s2 are chosen.
+
+    @param i: Chosen pixel x-component.
+    @param j: Chosen pixel y-component.
+    @param s: Index of the pixel in question.
+    @param s2: Index of the neighbouring pixel.
+    For the remaining parameters, see **do_step**.
+    @return: accepted, True if the swap was accepted. dH, the change in energy of the swap (0 if rejected).
+    """
+    ok, dH, dA_1, dA_2, dP_1, dP_2 = get_flip(I, i, j, s, s2, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion,
+                                              allowed, terms_dH, terms)
+    accepted = ok and metropolis(dH, T, rng)  # if both masks (Na==s) and (Na==s2) are permissible, and accepted.
+    if stats is not None:  # pruned by numba when stats are disabled.
+        forbidden_1 = (s != 0) and not allowed[get_hash(I, i, j, s)]
+        forbidden_2 = (s2 != 0) and not allowed[get_hash(I, i, j, s2)]
+        record_proposal(stats, s, s2, forbidden_1, forbidden_2, dH, accepted)
+    if accepted:
+        apply_flip(I, i, j, s, s2, A, P, dA_1, dA_2, dP_1, dP_2, contacts, geometry)
+        return True, dH
+    return False, 0.
+
+
+@jit(nopython=True)
+def get_flip(I, i, j, s, s2, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, allowed, terms_dH, terms):
+    """
+    Evaluate the swap of pixel (i,j) from state s to state s2, without performing it.
+
+    For the parameters, see **attempt_flip**.
+    @return: ok, True if both masks (Na==s) and (Na==s2) are permissible. dH, the total change in energy (only
+    calculated if ok). dA_1, dA_2, dP_1, dP_2, the changes in area and perimeter of cells s and s2.
+    """
+    # Initialise the changes in the Energy/Hamiltonian as 0.
+    dH_1, dH_2 = 0., 0.
+    dH = 0.
+
+    # Initialise the flags of permissible masks.
+    allowed_1, allowed_2 = True, True
+
+    # Initialise the contributions of the change in the energy.
+    dP_1 = 0
+    dP_2 = 0
+    dA_1 = 0
+    dA_2 = 0
+
+    # Calculate the change in energy. Calculated as two components: changes in state s and changes in state s2.
+    # The 3x3 Moore neighbourhood Na of (i,j) is read directly from I, such that no temporary arrays are allocated.
+    if s != 0:  # if the chosen pixel is not a medium cell.
+
+        # The mask Na==s generically defines the neighbourhood. Only certain masks are allowed in order to preserve
+        # local Moore contiguity and hence global Moore contiguity.
+
+        # This is achieved by hashing the mask into a 9-bit integer, which indexes the tables of acceptable masks
+        # and their changes in perimeter.
+        hash_1 = get_hash(I, i, j, s)
+        allowed_1 = allowed[hash_1]
+        if allowed_1:  # if Na==s is an acceptable mask, then calculate the changes in
+            # area and perimeter and hence the energy change.
+            dP_1 = dP_table[hash_1]
+            dA_1 = -1
+            dH_1 = get_dH(s, dP_1, dA_1, A, P, lambda_A, lambda_P, A0, P0)
+
+    if s2 != 0:  # if the chosen neighbour state is not a medium cell.
+        # Likewise with above, but instead with the swapped pixel.
+        hash_2 = get_hash(I, i, j, s2)
+        allowed_2 = allowed[hash_2]
+        if allowed_2:
+            dP_2 = dP_table[hash_2]
+            dA_2 = 1
+            dH_2 = get_dH(s2, dP_2, dA_2, A, P, lambda_A, lambda_P, A0, P0)
+
+    ok = allowed_1 and allowed_2
+    if ok:  # if both masks (Na==s) and (Na==s2) are permissible.
+        # Calculate the change in the interfacial energy term.
+        dJ = get_dJ(adhesion, s, s2, I, i, j)
+
+        # Sum together the changes in the contributions of the energy to calculate the total change in energy: dH.
+        dH = dH_1 + dH_2 + dJ
+        if terms is not None:  # pruned by numba when there are no extra terms.
+            dH += terms_dH(terms, I, i, j, s, s2)
+
+    return ok, dH, dA_1, dA_2, dP_1, dP_2
+
+
+@jit(nopython=True)
+def metropolis(dH, T, rng):
+    """
+    Metropolis criterion. Downhill swaps are always accepted, uphill swaps with probability exp(-dH / T).
+    @param dH: Change in energy of the swap.
+    @param T: Psuedo-temperature, used in the Metropolis-Hastings algorithm.
+    @param rng: Random number stream, see the **rng** module. Advanced in place.
+    @return: True if the swap is accepted.
+    """
+    if dH <= 0:  # if the change in energy is less than 0.
+        return True
+    return random(rng) < np.exp(-dH / T)  # stochastic contribution to minimisation, under M-H.
+
+
+@jit(nopython=True)
+def apply_flip(I, i, j, s, s2, A, P, dA_1, dA_2, dP_1, dP_2, contacts, geometry):
+    """
+    Swap the state of pixel (i,j) from s to s2 and update the properties of the two cells, as well as their contacts
+    and geometry if these are tracked (see the **contacts** and **geometry** modules).
+    """
+    if contacts is not None:  # pruned by numba when the contacts are not tracked.
+        record_flip(contacts, I, i, j, s, s2)
+    if geometry is not None:  # likewise.
+        record_flip_geometry(geometry, i, j, s, s2)
+    I[i, j] = s2
+    A[s] += dA_1
+    A[s2] += dA_2
+    P[s] += dP_1
+    P[s2] += dP_2
+
+
+@jit(nopython=True)
+def H(A, P, lambda_A, lambda_P, A0, P0):
+    """
+    Calculate the energy of a given cell.
+    @param A: Area of the cell.
+    @param P: Its perimeter.
+    @param lambda_A: The coefficient for the (A-A0) term in the energy functional. Cell-wise.
+    @param lambda_P: The coefficient for the (P-P0) term in the energy functional. Cell wise.
+    @param A0: Optimal area for each cell. Cell wise.
+    @param P0: Optimal perimeter for each cell. Cell wise.
+    @return: H, the energy of the cell inputted.
+    """
+    return lambda_A * (A - A0) ** 2 + lambda_P * (P - P0) ** 2
+
+
+@jit(nopython=True)
+def get_dH(s, dP, dA, A, P, lambda_A, lambda_P, A0, P0):
+    """
+    Calculate the change in energy.
+
+    @param s: Index of the pixel in question.
+    @param dP: Change in perimeter of that cell.
+    @param dA: Change in area.
+    @param A: Vector of areas, indexed with respect to cell indices prescribed in I.
+    @param P: Vector of cell perimeters, indexed with respect to cell indices prescribed in I.
+    @param lambda_A: The coefficient for the (A-A0) term in the energy functional. Cell-wise.
+    @param lambda_P: The coefficient for the (P-P0) term in the energy functional. Cell wise.
+    @param A0: Optimal area for each cell. Cell wise.
+    @param P0: Optimal perimeter for each cell. Cell wise.
+    @return:
+    """
+    dH = H(A[s] + dA, P[s] + dP, lambda_A[s], lambda_P[s], A0[s], P0[s])
+    dH -= H(A[s], P[s], lambda_A[s], lambda_P[s], A0[s], P0[s])
+    return dH
+
+
+@jit(nopython=True)
+def get_hash(I, i, j, s):
+    """
+    Hash the mask Na==s, where Na is the Moore neighbourhood of (i,j), without building the mask itself.
+
+    The mask is packed into a 9-bit integer, with bit (3 * a + b) set if Na[a, b] == s. This equals the hash defined
+    by **primes** in the **zmasks** module and indexes its lookup tables directly.
+
+    @param I: The (num_x x num_y) matrix of ints. Each int is the index corresponds to a cell. Thus each index is Moore contiguous within I.
+    @param i: Chosen pixel x-component.
+    @param j: Chosen pixel y-component.
+    @param s: Cell index defining the mask. In the code this is s or s2.
+    @return: The hash of the mask.
+    """
+    hash = 0
+    for a in range(3):
+        for b in range(3):
+            hash |= (I[i - 1 + a, j - 1 + b] == s) << (3 * a + b)
+    return hash
+
+
+@jit(nopython=True)
+def get_s2(I, i, j, num_x, num_y, rng):
+    """
+    Given a pixel in I, (i,j), randomly sample a cell index, s2, from the Neumann neighbourhood.
+    The four Neumann neighbours are enumerated as (1,0), (-1,0), (0,1) and (0,-1).
+
+    @param I: The (num_x x num_y) matrix of ints. Each int is the index corresponds to a cell. Thus each index is Moore contiguous within I.
+    @param i: Chosen pixel x-component.
+    @param j: Chosen pixel y-component.
+    @param num_x: Number of pixels in the x-dimension of I.
+    @param num_y: Number of pixels in the y-dimension of I.
+    @param rng: Random number stream, see the **rng** module. Advanced in place.
+    @return: s2, the cell index of the neighbouring pixel that is sampled randomly.
+    """
+    # Randomly choose one of the four options. This defines the shift in the x and y directions wrt. (i,j).
+    k = int(random(rng) * 4)
+    if k == 0:
+        return I[(i + 1) % num_x, j]
+    elif k == 1:
+        return I[(i - 1) % num_x, j]
+    elif k == 2:
+        return I[i, (j + 1) % num_y]
+    else:
+        return I[i, (j - 1) % num_y]
+
+
+@jit(nopython=True)
+def get_J(adhesion, a, b):
+    """
+    Interfacial energy between cell indices a and b: 0 within a cell, else the override of the pair (a, b) if any,
+    else the energy J_table[type of a, type of b] of their cell types.
+
+    @param adhesion: Tuple (J_table, cell_type, override_keys, override_J). J_table is the (n_types x n_types) array
+    of interfacial energies between cell types, cell_type the type of every cell index. override_keys is the sorted
+    array of the keys of the overridden pairs of cells (see **CPM.set_J**), override_J their interfacial energies.
+    Both are None without overrides, such that their lookup is pruned at compile time.
+    """
+    J_table, cell_type, override_keys, override_J = adhesion
+    if a == b:
+        return 0.
+    k = find_override(override_keys, a, b)
+    if k >= 0:
+        return override_J[k]
+    return J_table[cell_type[a], cell_type[b]]
+
+
+@jit(nopython=True)
+def find_override(override_keys, a, b):
+    """
+    Position of the pair of cells (a, b) in override_keys (see **get_J**), or -1 if it is not overridden.
+    """
+    if override_keys is None:
+        return -1
+    key = (np.int64(min(a, b)) << 32) + np.int64(max(a, b))
+    k = np.searchsorted(override_keys, key)
+    if (k < len(override_keys)) and (override_keys[k] == key):
+        return k
+    return -1
+
+
+@jit(nopython=True)
+def get_dJ(adhesion, s, s2, I, i, j):
+    """
+    Calculate the change in the interfacial energy, dJ.
+
+    @param adhesion: Interfacial energies, see **get_J**.
+    @param s: Index of the pixel in question.
+    @param s2: Index of the neighbouring pixel.
+    @param I: The (num_x x num_y) matrix of ints. Each int is the index corresponds to a cell. Thus each index is Moore contiguous within I.
+    @param i: Chosen pixel x-component.
+    @param j: Chosen pixel y-component.
+    @return:
+    """
+    J_table, cell_type, override_keys, override_J = adhesion
+    # Sum over the neighbours of the rows of the types of s2 and s, corrected for the neighbours within s2 and s.
+    J_2, J_1 = J_table[cell_type[s2]], J_table[cell_type[s]]
+    dJ = 0.
+    n_2, n_1 = 0, 0
+    for a in range(-1, 2):
+        for b in range(-1, 2):
+            if (a != 0) or (b != 0):
+                n = I[i + a, j + b]
+                c = cell_type[n]
+                dJ += J_2[c] - J_1[c]
+                n_2 += n == s2
+                n_1 += n == s
+    dJ += n_1 * J_1[cell_type[s]] - n_2 * J_2[cell_type[s2]]
+    return dJ + get_dJ_overrides(override_keys, adhesion, s, s2, I, i, j)
+
+
+@jit(nopython=True)
+def get_dJ_overrides(override_keys, adhesion, s, s2, I, i, j):
+    """
+    Correction of the change in the interfacial energy computed from the cell types (see **get_dJ**) for the
+    overridden pairs of cells among s, s2 and the Moore neighbours of (i,j). 0 without overrides.
+    """
+    if override_keys is None:
+        return 0.
+    J_table, cell_type = adhesion[0], adhesion[1]
+    dJ = 0.
+    for a in range(-1, 2):
+        for b in range(-1, 2):
+            if (a != 0) or (b != 0):
+                n = I[i + a, j + b]
+                if n != s2:
+                    dJ += get_J(adhesion, s2, n) - J_table[cell_type[s2], cell_type[n]]
+                if n != s:
+                    dJ -= get_J(adhesion, s, n) - J_table[cell_type[s], cell_type[n]]
+    return dJ
@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+
+"""
+This module defines a rejection-free kinetic Monte Carlo sampler (the n-fold way of Bortz, Kalos and Lebowitz), for
+runs at low temperature, where almost all swaps proposed by **kernels.do_step** are rejected.
+
+Each step of **kernels.do_step** proposes one of the n_pairs (pixel, Neumann neighbour) pairs with differing indices,
+uniformly, and accepts it with probability r = min(1, exp(-dH / T)) (0 if the zmasks forbid it). Instead, the rate r
+of every pair is stored, summed per pixel in a sum tree, and the next accepted swap is drawn directly, with
+probability r / R, where R is the total rate. The number of steps that **kernels.do_step** would have needed to reach
+this swap is geometrically distributed with success probability R / n_pairs, and is used to advance the clock. The
+sampler is hence statistically equivalent to **kernels.do_steps**, for the same number of steps.
+
+A swap of pixel (i,j) from cell s to s2 changes the rates of the pixels in the Moore neighbourhood of (i,j), whose
+zmasks and interfacial energies depend on it, and of all pairs that involve s or s2, through their areas and
+perimeters. The latter are found via per-cell lists of boundary pixels, such that an update costs O(perimeter). The
+lists include the pixels on the border of the lattice, which never swap themselves, such that the rates of their
+neighbours are refreshed as well when the cell changes.
+
+@article{bortz1975new,
+  title={A new algorithm for Monte Carlo simulation of Ising spin systems},
+  author={Bortz, Alfred B and Kalos, Malvin H and Lebowitz, Joel L},
+  journal={Journal of Computational Physics},
+  volume={17},
+  number={1},
+  pages={10--18},
+  year={1975},
+  publisher={Elsevier}
+}
+"""
+
+import numpy as np
+from numba import jit
+
+from .kernels import apply_flip, get_flip
+from .rng import random
+
+
+class KMCState:
+    """
+    **KMCState** class, holding the rates of all candidate swaps of a CPM object.
+
+    - rates: (num_x * num_y, 4) array of the rates of swapping each pixel to the index of each of its Neumann neighbours.
+    - tree: sum tree over the per-pixel total rates. Leaves start at index **n_leaves**, tree[1] is the total rate.
+    - n_pairs: number of (pixel, Neumann neighbour) pairs with differing indices for each pixel, and its total.
+    - owner, next_pixel, prev_pixel, head: per-cell doubly linked lists of boundary pixels (see **is_boundary**).
+    """
+
+    def __init__(self, cpm, zmasks, T, terms_dH=None, terms=None):
+        """
+        Initialise the **KMCState** class, computing all rates from the current state of the CPM object.
+        @param cpm: a CPM object.
+        @param zmasks: a **Zmasks** object.
+        @param T: Psuedo-temperature, used in the Metropolis-Hastings algorithm.
+        @param terms_dH, terms: The extra terms of the energy functional, or None. See the **energy** module.
+        """
+        num_x, num_y = cpm.num_x, cpm.num_y
+        n = num_x * num_y
+        self.n_leaves = 1 << int(np.ceil(np.log2(n)))
+        self.rates = np.zeros((n, 4))
+        self.tree = np.zeros(2 * self.n_leaves)
+        self.n_pairs = np.zeros(n + 1, dtype=np.int64)  # the last entry holds the total.
+        self.owner = -np.ones(n, dtype=np.int64)
+        self.next_pixel = -np.ones(n, dtype=np.int64)
+        self.prev_pixel = -np.ones(n, dtype=np.int64)
+        self.head = -np.ones(len(cpm.A), dtype=np.int64)
+        build_rates(cpm.sigma_field, num_x, num_y, zmasks.dP_table, cpm.A, cpm.P, cpm.lambda_A, cpm.lambda_P, cpm.A0,
+                    cpm.P0, cpm.adhesion, T, zmasks.allowed, terms_dH, terms, self.rates, self.tree, self.n_leaves,
+                    self.n_pairs, self.owner, self.next_pixel, self.prev_pixel, self.head)
+        self.n_events = 0  # number of swaps performed.
+        self.adopt(cpm, T, terms_dH)
+
+    @staticmethod
+    def get_params(cpm):
+        """
+        (4 x capacity) array of the per-cell parameters the rates depend on: lambda_A, lambda_P, A0 and P0.
+        """
+        return np.stack((cpm.lambda_A, cpm.lambda_P, cpm.A0, cpm.P0))
+
+    def adopt(self, cpm, T, terms_dH):
+        """
+        Record the arrays and the energy functional of the CPM object as those the rates were computed for.
+        """
+        self.I, self.A, self.P, self.adhesion = cpm.sigma_field, cpm.A, cpm.P, cpm.adhesion
+        self.T, self.terms_dH = T, terms_dH
+        self.params = self.get_params(cpm)
+
+    def is_stale(self, cpm, T, terms_dH=None):
+        """
+        True if the CPM object has been changed outside of the rejection-free sampler, e.g. by **CPM.initialize**,
+        which temporarily modifies the adhesion and perimeter terms. The parameters of cells without pixels, which no
+        rate depends on, are not compared. In-place changes of the sigma field outside the samplers, and changes of
+        the parameters of the extra terms, are not detected, call **Sample.reset_kmc** after these.
+        """
+        if not ((cpm.sigma_field is self.I) and (cpm.A is self.A) and (cpm.P is self.P)
+                and (cpm.adhesion is self.adhesion) and (T == self.T) and (terms_dH is self.terms_dH)):
+            return True
+        params = self.get_params(cpm)
+        if params.shape != self.params.shape:
+            return True
+        occupied = cpm.A > 0
+        return not np.array_equal(params[:, occupied], self.params[:, occupied])
+
+    def update(self, cpm, pixels, cells, zmasks, T, terms_dH=None, terms=None):
+        """
+        Update the rates in place after pixels were assigned to a cell outside of the sampler (see
+        **Sample.assign_pixels**), in O(number of pixels + perimeters of the cells), rather than rebuilding them.
+        @param pixels: (n x 2) int array of the (x, y) coordinates of the pixels, none on the border of the lattice.
+        @param cells: int array of the indices of the cells that lost or gained pixels.
+        """
+        update_pixels(pixels, cells, cpm.sigma_field, cpm.num_x, cpm.num_y, zmasks.dP_table, cpm.A, cpm.P,
+                      cpm.lambda_A, cpm.lambda_P, cpm.A0, cpm.P0, cpm.adhesion, T, zmasks.allowed, terms_dH, terms,
+                      self.rates, self.tree, self.n_leaves, self.n_pairs, self.owner, self.next_pixel,
+                      self.prev_pixel, self.head)
+        self.params[:, cells] = self.get_params(cpm)[:, cells]
+
+    def resize(self, cpm, T, terms_dH=None):
+        """
+        Follow the growth of the per-cell arrays of the CPM object (see **CPM.grow**), which copies them, and may
+        convert the sigma field to a wider integer type (see **CPM.fit_sigma_dtype**): if the copies hold the values the
+        rates were computed for, enlarge the lists of boundary pixels and adopt the copies, without rebuilding. Costs
+        O(lattice) only if the sigma field was converted, i.e. at most once per doubling of the number of cells.
+        """
+        n = len(self.head)
+        same_I = (cpm.sigma_field is self.I) or ((cpm.sigma_field.dtype != self.I.dtype)
+                                                 and np.array_equal(cpm.sigma_field, self.I))
+        same_adhesion = all((x is y) or ((x is not None) and (y is not None) and np.array_equal(x[:len(y)], y))
+                            for x, y in zip(cpm.adhesion, self.adhesion))
+        if not (same_I and same_adhesion and (T == self.T) and (terms_dH is self.terms_dH)
+                and np.array_equal(cpm.A[:n], self.A) and np.array_equal(cpm.P[:n], self.P)
+                and np.array_equal(self.get_params(cpm)[:, :n], self.params)):
+            return  # stale, rebuilt on the next call of the sampler.
+        self.head = np.concatenate((self.head, -np.ones(len(cpm.A) - n, dtype=np.int64)))
+        self.adopt(cpm, T, terms_dH)
+
+
+@jit(nopython=True)
+def pixel_rates(I, i, j, num_x, num_y, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T, allowed, terms_dH,
+                terms, rates):
+    """
+    Compute the rates of swapping pixel (i,j) to the index of each of its four Neumann neighbours, enumerated as in
+    **kernels.get_s2**.
+    @return: total, the summed rate. n_pairs, the number of neighbours with a different index.
+    """
+    p = i * num_y + j
+    total = 0.
+    n_pairs = 0
+    for d in range(4):
+        rates[p, d] = 0.
+    if (i == 0) or (j == 0) or (i == num_x - 1) or (j == num_y - 1):
+        return total, n_pairs
+    s = I[i, j]
+    for d in range(4):
+        if d == 0:
+            s2 = I[i + 1, j]
+        elif d == 1:
+            s2 = I[i - 1, j]
+        elif d == 2:
+            s2 = I[i, j + 1]
+        else:
+            s2 = I[i, j - 1]
+        if s2 == s:
+            continue
+        n_pairs += 1
+        r = -1.
+        for d2 in range(d):  # re-use the rate of a previous neighbour with the same index.
+            if ((d2 == 0) and (I[i + 1, j] == s2)) or ((d2 == 1) and (I[i - 1, j] == s2)) or \
+                    ((d2 == 2) and (I[i, j + 1] == s2)):
+                r = rates[p, d2]
+                break
+        if r < 0:
+            ok, dH, dA_1, dA_2, dP_1, dP_2 = get_flip(I, i, j, s, s2, dP_table, A, P, lambda_A, lambda_P, A0, P0,
+                                                      adhesion, allowed, terms_dH, terms)
+            if not ok:
+                r = 0.
+            elif dH <= 0:
+                r = 1.
+            else:
+                r = np.exp(-dH / T)
+        rates[p, d] = r
+        total += r
+    return total, n_pairs
+
+
+@jit(nopython=True)
+def set_leaf(tree, n_leaves, p, value):
+    """
+    Set the rate of pixel p in the sum tree, and update its ancestors.
+    """
+    k = n_leaves + p
+    tree[k] = value
+    k //= 2
+    while k >= 1:
+        tree[k] = tree[2 * k] + tree[2 * k + 1]
+        k //= 2
+
+
+@jit(nopython=True)
+def find_leaf(tree, n_leaves, x):
+    """
+    Descend the sum tree to find the pixel p at which the cumulative rate exceeds x.
+    """
+    k = 1
+    while k < n_leaves:
+        if (x < tree[2 * k]) or (tree[2 * k + 1] <= 0):
+            k = 2 * k
+        else:
+            x -= tree[2 * k]
+            k = 2 * k + 1
+    return k - n_leaves
+
+
+@jit(nopython=True)
+def update_rate(I, i, j, num_x, num_y, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T, allowed, terms_dH,
+                terms, rates, tree, n_leaves, n_pairs):
+    """
+    Recompute the rates of pixel (i,j) and update the sum tree and the number of pairs.
+    """
+    p = i * num_y + j
+    total, n = pixel_rates(I, i, j, num_x, num_y, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T, allowed,
+                           terms_dH, terms, rates)
+    set_leaf(tree, n_leaves, p, total)
+    n_pairs[-1] += n - n_pairs[p]
+    n_pairs[p] = n
+
+
+@jit(nopython=True)
+def is_boundary(I, i, j, num_x, num_y):
+    """
+    True if one of the Neumann neighbours of pixel (i,j) within the lattice has a different index. Unlike
+    **interface.is_interface**, includes the pixels on the border of the lattice.
+    """
+    s = I[i, j]
+    return (((i + 1 < num_x) and (I[i + 1, j] != s)) or ((i > 0) and (I[i - 1, j] != s))
+            or ((j + 1 < num_y) and (I[i, j + 1] != s)) or ((j > 0) and (I[i, j - 1] != s)))
+
+
+@jit(nopython=True)
+def update_owner(I, i, j, num_x, num_y, owner, next_pixel, prev_pixel, head):
+    """
+    Move pixel (i,j) to the list of boundary pixels of its cell, or remove it from all lists if it is not a boundary
+    pixel.
+    """
+    p = i * num_y + j
+    c = I[i, j] if is_boundary(I, i, j, num_x, num_y) else -1
+    if owner[p] == c:
+        return
+    if owner[p] != -1:  # unlink from the current list.
+        if prev_pixel[p] != -1:
+            next_pixel[prev_pixel[p]] = next_pixel[p]
+        else:
+            head[owner[p]] = next_pixel[p]
+        if next_pixel[p] != -1:
+            prev_pixel[next_pixel[p]] = prev_pixel[p]
+    owner[p] = c
+    prev_pixel[p] = -1
+    next_pixel[p] = -1
+    if c != -1:  # link at the head of the new list.
+        next_pixel[p] = head[c]
+        if head[c] != -1:
+            prev_pixel[head[c]] = p
+        head[c] = p
+
+
+@jit(nopython=True)
+def build_rates(I, num_x, num_y, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T, allowed, terms_dH, terms,
+                rates, tree, n_leaves, n_pairs, owner, next_pixel, prev_pixel, head):
+    """
+    Compute the rates of all pixels and the lists of boundary pixels from scratch.
+    """
+    for i in range(num_x):
+        for j in range(num_y):
+            update_owner(I, i, j, num_x, num_y, owner, next_pixel, prev_pixel, head)
+            p = i * num_y + j
+            tree[n_leaves + p], n_pairs[p] = pixel_rates(I, i, j, num_x, num_y, dP_table, A, P, lambda_A, lambda_P,
+                                                         A0, P0, adhesion, T, allowed, terms_dH, terms, rates)
+    n_pairs[-1] = np.sum(n_pairs[:-1])
+    for k in range(n_leaves - 1, 0, -1):
+        tree[k] = tree[2 * k] + tree[2 * k + 1]
+
+
+@jit(nopython=True)
+def update_cell_rates(c, I, num_x, num_y, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T, allowed, terms_dH,
+                      terms, rates, tree, n_leaves, n_pairs, next_pixel, head):
+    """
+    Recompute the rates of all pairs that involve cell c: its boundary pixels, and their Neumann neighbours.
+    """
+    p = head[c]
+    while p != -1:
+        i, j = p // num_y, p % num_y
+        update_rate(I, i, j, num_x, num_y, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T, allowed, terms_dH,
+                    terms, rates, tree, n_leaves, n_pairs)
+        for a, b in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+            if (0 <= i + a < num_x) and (0 <= j + b < num_y) and (I[i + a, j + b] != c):
+                update_rate(I, i + a, j + b, num_x, num_y, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T,
+                            allowed, terms_dH, terms, rates, tree, n_leaves, n_pairs)
+        p = next_pixel[p]
+
+
+@jit(nopython=True)
+def update_pixels(pixels, cells, I, num_x, num_y, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T, allowed,
+                  terms_dH, terms, rates, tree, n_leaves, n_pairs, owner, next_pixel, prev_pixel, head):
+    """
+    Update the lists of boundary pixels and the rates after the given pixels were swapped, then the rates of all pairs
+    that involve the given cells (the medium excluded). See **KMCState.update**.
+    """
+    for k in range(len(pixels)):
+        for a in range(-1, 2):
+            for b in range(-1, 2):
+                update_owner(I, pixels[k, 0] + a, pixels[k, 1] + b, num_x, num_y, owner, next_pixel, prev_pixel, head)
+    for k in range(len(pixels)):
+        for a in range(-1, 2):
+            for b in range(-1, 2):
+                update_rate(I, pixels[k, 0] + a, pixels[k, 1] + b, num_x, num_y, dP_table, A, P, lambda_A, lambda_P,
+                            A0, P0, adhesion, T, allowed, terms_dH, terms, rates, tree, n_leaves, n_pairs)
+    for c in cells:
+        if c != 0:
+            update_cell_rates(c, I, num_x, num_y, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T, allowed,
+                              terms_dH, terms, rates, tree, n_leaves, n_pairs, next_pixel, head)
+
+
+@jit(nopython=True)
+def do_steps_kmc(n_steps, I, num_x, num_y, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T, allowed, rng, rates,
+                 tree, n_leaves, n_pairs, owner, next_pixel, prev_pixel, head, contacts=None, geometry=None,
+                 terms_dH=None, terms=None):
+    """
+    Advance the CPM by the equivalent of n_steps iterations of **kernels.do_step**, performing only accepted swaps.
+    I, A and P, as well as the rates, are modified in place.
+
+    As the waiting time between accepted swaps is memoryless, the waiting time that overshoots n_steps is discarded.
+
+    For the parameters, see **kernels.do_steps** and **KMCState**.
+    @return: n_events, the number of swaps performed. dE, the change in the total energy.
+    """
+    t = 0.
+    n_events = 0
+    dE = 0.
+    while True:
+        R = tree[1]
+        if (R <= 0) or (n_pairs[-1] == 0):  # no swap can ever be accepted.
+            break
+        p_accept = R / n_pairs[-1]
+        if p_accept >= 1:
+            k = 1.
+        else:
+            k = 1. + np.floor(np.log(1. - random(rng)) / np.log(1. - p_accept))
+        t += k
+        if t > n_steps:
+            break
+
+        # Choose the pixel, then the neighbour, in proportion to their rates.
+        p = find_leaf(tree, n_leaves, random(rng) * R)
+        i, j = p // num_y, p % num_y
+        x = random(rng) * tree[n_leaves + p]
+        d = -1
+        for d2 in range(4):
+            if rates[p, d2] > 0:
+                d = d2
+                if x < rates[p, d2]:
+                    break
+                x -= rates[p, d2]
+        if d == -1:  # only reached through rounding of the sum tree; refresh the pixel and draw again.
+            update_rate(I, i, j, num_x, num_y, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T, allowed,
+                        terms_dH, terms, rates, tree, n_leaves, n_pairs)
+            continue
+        if d == 0:
+            s2 = I[i + 1, j]
+        elif d == 1:
+            s2 = I[i - 1, j]
+        elif d == 2:
+            s2 = I[i, j + 1]
+        else:
+            s2 = I[i, j - 1]
+        s = I[i, j]
+
+        ok, dH, dA_1, dA_2, dP_1, dP_2 = get_flip(I, i, j, s, s2, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion,
+                                                  allowed, terms_dH, terms)
+        if not ok:  # only reached through rounding of the sum tree.
+            continue
+        apply_flip(I, i, j, s, s2, A, P, dA_1, dA_2, dP_1, dP_2, contacts, geometry)
+        n_events += 1
+        dE += dH
+
+        # Update the lists of boundary pixels, then the rates.
+        update_owner(I, i, j, num_x, num_y, owner, next_pixel, prev_pixel, head)
+        for a, b in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+            update_owner(I, i + a, j + b, num_x, num_y, owner, next_pixel, prev_pixel, head)
+        for a in range(-1, 2):
+            for b in range(-1, 2):
+                update_rate(I, i + a, j + b, num_x, num_y, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T,
+                            allowed, terms_dH, terms, rates, tree, n_leaves, n_pairs)
+        if s != 0:
+            update_cell_rates(s, I, num_x, num_y, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T, allowed,
+                              terms_dH, terms, rates, tree, n_leaves, n_pairs, next_pixel, head)
+        if s2 != 0:
+            update_cell_rates(s2, I, num_x, num_y, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T, allowed,
+                              terms_dH, terms, rates, tree, n_leaves, n_pairs, next_pixel, head)
+    return n_events, dE
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+"""
+This module defines a multi-core version of the Metropolis-Hastings algorithm, based on a checkerboard decomposition of
+the lattice into tiles.
+
+The lattice is split into square tiles of side L, coloured like a 2x2 checkerboard. The tiles of one colour are
+updated concurrently (with **numba.prange**), each by a serial sequence of **kernels.attempt_flip** calls within the
+tile, and the four colours are updated one after the other. Tiles of the same colour are separated by at least one
+tile of another colour, such that:
+- their 3x3 Moore neighbourhoods never overlap, so zmask contiguity checks and interfacial energies read a consistent
+lattice;
+- provided no cell extends over more than L - 2 pixels, no cell is touched by two concurrent tiles, so the areas and
+perimeters A and P can be updated directly, without races. L is therefore enlarged automatically to twice the largest
+cell extent (plus a margin) at the start of every sweep. The extent is read from the bounding boxes of the
+**CellGeometry** if it is tracked, tightening only the boxes that would set it, else from a concurrent scan of the
+lattice. The number of tiles per colour, and thus the number of cores that can be used, is then at most about
+(lattice side / (4 x largest cell extent))^2: a single large or elongated cell limits the parallelism of the whole
+lattice.
+
+As a sweep also counts the pairs of every tile, its setup costs O(lattice). Sweeps too short to amortise it, e.g.
+the single steps of the GUI, are performed serially by **kernels.do_steps** instead, with the same dynamics.
+
+A sweep of n steps distributes the steps over the tiles in proportion to their number of (pixel, Neumann neighbour)
+pairs with differing indices, as would the uniform choice of pairs in **kernels.pick_pixel**. The tile grid is shifted
+randomly and the colours are visited in random order every sweep, to avoid artefacts at tile boundaries. Up to the
+order of updates, the dynamics thus follow **kernels.do_steps**.
+
+Every tile draws from its own random number stream, derived from the stream of the sweep (see **rng.spawn**), such
+that threads never share random state and the result of a sweep does not depend on the number of threads.
+
+The number of threads is set by numba, e.g. with the environment variable NUMBA_NUM_THREADS or with
+numba.set_num_threads.
+"""
+
+import numpy as np
+from numba import jit, prange
+
+from .kernels import attempt_flip, do_steps, get_s2
+from .rng import permutation, random, spawn
+
+MIN_SWEEP = 16  # sweeps of fewer than num_x * num_y / MIN_SWEEP steps are performed serially.
+
+
+@jit(nopython=True, parallel=True)
+def max_cell_extent(I, num_x, num_y, boxes):
+    """
+    Largest extent, in x or y, of the bounding box of any cell (medium excluded).
+    The lattice is scanned concurrently in blocks of rows, one per entry of **boxes**, each recording the bounding
+    boxes of the cells within its rows, which are then merged.
+    @param boxes: Preallocated (n_blocks x capacity x 4) int array, overwritten with the bounding boxes
+    [x_min, x_max, y_min, y_max] of every cell within every block.
+    """
+    n_blocks, n = boxes.shape[0], boxes.shape[1]
+    rows = -(-num_x // n_blocks)
+    for b in prange(n_blocks):
+        box = boxes[b]
+        for s in range(n):
+            box[s, 0], box[s, 1], box[s, 2], box[s, 3] = num_x, -1, num_y, -1
+        for i in range(b * rows, min((b + 1) * rows, num_x)):
+            for j in range(num_y):
+                s = I[i, j]
+                box[s, 0], box[s, 1] = min(box[s, 0], i), max(box[s, 1], i)
+                box[s, 2], box[s, 3] = min(box[s, 2], j), max(box[s, 3], j)
+    extent = 0
+    for s in range(1, n):
+        x_min, x_max, y_min, y_max = num_x, -1, num_y, -1
+        for b in range(n_blocks):
+            x_min, x_max = min(x_min, boxes[b, s, 0]), max(x_max, boxes[b, s, 1])
+            y_min, y_max = min(y_min, boxes[b, s, 2]), max(y_max, boxes[b, s, 3])
+        if x_max >= 0:
+            extent = max(extent, x_max - x_min + 1, y_max - y_min + 1)
+    return extent
+
+
+@jit(nopython=True)
+def geometry_extent(I, moments, box):
+    """
+    Largest extent, in x or y, of any cell (medium excluded), from the bounding boxes of a **CellGeometry**, which
+    contain their cells but may be loose. The box of the cell with the largest extent is tightened by scanning it,
+    until that box is tight, such that only the boxes of the largest cells are scanned.
+    @param moments, box: The arrays of a **CellGeometry** object.
+    """
+    tight = np.zeros(len(box), dtype=np.bool_)
+    while True:
+        extent, c = 0, -1
+        for s in range(1, len(box)):
+            if moments[s, 0] > 0:
+                e = max(box[s, 1] - box[s, 0] + 1, box[s, 3] - box[s, 2] + 1)
+                if e > extent:
+                    extent, c = e, s
+        if (c == -1) or tight[c]:
+            return extent
+        x_min, x_max, y_min, y_max = box[c, 1], box[c, 0], box[c, 3], box[c, 2]
+        for i in range(box[c, 0], box[c, 1] + 1):
+            for j in range(box[c, 2], box[c, 3] + 1):
+                if I[i, j] == c:
+                    x_min, x_max = min(x_min, i), max(x_max, i)
+                    y_min, y_max = min(y_min, j), max(y_max, j)
+        box[c, 0], box[c, 1], box[c, 2], box[c, 3] = x_min, x_max, y_min, y_max
+        tight[c] = True
+
+
+@jit(nopython=True)
+def tile_bounds(t, n_ty, L, ox, oy, num_x, num_y):
+    """
+    Pixel bounds [x0, x1) x [y0, y1) of tile t, with the tile grid shifted by (ox, oy).
+    """
+    tx, ty = t // n_ty, t % n_ty
+    x0, y0 = max(tx * L - ox, 0), max(ty * L - oy, 0)
+    x1, y1 = min((tx + 1) * L - ox, num_x), min((ty + 1) * L - oy, num_y)
+    return x0, x1, y0, y1
+
+
+@jit(nopython=True, parallel=True)
+def count_tile_pairs(I, num_x, num_y, L, ox, oy, n_tx, n_ty, pairs):
+    """
+    Count, for every tile, the non-border pixel and Neumann neighbour pairs with differing indices.
+    """
+    for t in prange(n_tx * n_ty):
+        x0, x1, y0, y1 = tile_bounds(t, n_ty, L, ox, oy, num_x, num_y)
+        n = 0
+        for i in range(max(x0, 1), min(x1, num_x - 1)):
+            for j in range(max(y0, 1), min(y1, num_y - 1)):
+                s = I[i, j]
+                n += (I[i + 1, j] != s) + (I[i - 1, j] != s) + (I[i, j + 1] != s) + (I[i, j - 1] != s)
+        pairs[t] = n
+
+
+@jit(nopython=True)
+def do_tile_steps(n_steps, x0, x1, y0, y1, I, num_x, num_y, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T,
+                  allowed, rng, geometry, terms_dH, terms):
+    """
+    Perform n_steps iterations of the Metropolis-Hastings algorithm with pixels drawn in the tile [x0, x1) x [y0, y1).
+    Like **kernels.pick_pixel**, draws of border pixels and of neighbours with the same index are rejected. Gives up
+    if no valid pair is found after many draws, i.e. if the tile lost all of its interfaces during the sweep.
+    The geometry of the cells (see **kernels.do_steps**) is updated safely, as no cell is touched by two tiles.
+    @return: dE, the change in the total energy.
+    """
+    max_draws = 100 * (x1 - x0) * (y1 - y0)
+    dE = 0.
+    for _ in range(n_steps):
+        picked = False
+        n_draws = 0
+        while (picked is False) and (n_draws < max_draws):
+            n_draws += 1
+            i = x0 + int(random(rng) * (x1 - x0))
+            j = y0 + int(random(rng) * (y1 - y0))
+            if not ((i * j == 0) or (((i - num_x + 1) * (j - num_y + 1)) == 0)):
+                s = I[i, j]
+                s2 = get_s2(I, i, j, num_x, num_y, rng)
+                if s != s2:
+                    picked = True
+        if not picked:
+            break
+        accepted, dH = attempt_flip(I, i, j, s, s2, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T, allowed,
+                                    rng, None, None, geometry, terms_dH, terms)
+        dE += dH
+    return dE
+
+
+@jit(nopython=True, parallel=True)
+def do_phase(colour, steps, n_tx, n_ty, L, ox, oy, I, num_x, num_y, dP_table, A, P, lambda_A, lambda_P, A0, P0,
+             adhesion, T, allowed, rngs, dE, geometry, terms_dH, terms):
+    """
+    Concurrently update all tiles of a colour (0 to 3), tile t performing steps[t] iterations with the random number
+    stream rngs[t], and adding its change in energy to dE[t].
+    """
+    cx, cy = colour // 2, colour % 2
+    n_cx, n_cy = (n_tx - cx + 1) // 2, (n_ty - cy + 1) // 2
+    for k in prange(n_cx * n_cy):
+        t = (cx + 2 * (k // n_cy)) * n_ty + cy + 2 * (k % n_cy)
+        if steps[t] > 0:
+            x0, x1, y0, y1 = tile_bounds(t, n_ty, L, ox, oy, num_x, num_y)
+            dE[t] += do_tile_steps(steps[t], x0, x1, y0, y1, I, num_x, num_y, dP_table, A, P, lambda_A, lambda_P, A0,
+                                   P0, adhesion, T, allowed, rngs[t], geometry, terms_dH, terms)
+
+
+@jit(nopython=True)
+def do_steps_checkerboard(n_steps, I, num_x, num_y, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T, allowed,
+                          rng, tile_size, boxes, geometry=None, terms_dH=None, terms=None):
+    """
+    Perform n_steps iterations of the Metropolis-Hastings algorithm, in sweeps of at most num_x * num_y steps, with the
+    tiles of each colour updated in parallel. I, A and P are modified in place.
+
+    @param tile_size: Minimal side of the tiles. Enlarged to 2 * (largest cell extent) + 3 if needed.
+    @param boxes: Preallocated (n_blocks x capacity x 4) int array, see **max_cell_extent**. Unused if the geometry is
+    tracked.
+    @param geometry: Tuple of the arrays of a **CellGeometry** object, or None.
+    @param terms_dH, terms: The extra terms of the energy functional, or None. See the **energy** module.
+    For the remaining parameters, see **kernels.do_steps**.
+    @return: dE, the change in the total energy.
+    """
+    dE = 0.
+    remaining = n_steps
+    while remaining > 0:
+        n_sweep = min(remaining, num_x * num_y)
+        remaining -= n_sweep
+        if n_sweep < num_x * num_y // MIN_SWEEP:
+            dE += do_steps(n_sweep, I, num_x, num_y, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T, allowed,
+                           rng, None, None, geometry, terms_dH, terms)
+            continue
+
+        if geometry is not None:
+            extent = geometry_extent(I, geometry[0], geometry[1])
+        else:
+            extent = max_cell_extent(I, num_x, num_y, boxes)
+        L = max(tile_size, 2 * extent + 3)
+        ox, oy = int(random(rng) * L), int(random(rng) * L)
+        n_tx, n_ty = (num_x + ox) // L + 1, (num_y + oy) // L + 1
+
+        # Distribute the steps over the tiles, in proportion to their number of pairs (with stochastic rounding).
+        pairs = np.zeros(n_tx * n_ty, dtype=np.int64)
+        count_tile_pairs(I, num_x, num_y, L, ox, oy, n_tx, n_ty, pairs)
+        total = pairs.sum()
+        if total == 0:
+            break
+        steps = np.zeros(n_tx * n_ty, dtype=np.int64)
+        for t in range(n_tx * n_ty):
+            x = n_sweep * pairs[t] / total
+            steps[t] = int(x) + (random(rng) < x - int(x))
+
+        tile_dE = np.zeros(n_tx * n_ty)
+        for colour in permutation(rng, 4):
+            rngs = spawn(rng, n_tx * n_ty)
+            do_phase(colour, steps, n_tx, n_ty, L, ox, oy, I, num_x, num_y, dP_table, A, P, lambda_A, lambda_P, A0,
+                     P0, adhesion, T, allowed, rngs, tile_dE, geometry, terms_dH, terms)
+        dE += tile_dE.sum()
+    return dE
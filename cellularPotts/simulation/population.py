@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+"""
+This module defines the kernels that change the population of cells during a run: the division of a cell, and the
+assignment of a set of pixels to a cell, used to seed new cells and to remove cells (by assigning their pixels to the
+medium). See **CPM.add_cell**, **CPM.divide_cell** and **CPM.remove_cell**.
+
+Pixels are reassigned one at a time, as forced swaps: each swap updates the areas and perimeters of the two cells,
+their contacts and geometry if these are tracked (see **kernels.apply_flip**), and its change in energy is evaluated
+before it is performed, exactly as for a swap of the samplers, such that the tracked total energy stays exact. Unlike
+the swaps of the samplers, forced swaps are not restricted by the zmasks. The cost of an event is thus O(size of the
+cell), independent of the size of the lattice and of the number of cells.
+
+The per-cell arrays of the CPM object are allocated with a spare capacity, which is doubled when exhausted, and the
+indices of removed cells are recycled, such that adding a cell costs amortised O(1) reallocations.
+"""
+
+import numpy as np
+from numba import jit
+
+from .interface import update_interface
+from .kernels import apply_flip, get_dH, get_dJ
+
+
+@jit(nopython=True)
+def get_dP(I, i, j, s, sign):
+    """
+    Change in the perimeter of cell s when pixel (i,j) is added to (sign = 1) or removed from (sign = -1) it, for any
+    Moore neighbourhood. The perimeter counts the pairs of Moore neighbours with one pixel in the cell.
+    """
+    m = 0
+    for a in range(-1, 2):
+        for b in range(-1, 2):
+            if ((a != 0) or (b != 0)) and (I[i + a, j + b] == s):
+                m += 1
+    return sign * (8 - 2 * m)
+
+
+@jit(nopython=True)
+def force_flips(pixels, s2, I, A, P, lambda_A, lambda_P, A0, P0, adhesion, contacts=None, geometry=None,
+                terms_dH=None, terms=None):
+    """
+    Swap the pixels, in order, to cell index s2, regardless of the zmasks. I, A and P are modified in place.
+
+    @param pixels: (n x 2) int array of the (x, y) coordinates of the pixels. None may lie on the border of the lattice.
+    @param s2: Index of the cell gaining the pixels.
+    For the remaining parameters, see **kernels.do_steps**.
+    @return: dE, the change in the total energy.
+    """
+    dE = 0.
+    for k in range(len(pixels)):
+        i, j = pixels[k, 0], pixels[k, 1]
+        s = I[i, j]
+        if s == s2:
+            continue
+        dA_1, dA_2, dP_1, dP_2 = 0, 0, 0, 0
+        dH = get_dJ(adhesion, s, s2, I, i, j)
+        if s != 0:
+            dA_1, dP_1 = -1, get_dP(I, i, j, s, -1)
+            dH += get_dH(s, dP_1, dA_1, A, P, lambda_A, lambda_P, A0, P0)
+        if s2 != 0:
+            dA_2, dP_2 = 1, get_dP(I, i, j, s2, 1)
+            dH += get_dH(s2, dP_2, dA_2, A, P, lambda_A, lambda_P, A0, P0)
+        if terms is not None:
+            dH += terms_dH(terms, I, i, j, s, s2)
+        apply_flip(I, i, j, s, s2, A, P, dA_1, dA_2, dP_1, dP_2, contacts, geometry)
+        dE += dH
+    return dE
+
+
+@jit(nopython=True)
+def split_pixels(pixels):
+    """
+    Split the pixels of a cell into two halves, by the line through its centroid perpendicular to its major axis (the
+    principal axis of largest variance of the pixel coordinates).
+    @param pixels: (n x 2) int array of the (x, y) coordinates of the pixels of the cell.
+    @return: (m x 2) int array of the pixels on the positive side of the line.
+    """
+    n = len(pixels)
+    x = pixels[:, 0].astype(np.float64)
+    y = pixels[:, 1].astype(np.float64)
+    cx, cy = x.mean(), y.mean()
+    xx = np.mean((x - cx) ** 2)
+    yy = np.mean((y - cy) ** 2)
+    xy = np.mean((x - cx) * (y - cy))
+    # Eigenvector of the largest eigenvalue of the covariance matrix.
+    l_max = 0.5 * (xx + yy) + np.sqrt(0.25 * (xx - yy) ** 2 + xy ** 2)
+    if abs(xy) > 1e-12:
+        vx, vy = l_max - yy, xy
+    elif xx >= yy:
+        vx, vy = 1., 0.
+    else:
+        vx, vy = 0., 1.
+    side = np.zeros(n, dtype=np.bool_)
+    for k in range(n):
+        side[k] = (x[k] - cx) * vx + (y[k] - cy) * vy > 0
+    return pixels[side]
+
+
+@jit(nopython=True)
+def update_interface_pixels(pixels, I, num_x, num_y, members, position, n_members):
+    """
+    Update the set of interface pixels (see the **interface** module) after swaps of the given pixels.
+    @return: n_members, the updated number of interface pixels.
+    """
+    for k in range(len(pixels)):
+        n_members = update_interface(I, pixels[k, 0], pixels[k, 1], num_x, num_y, members, position, n_members)
+    return n_members
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""
+This module defines the counter-based random number streams used by the CPM and its samplers.
+
+A stream is a (2,) uint64 array [key, counter]. The n-th draw of a stream is a fixed function of its key and of n:
+the SplitMix64 finaliser of the key xor the scrambled counter, mix(key ^ mix(n * golden ratio)). The key and the
+counter are hashed together, rather than the key offsetting a single sequence, such that streams with different keys
+are not shifted copies of one another. Hence:
+- a run is reproduced exactly from its seed, independently of any global random state (numpy, numba or Python);
+- streams with different keys are statistically independent, and child streams can be derived from a parent without
+coordination, e.g. one per replica (see **make_stream**) or one per tile of a parallel sweep (see **spawn**). The
+output of a parallel sweep therefore does not depend on the number of threads, or on the order in which they are
+scheduled.
+
+The compiled draws update the counter of the stream in place. A stream must therefore not be shared by concurrent
+threads; derive one per thread with **spawn** instead.
+"""
+
+import secrets
+
+import numpy as np
+from numba import jit
+
+GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+MIX_1 = np.uint64(0xBF58476D1CE4E5B9)
+MIX_2 = np.uint64(0x94D049BB133111EB)
+SHIFT_1, SHIFT_2, SHIFT_3 = np.uint64(30), np.uint64(27), np.uint64(31)
+SHIFT_53 = np.uint64(11)
+TO_UNIT = 2. ** -53
+
+
+def make_stream(seed=None, stream=0):
+    """
+    Create a stream.
+    @param seed: Integer seed. If None, a seed is drawn from the entropy of the operating system.
+    @param stream: Index of the stream, e.g. of the replica, for the same seed. Different indices give independent
+    streams.
+    @return: (2,) uint64 array [key, counter].
+    """
+    if seed is None:
+        seed = secrets.randbits(64)
+    rng = np.zeros(2, dtype=np.uint64)
+    rng[0] = derive_key(np.uint64(int(seed) % 2 ** 64), np.uint64(int(stream) % 2 ** 64))
+    return rng
+
+
+@jit(nopython=True)
+def mix(z):
+    """
+    SplitMix64 finaliser: a bijective scrambling of a uint64.
+    """
+    z = (z ^ (z >> SHIFT_1)) * MIX_1
+    z = (z ^ (z >> SHIFT_2)) * MIX_2
+    return z ^ (z >> SHIFT_3)
+
+
+@jit(nopython=True)
+def derive_key(key, stream):
+    """
+    Key of the child stream number **stream** of the stream with key **key**.
+    """
+    return mix(key ^ mix((stream + np.uint64(1)) * GOLDEN))
+
+
+@jit(nopython=True)
+def next_uint64(rng):
+    """
+    Next uint64 of the stream. The counter is incremented in place.
+    """
+    rng[1] += np.uint64(1)
+    return mix(rng[0] ^ mix(rng[1] * GOLDEN))
+
+
+@jit(nopython=True)
+def random(rng):
+    """
+    Next float of the stream, uniform in [0, 1). Replaces np.random.random().
+    """
+    return float(next_uint64(rng) >> SHIFT_53) * TO_UNIT
+
+
+@jit(nopython=True)
+def spawn(rng, n):
+    """
+    Derive n independent child streams from a stream, e.g. one per thread. The parent stream is advanced by one draw,
+    such that successive calls give different children.
+    @return: (n, 2) uint64 array of streams.
+    """
+    base = next_uint64(rng)
+    children = np.zeros((n, 2), dtype=np.uint64)
+    for k in range(n):
+        children[k, 0] = derive_key(base, np.uint64(k))
+    return children
+
+
+@jit(nopython=True)
+def uniform(rng, low, high, n):
+    """
+    n floats of the stream, uniform in [low, high). Replaces np.random.uniform.
+    """
+    x = np.zeros(n)
+    for k in range(n):
+        x[k] = low + (high - low) * random(rng)
+    return x
+
+
+@jit(nopython=True)
+def permutation(rng, n):
+    """
+    Random permutation of range(n) (Fisher-Yates shuffle). Replaces np.random.permutation and random.shuffle.
+    """
+    x = np.arange(n)
+    for k in range(n - 1, 0, -1):
+        l = int(random(rng) * (k + 1))
+        x[k], x[l] = x[l], x[k]
+    return x
@@ -7,326 +7,296 @@ and evolves it under the Cellular-Potts/Metropolis Hastings algorithm to stochas
 """
 
 import numpy as np
-from numba import jit
-
+from numba import get_num_threads
+
+from .contacts import Contacts
+from .energy import get_kernel_terms
+from .geometry import CellGeometry
+from .interface import InterfaceSet, do_steps_interface
+from .kmc import KMCState, do_steps_kmc
+from .population import force_flips, update_interface_pixels
+from .state import CHECKERBOARD, HEAT_BATH, UNIFORM, make_state, run_state
+from .stats import Stats
 from .zmasks import Zmasks
 
 
 class Sample:
     """
     **Sample** class, wrapping functions that perform the Metropolis-Hastings sampling algorithm.
+
+    Pixels are chosen by one of the following samplers:
+    - "uniform": pixels are drawn uniformly over the lattice (see **kernels.pick_pixel**).
+    - "interface": pixels are drawn from the incrementally maintained set of interface pixels (see the **interface**
+    module). Statistically equivalent to "uniform" per step, but does not waste draws on the interior of cells.
+    - "rejection_free": only accepted swaps are performed, drawn in proportion to their Metropolis acceptance rates,
+    and the clock is advanced accordingly (see the **kmc** module). Statistically equivalent to "uniform" for the same
+    number of steps, but much faster at low temperatures, where most swaps are rejected.
+    - "heat_bath": instead of a single Neumann neighbour, the new index of the chosen pixel is sampled from the
+    Boltzmann weights of all the distinct indices of its Neumann neighbours, weighted by their numbers of neighbours as
+    in the proposals of "uniform" (see the **heatbath** module). Relaxes to the same states as "uniform", with
+    different dynamics.
+    - "checkerboard": the lattice is split into tiles, which are updated in parallel on all cores, in a checkerboard
+    pattern (see the **parallel** module). Same dynamics as "uniform", up to the order of updates.
+    - "tiled": pixels are drawn uniformly over the stored tiles of a tiled lattice, which only stores the tiles in
+    contact with cells (see the **tiles** module and **CPM.make_grid**). Statistically equivalent to "uniform" per step,
+    at a cost proportional to the area of the tissue. The only sampler of a tiled lattice.
+
+    All samplers draw their random numbers from the stream of the CPM object, such that runs are reproducible from
+    its seed (see **CPM.set_seed**).
     """
 
-    def __init__(self, cpm, n_steps=100):
+    samplers = ("uniform", "interface", "rejection_free", "heat_bath", "checkerboard", "tiled")
+    state_samplers = {"uniform": UNIFORM, "heat_bath": HEAT_BATH, "checkerboard": CHECKERBOARD}  # see **run_state**.
+
+    def __init__(self, cpm, n_steps=100, sampler=None):
         """
         Initialise **Sample** class.
         @param cpm: a CPM object, on which the Metropolis-Hastings optimisation algorithm is performed.
         See corresponding documentation
         @param n_steps: number of steps to perform, every time the **do_steps** function is called.
+        @param sampler: name of the sampler, see above. Defaults to the "sampler" entry of the CPM parameters, else
+        "uniform".
         """
         self.cpm = cpm  # a CPM object.
         self.zmasks = Zmasks()  # initialise the **Zmasks** object. See corresponding documentation.
         self.T = self.cpm.params["T"]  # alias for the temperature of the optimisation. Prescribed in the **CPM** class.
         self.n_steps = n_steps  # number of steps to perform, every time the **do_steps** function is called.
-
-    def do_step(self):
+        self.sampler = sampler if sampler is not None else self.cpm.params.get("sampler", "uniform")
+        assert self.sampler in self.samplers, "Unknown sampler %s" % self.sampler
+        self.interface = None  # the **InterfaceSet**, built on first use by the "interface" sampler.
+        self.effective_mcs = 0.  # elapsed Monte Carlo Steps, in proposals per **attempts_per_mcs**, of "interface".
+        self.kmc = None  # the **KMCState**, built on first use by the "rejection_free" sampler.
+        self.tile_size = self.cpm.params.get("tile_size", 32)  # minimal side of the tiles of the "checkerboard" sampler.
+        self.state, self.state_key = None, None  # the **CPMState**, see **get_state**.
+        self.stats = None  # the **Stats** of the "uniform" and "interface" samplers, if enabled. See **enable_stats**.
+        self.contacts = None  # the **Contacts** between cells, if tracked. See **enable_contacts**.
+        self.geometry = None  # the **CellGeometry** of cells, if tracked. See **enable_geometry**.
+
+    @property
+    def attempts_per_mcs(self):
         """
-        Wrapper for the **do_step** function, see below.
-
-        Performs the function, then transfers the results back to the CPM class.
-        @return:
+        Number of flip attempts that make up one Monte Carlo Step (MCS), i.e. one attempt per lattice site.
         """
-        self.cpm.sigma_field, self.cpm.A, self.cpm.P = do_step(self.cpm.sigma_field, self.cpm.num_x, self.cpm.num_y, self.zmasks.dP_z,
-                                                               self.cpm.A, self.cpm.P, self.cpm.lambda_A, self.cpm.lambda_P,
-                                                               self.cpm.A0, self.cpm.P0, self.cpm.J_diff, self.T,
-                                                               self.zmasks.primes, self.zmasks.hashes)
+        return self.cpm.num_x * self.cpm.num_y
 
-    def do_steps(self):
+    def reset_interface(self):
         """
-        Wrapper for the **do_steps** function, see below.
-
-        Performs the function, then transfers the results back to the CPM class.
-        @return:
+        Rebuild the set of interface pixels from the sigma field. Only needed if the sigma field is modified in place
+        outside the samplers.
         """
-        self.cpm.sigma_field, self.cpm.A, self.cpm.P = do_steps(self.n_steps, self.cpm.sigma_field, self.cpm.num_x, self.cpm.num_y,
-                                                                self.zmasks.dP_z, self.cpm.A, self.cpm.P, self.cpm.lambda_A,
-                                                                self.cpm.lambda_P, self.cpm.A0, self.cpm.P0, self.cpm.J_diff,
-                                                                self.T, self.zmasks.primes, self.zmasks.hashes)
-
-
-@jit(nopython=True)
-def do_step(I, num_x, num_y, dP_z, A, P, lambda_A, lambda_P, A0, P0, J_diff, T, primes, hashes):
-    """
-    Performs one iteration of the Metropolis-Hastings algorithm.
-
-    @param I: The (num_x x num_y) matrix of ints. Each int is the index corresponds to a cell. Thus each index is Moore contiguous within I.
-    @param num_x: Number of pixels in the x-dimension of I.
-    @param num_y: Number of pixels in the y-dimension of I.
-    @param dP_z: The change of perimeter given a specific type of swap. Indexed with respect to the z-mask list (see documentation in the **zmasks** module).
-    @param A: Vector of areas, indexed with respect to cell indices prescribed in I.
-    @param P: Vector of cell perimeters, indexed with respect to cell indices prescribed in I.
-    @param lambda_A: The coefficient for the (A-A0) term in the energy functional. Cell-wise.
-    @param lambda_P: The coefficient for the (P-P0) term in the energy functional. Cell wise.
-    @param A0: Optimal area for each cell. Cell wise.
-    @param P0: Optimal perimeter for each cell. Cell wise.
-    @param J_diff: Change in the interfacial energy when a pixel is replaced from cell index i to cell index j.
-    Jdiff is a (nc x nc x nc) array, where the first two dimensions are indices of cells i and j, and the third
-    dimension can be used to index of all neighbouring cells of the pixel that is being flipped.
-    @param T: Psuedo-temperature, used in the Metropolis-Hastings algorithm.
-    @param primes: The kernel used to hash the local Moore neighbourhood.
-    @param hashes: The set of hashes for all accepted local Moore neighbourhoods.
-    @return: I_new, the new I matrix. A, the new areas. P, the new perimeters.
-    """
-    ##Given an existing I matrix, sample a random point, and then select the state of one of its Neumann neighbours.
-    # (i,j) is the coordinate in the I matrix of the selected pixel.
-    # s is the cell index of the chosen pixel
-    # s2 is the cell index of the chosen neighbour
-    i, j, s, s2 = pick_pixel(I, num_x, num_y)
-
-    # Initialise the changes in the Energy/Hamiltonian as 0.
-    dH_1, dH_2 = 0, 0
-
-    # Given a point (i,j), subset I to find the Moore neighbourhood. Na is a matrix of size (3,3)
-    Na = get_Na(I, i, j)
-
-    # Initialise mask_ids.
-    mask_id_1, mask_id_2 = 0, 0
-
-    # Initialise the contributions of the change in the energy.
-    dP_1 = 0
-    dP_2 = 0
-    dA_1 = 0
-    dA_2 = 0
-
-    # Calculate the change in energy. Calculated as two components: changes in state s and changes in state s2.
-    if s != 0:  # if the chosen pixel is not a medium cell.
-
-        # The mask Na==s generically defines the neighbourhood. Only certain masks are allowed in order to preserve
-        # local Moore contiguity and hence global Moore contiguity.
-
-        # This is achieved by indexing the hashes of the allowed masks.
-        # mask_id is the index of the mask Na==s within the pre-defined list of acceptable masks.
-        mask_id_1 = get_mask_id(Na == s, primes, hashes)
-        if mask_id_1 != -1:  # if Na==s is in the list of acceptable masks, then calculate the changes in
-            # area and perimeter and hence the energy change.
-            dP_1 = dP_z[mask_id_1]
-            dA_1 = -1
-            dH_1 = get_dH(s, dP_1, dA_1, A, P, lambda_A, lambda_P, A0, P0)
-
-    if s2 != 0:  # if the chosen neighbour state is not a medium cell.
-        # Likewise with above, but instead with the swapped pixel.
-        mask_id_2 = get_mask_id(Na == s2, primes, hashes)
-        if mask_id_2 != -1:
-            dP_2 = dP_z[mask_id_2]
-            dA_2 = 1
-            dH_2 = get_dH(s2, dP_2, dA_2, A, P, lambda_A, lambda_P, A0, P0)
-            
-    # Calculate the change in the interfacial energy term.
-    dJ = get_dJ(J_diff, s, s2, Na)
-
-    # Sum together the changes in the contributions of the energy to calculate the total change in energy: dH.
-    dH = dH_1 + dH_2 + dJ
-
-    # Copy I to putatively change I by swapping states. I2 may be accepted or rejected.
-    I_new = I.copy()
-    if (mask_id_1 != -1) * (mask_id_2 != -1):  # if both masks (Na==s) and (Na==s2) are permissible.
-        if dH <= 0:  # if the change in energy is less than 0.
-            # Swap the state of pixel (i,j) with the state of the neighbours.
-            I_new[i, j] = s2
-            # Update the properties of the cells.
-            A[s] += dA_1
-            A[s2] += dA_2
-            P[s] += dP_1
-            P[s2] += dP_2
-        else:
-            if np.random.random() < np.exp(-dH / T):  # stochastic contribution to minimisation, under M-H.
-                # Swap the state of pixel (i,j) with the state of the neighbours.
-                I_new[i, j] = s2
-                # Update the properties of the cells.
-                A[s] += dA_1
-                A[s2] += dA_2
-                P[s] += dP_1
-                P[s2] += dP_2
-    return I_new, A, P
-
-
-@jit(nopython=True)
-def do_steps(n_steps, I, num_x, num_y, dP_z, A, P, lambda_A, lambda_P, A0, P0, J_diff, T, primes, hashes):
-    """
-    Iterate **do_step** for n_steps.
-
-    @param n_steps: Number of iteration steps.
-    @param I: The (num_x x num_y) matrix of ints. Each int is the index corresponds to a cell. Thus each index is Moore contiguous within I.
-    @param num_x: Number of pixels in the x-dimension of I.
-    @param num_y: Number of pixels in the y-dimension of I.
-    @param dP_z: The change of perimeter given a specific type of swap. Indexed with respect to the z-mask list (see documentation in the **zmasks** module).
-    @param A: Vector of areas, indexed with respect to cell indices prescribed in I.
-    @param P: Vector of cell perimeters, indexed with respect to cell indices prescribed in I.
-    @param lambda_A: The coefficient for the (A-A0) term in the energy functional. Cell-wise.
-    @param lambda_P: The coefficient for the (P-P0) term in the energy functional. Cell wise.
-    @param A0: Optimal area for each cell. Cell wise.
-    @param P0: Optimal perimeter for each cell. Cell wise.
-    @param J_diff: Change in the interfacial energy when a pixel is replaced from cell index i to cell index j.
-    Jdiff is a (nc x nc x nc) array, where the first two dimensions are indices of cells i and j, and the third
-    dimension can be used to index of all neighbouring cells of the pixel that is being flipped.
-    @param T: Psuedo-temperature, used in the Metropolis-Hastings algorithm.
-    @param primes: The kernel used to hash the local Moore neighbourhood.
-    @param hashes: The set of hashes for all accepted local Moore neighbourhoods.
-    @return: I, the new I matrix. A, the new areas. P, the new perimeters.
-    """
-    for i in range(n_steps):
-        I, A, P = do_step(I, num_x, num_y, dP_z, A, P, lambda_A, lambda_P, A0, P0, J_diff, T, primes, hashes)
-    return I, A, P
+        self.interface = InterfaceSet(self.cpm.sigma_field)
 
+    def reset_kmc(self):
+        """
+        Recompute the rates of the rejection-free sampler from the CPM object. Only needed if the sigma field, or the
+        parameters of the extra terms of the energy functional, are modified in place outside the samplers.
+        """
+        self.kmc = KMCState(self.cpm, self.zmasks, self.T, *get_kernel_terms(self.cpm.energy_terms))
 
-@jit(nopython=True)
-def H(A, P, lambda_A, lambda_P, A0, P0):
-    """
-    Calculate the energy of a given cell.
-    @param A: Area of the cell.
-    @param P: Its perimeter.
-    @param lambda_A: The coefficient for the (A-A0) term in the energy functional. Cell-wise.
-    @param lambda_P: The coefficient for the (P-P0) term in the energy functional. Cell wise.
-    @param A0: Optimal area for each cell. Cell wise.
-    @param P0: Optimal perimeter for each cell. Cell wise.
-    @return: H, the energy of the cell inputted.
-    """
-    return lambda_A * (A - A0) ** 2 + lambda_P * (P - P0) ** 2
+    def enable_stats(self):
+        """
+        Start recording where the flip attempts of the "uniform" and "interface" samplers go (proposals, rejections,
+        changes in energy and acceptance per pair of cell types) in **self.stats**. See the **stats** module.
 
+        Counts accumulate over calls, until **self.stats.reset** is called. The other samplers record nothing.
+        @return: the **Stats** object.
+        """
+        self.stats = Stats(self.cpm.cell_type, self.cpm.n_types)
+        return self.stats
 
-@jit(nopython=True)
-def get_dH(s, dP, dA, A, P, lambda_A, lambda_P, A0, P0):
-    """
-    Calculate the change in energy.
-
-    @param s: Index of the pixel in question.
-    @param dP: Change in perimeter of that cell.
-    @param dA: Change in area.
-    @param A: Vector of areas, indexed with respect to cell indices prescribed in I.
-    @param P: Vector of cell perimeters, indexed with respect to cell indices prescribed in I.
-    @param lambda_A: The coefficient for the (A-A0) term in the energy functional. Cell-wise.
-    @param lambda_P: The coefficient for the (P-P0) term in the energy functional. Cell wise.
-    @param A0: Optimal area for each cell. Cell wise.
-    @param P0: Optimal perimeter for each cell. Cell wise.
-    @return:
-    """
-    dH = H(A[s] + dA, P[s] + dP, lambda_A[s], lambda_P[s], A0[s], P0[s])
-    dH -= H(A[s], P[s], lambda_A[s], lambda_P[s], A0[s], P0[s])
-    return dH
+    def disable_stats(self):
+        """
+        Stop recording statistics. The kernels then run without any recording overhead.
+        """
+        self.stats = None
 
+    def enable_contacts(self):
+        """
+        Start maintaining the contact lengths between cells, and between cell types, in **self.contacts**, updated
+        after every accepted swap. See the **contacts** module.
+        @return: the **Contacts** object.
+        """
+        if self.contacts is None:
+            self.contacts = Contacts(self.cpm)
+        elif self.contacts.is_stale(self.cpm):
+            self.contacts.rebuild()
+        return self.contacts
 
-@jit(nopython=True)
-def pick_pixel(I, num_x, num_y):
-    """
-    Algorithm to choose pixels.
-
-    1. Randomly choose a pixel (i,j)
-    2. Continue if: not a boundary pixel, else return to 1.
-    3. Define the cell index of the pixel (i,j) as s
-    4. Pick one of the indices of the neighbouring pixels (Neumann). s2.
-    5. Accept if s=/=s2. Else return to 1.
-
-    @param I: The (num_x x num_y) matrix of ints. Each int is the index corresponds to a cell. Thus each index is Moore contiguous within I.
-    @param num_x: Number of pixels in the x-dimension of I.
-    @param num_y: Number of pixels in the y-dimension of I.
-    @return: i: Chosen pixel x-component.
-    j: Chosen pixel y-component.
-    s: Index of the pixel in question.
-    s2: Index of the neighbouring.
-    """
-    picked = False
-    while picked is False:
-        i = int(np.random.random() * num_x)
-        j = int(np.random.random() * num_y)
-        if not ((i * j == 0) or (((i - num_x + 1) * (j - num_y + 1)) == 0)):
-            s = I[i, j]
-            s2 = get_s2(I, i, j, num_x, num_y)
-            if s != s2:
-                picked = True
-    return i, j, s, s2
-
-
-@jit(nopython=True)
-def get_mask_id(the_mask, primes, hashes):
-    """
-    The mask Na==s generically defines the neighbourhood. Only certain masks are allowed in order to preserve
-    local Moore contiguity and hence global Moore contiguity.
+    def disable_contacts(self):
+        """
+        Stop maintaining the contacts. The kernels then run without any overhead.
+        """
+        self.contacts = None
 
-    This is achieved by indexing the hashes of the allowed masks.
-    mask_id is the index of the mask Na==s within the pre-defined list of acceptable masks.
+    def enable_geometry(self, pixel_list=False):
+        """
+        Start maintaining the bounding boxes, centroids and second moments of the cells, and optionally their lists of
+        pixels, in **self.geometry**, updated after every accepted swap. See the **geometry** module.
+        @param pixel_list: Boolean. If True, also maintain the list of pixels of every cell.
+        @return: the **CellGeometry** object.
+        """
+        if (self.geometry is None) or (pixel_list and not self.geometry.pixel_list):
+            self.geometry = CellGeometry(self.cpm, pixel_list)
+        elif self.geometry.is_stale(self.cpm):
+            self.geometry.rebuild()
+        return self.geometry
 
+    def disable_geometry(self):
+        """
+        Stop maintaining the geometry of the cells. The kernels then run without any overhead.
+        """
+        self.geometry = None
 
-    @param the_mask: A 3x3 boolean array defining the neighbourhood of a pixel. In the code this is Na==s or Na==s2.
-    @param primes: The kernel used to hash the mask.
-    @param hashes: The list of acceptable hashes.
-    @return: This function returns the index of the mask from the list of acceptable masks.
-    If **the_mask** is not in this list, -1 is returned.
-    """
-    hash = np.sum(the_mask * primes)
-    cont = True
-    k = 0
-    mask_id = -1
-    n_hashes = len(hashes)
-    while (cont) and (k < n_hashes):
-        if hash == hashes[k]:
-            mask_id = k
-            cont = False
-        else:
-            k += 1
-    return mask_id
+    def resize(self):
+        """
+        Follow the growth of the per-cell arrays of the CPM object (see **CPM.grow**): enlarge the tracked contacts,
+        geometry and rates of the "rejection_free" sampler, without rebuilding them.
+        """
+        if self.stats is not None:
+            self.stats.cell_type = self.cpm.cell_type
+        if self.contacts is not None:
+            self.contacts.resize()
+        if self.geometry is not None:
+            self.geometry.resize()
+        if self.kmc is not None:
+            self.kmc.resize(self.cpm, self.T, get_kernel_terms(self.cpm.energy_terms)[0])
+
+    def assign_pixels(self, pixels, s2):
+        """
+        Assign pixels to cell s2, regardless of the zmasks, e.g. on division or removal of a cell (see the
+        **population** module). The energy, contacts, geometry and the set of interface pixels are updated in
+        O(number of pixels), and the rates of the "rejection_free" sampler in O(number of pixels + perimeters of the
+        cells that lose or gain pixels).
+        @param pixels: (n x 2) array of the (x, y) coordinates of the pixels. None may lie on the border of the lattice.
+        @param s2: Index of the cell gaining the pixels, 0 for the medium.
+        """
+        cpm = self.cpm
+        pixels = np.asarray(pixels, dtype=np.int64).reshape(-1, 2)
+        assert np.all((pixels > 0) & (pixels < (cpm.num_x - 1, cpm.num_y - 1))), "Pixels on the border of the lattice"
+        if cpm.lattice is not None:
+            if cpm.energy is None:
+                cpm.energy = cpm.get_energy()
+            cpm.energy += cpm.lattice.force_flips(pixels, s2, cpm.A, cpm.P, cpm.lambda_A, cpm.lambda_P, cpm.A0, cpm.P0,
+                                                  cpm.adhesion)
+            return
+        terms_dH, terms = get_kernel_terms(cpm.energy_terms)
+        contacts = None if self.contacts is None else self.enable_contacts().kernel_args
+        geometry = None if self.geometry is None else self.enable_geometry(self.geometry.pixel_list).kernel_args
+        if cpm.energy is None:
+            cpm.energy = cpm.get_energy()
+        kmc = self.kmc if (self.kmc is not None) and not self.kmc.is_stale(cpm, self.T, terms_dH) else None
+        cells = np.unique(np.append(cpm.sigma_field[pixels[:, 0], pixels[:, 1]], s2)) if kmc is not None else None
+        cpm.energy += force_flips(pixels, s2, cpm.sigma_field, cpm.A, cpm.P, cpm.lambda_A, cpm.lambda_P, cpm.A0,
+                                  cpm.P0, cpm.adhesion, contacts, geometry, terms_dH, terms)
+        if (self.interface is not None) and not self.interface.is_stale(cpm.sigma_field):
+            self.interface.n_members = update_interface_pixels(pixels, cpm.sigma_field, cpm.num_x, cpm.num_y,
+                                                               self.interface.members, self.interface.position,
+                                                               self.interface.n_members)
+        if kmc is not None:
+            kmc.update(cpm, pixels, cells, self.zmasks, self.T, terms_dH, terms)
+        self.kmc = kmc
+        if (contacts is not None) and self.contacts.overflow[0]:
+            self.contacts.rebuild()
+
+    def get_state(self):
+        """
+        Return the **CPMState** of the CPM object, on which the compiled kernels operate.
 
+        The state references the arrays of the CPM object, and is only recreated if one of them has been replaced
+        (e.g. by **CPM.make_init** or **CPM.initialize**), or if the temperature, tile size or, for the "checkerboard"
+        sampler, number of threads has changed, such that repeated calls are cheap.
+        """
+        cpm, key = self.cpm, self.state_key
+        n_blocks = get_num_threads() if self.sampler == "checkerboard" else 0
+        if (key is None) or not (cpm.sigma_field is key[0] and cpm.A is key[1] and cpm.P is key[2]
+                                 and cpm.lambda_A is key[3] and cpm.lambda_P is key[4] and cpm.A0 is key[5]
+                                 and cpm.P0 is key[6] and cpm.adhesion is key[7] and cpm.rng is key[8]
+                                 and self.T == key[9] and self.tile_size == key[10] and n_blocks == key[11]):
+            self.state = make_state(cpm.sigma_field, cpm.num_x, cpm.num_y, self.zmasks.dP_table, cpm.A, cpm.P,
+                                    cpm.lambda_A, cpm.lambda_P, cpm.A0, cpm.P0, cpm.adhesion, self.T,
+                                    self.zmasks.allowed, cpm.rng, self.tile_size, n_blocks)
+            self.state_key = (cpm.sigma_field, cpm.A, cpm.P, cpm.lambda_A, cpm.lambda_P, cpm.A0, cpm.P0, cpm.adhesion,
+                              cpm.rng, self.T, self.tile_size, n_blocks)
+        return self.state
 
-@jit(nopython=True)
-def get_Na(I, i, j):
-    """
-    Given a point (i,j), subset I to find the Moore neighbourhood. Na is a matrix of size (3,3)
-    @param I: The (num_x x num_y) matrix of ints. Each int is the index corresponds to a cell. Thus each index is Moore contiguous within I.
-    @param i: Chosen pixel x-component.
-    @param j: Chosen pixel y-component.
-    @return: Na. The 3x3 subset I centred on (i,j).
-    """
-    Na = I[i - 1:i + 2, j - 1:j + 2]
-    return Na
+    def do_step(self):
+        """
+        Perform a single iteration of the Metropolis-Hastings algorithm, see **kernels.do_step**.
 
+        The sigma field, areas and perimeters of the CPM class are updated in place.
+        @return:
+        """
+        self.run(1)
 
-@jit(nopython=True)
-def get_s2(I, i, j, num_x, num_y):
-    """
-    Given a pixel in I, (i,j), randomly sample a cell index, s2, from the Neumann neighbourhood.
-    Neumann neighbourhood is defined in neighbour_options.
-
-    @param I: The (num_x x num_y) matrix of ints. Each int is the index corresponds to a cell. Thus each index is Moore contiguous within I.
-    @param i: Chosen pixel x-component.
-    @param j: Chosen pixel y-component.
-    @param num_x: Number of pixels in the x-dimension of I.
-    @param num_y: Number of pixels in the y-dimension of I.
-    @return: s2, the cell index of the neighbouring pixel that is sampled randomly.
-    """
-    # Specifies Neumann neighbourhood.
-    neighbour_options = np.array([[1, 0],
-                                  [-1, 0],
-                                  [0, 1],
-                                  [0, -1]])
+    def do_steps(self):
+        """
+        Wrapper for the **kernels.do_steps** function.
 
-    # Randomly choose one of the four options. This defines the shift in the x and y directions wrt. (i,j).
-    ni = neighbour_options[int(np.random.random() * 4)]
+        Performs **n_steps** flip attempts. The sigma field, areas and perimeters of the CPM class are updated in place.
+        @return:
+        """
+        self.run(self.n_steps)
 
-    # Identify s2 from I.
-    s2 = I[np.mod(ni[0] + i, num_x), np.mod(ni[1] + j, num_y)]
-    return s2
+    def do_mcs(self, n_mcs=1):
+        """
+        Perform **n_mcs** Monte Carlo Steps. One MCS is num_x * num_y flip attempts, such that on average every
+        lattice site is visited once per MCS, independent of the size of the lattice.
 
+        The sigma field, areas and perimeters of the CPM class are updated in place.
+        @param n_mcs: Number of Monte Carlo Steps to perform. Can be fractional.
+        """
+        self.run(int(n_mcs * self.attempts_per_mcs))
 
-@jit(nopython=True)
-def get_dJ(J_diff, s, s2, Na):
-    """
-    Calculate the change in the interfacial energy, dJ.
+    def run(self, n_steps):
+        """
+        Perform **n_steps** flip attempts with the chosen sampler. The total energy of the CPM object, **CPM.energy**,
+        is updated with the change in energy of every accepted swap.
+        @param n_steps: Number of flip attempts.
+        """
+        cpm = self.cpm
+        assert (self.sampler == "tiled") == (cpm.lattice is not None), \
+            "The \"tiled\" sampler, and only it, samples a tiled lattice (see **CPM.make_grid**)"
+        # Incremental state is only maintained by the sampler that owns it.
+        if self.sampler != "interface":
+            self.interface = None
+        if self.sampler != "rejection_free":
+            self.kmc = None
+        stats = None if self.stats is None else self.stats.kernel_args
+        terms_dH, terms = get_kernel_terms(cpm.energy_terms)  # before the geometry, which terms may enable.
+        contacts = None if self.contacts is None else self.enable_contacts().kernel_args
+        geometry = None if self.geometry is None else self.enable_geometry(self.geometry.pixel_list).kernel_args
+        if cpm.energy is None:
+            cpm.energy = cpm.get_energy()
+
+        if self.sampler == "tiled":
+            assert all(x is None for x in (stats, contacts, geometry, terms)), \
+                "Statistics, contacts, geometry and extra energy terms require a dense sigma field"
+            dE = cpm.lattice.run(n_steps, self.zmasks.dP_table, cpm.A, cpm.P, cpm.lambda_A, cpm.lambda_P, cpm.A0,
+                                 cpm.P0, cpm.adhesion, self.T, self.zmasks.allowed, cpm.rng)
+        elif self.sampler == "interface":
+            if (self.interface is None) or self.interface.is_stale(cpm.sigma_field):
+                self.reset_interface()
+            interface = self.interface
+            interface.n_members, n_proposals, dE = do_steps_interface(
+                n_steps, cpm.sigma_field, cpm.num_x, cpm.num_y, self.zmasks.dP_table, cpm.A, cpm.P, cpm.lambda_A,
+                cpm.lambda_P, cpm.A0, cpm.P0, cpm.adhesion, self.T, self.zmasks.allowed, cpm.rng, interface.members,
+                interface.position, interface.n_members, stats, contacts, geometry, terms_dH, terms)
+            self.effective_mcs += n_proposals / self.attempts_per_mcs
+        elif self.sampler == "rejection_free":
+            if (self.kmc is None) or self.kmc.is_stale(cpm, self.T, terms_dH):
+                self.reset_kmc()
+            kmc = self.kmc
+            n_events, dE = do_steps_kmc(n_steps, cpm.sigma_field, cpm.num_x, cpm.num_y, self.zmasks.dP_table, cpm.A,
+                                        cpm.P, cpm.lambda_A, cpm.lambda_P, cpm.A0, cpm.P0, cpm.adhesion, self.T,
+                                        self.zmasks.allowed, cpm.rng, kmc.rates, kmc.tree, kmc.n_leaves, kmc.n_pairs,
+                                        kmc.owner, kmc.next_pixel, kmc.prev_pixel, kmc.head, contacts,
+                                        geometry, terms_dH, terms)
+            kmc.n_events += n_events
+        else:
+            dE = run_state(self.get_state(), self.state_samplers[self.sampler], n_steps, stats, contacts,
+                           geometry, terms_dH, terms, *cpm.adhesion[2:])
+        cpm.energy += dE
 
-    @param J_diff: Change in the interfacial energy when a pixel is replaced from cell index i to cell index j.
-    @param s: Index of the pixel in question.
-    @param s2: Index of the neighbouring pixel.
-    @param Na: A 3x3 matrix, subsetting I centred on (i,j).
-    @return:
-    """
-    Js2s = J_diff[s2, s]
-    dJ = Js2s.take(Na.take([0, 1, 2, 3, 5, 6, 7, 8])).sum()
-    return dJ
+        # The "checkerboard" sampler does not update the contacts, to avoid races between threads.
+        if (contacts is not None) and (self.sampler == "checkerboard" or self.contacts.overflow[0]):
+            self.contacts.rebuild()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+"""
+This module defines the binary run format, in which the snapshots of the sigma field of a run are stored:
+**SnapshotWriter**, which streams frames to an append-only file from a background thread, and **SnapshotReader**,
+which reads them back with random access (see **CPM.simulate** and **CPM.save_simulation**).
+
+A file starts with a header, the magic bytes b"CPMRUN01" followed by the length and the JSON description of the frames
+(shape and dtype). It is followed by chunks of consecutive frames, each a record (b"CHNK", number of frames, length of
+the payload) followed by the payload, compressed with zlib at its fastest level. Between snapshots, only a small
+fraction of the pixels swap, so the first frame of a chunk is stored in full, as a keyframe, and every following frame
+as the list of the pixels that changed since the previous frame. The payload holds, in order: the keyframe, the number
+of changed pixels of every following frame, the gaps between the flat indices of the changed pixels, and their new cell
+indices. Each array is byte-shuffled (all first bytes of its elements, then all second bytes, ...), which groups the
+mostly-zero high bytes, such that zlib compresses it better, at no cost in speed. A closed file ends with an index of
+the chunks (b"INDX", their offsets, lengths and first frames), followed by the offset of the index and the magic bytes
+b"CPMRUNIX", such that a reader seeks any frame directly, decoding at most one chunk.
+
+Frames are handed to the writer thread through a bounded queue, and written as soon as a chunk is full, such that the
+memory of a run is O(chunk) rather than O(number of snapshots), and the simulation does not wait for the encoding
+(zlib releases the GIL). A chunk is also written, partial, once its first frame has waited max_delay seconds, such that
+slow runs (e.g. with the GUI) reach the file frame by frame; every chunk, full or partial, starts with a keyframe.
+Every chunk is flushed to the file when written: after a crash, the file has no index, and the reader recovers all
+complete chunks by scanning their records, ignoring a truncated last chunk. A writer that is still open when the
+interpreter exits is closed, writing its queued frames and index.
+"""
+
+import atexit
+import json
+import queue
+import struct
+import threading
+import time
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+MAGIC = b"CPMRUN01"
+INDEX_MAGIC = b"CPMRUNIX"
+RECORD = struct.Struct("<4sIQ")  # tag, number of frames (or chunks, for the index), length of the payload.
+TRAILER = struct.Struct("<Q8s")  # offset of the index, INDEX_MAGIC.
+
+
+def shuffle(x):
+    """
+    Bytes of the array x, byte-shuffled: the first bytes of all elements, then their second bytes, ...
+    """
+    return np.ascontiguousarray(np.ascontiguousarray(x).view(np.uint8).reshape(-1, x.itemsize).T).tobytes()
+
+
+def unshuffle(data, dtype, count, offset):
+    """
+    Inverse of **shuffle**: the array of count elements of type dtype, byte-shuffled at data[offset:].
+    @return: The array, and the offset following it.
+    """
+    dtype = np.dtype(dtype)
+    x = np.frombuffer(data, np.uint8, count * dtype.itemsize, offset).reshape(dtype.itemsize, count)
+    return np.ascontiguousarray(x.T).view(dtype).ravel(), offset + count * dtype.itemsize
+
+
+class SnapshotWriter:
+    """
+    **SnapshotWriter** class, an append-only file of frames, written by a background thread.
+    """
+
+    def __init__(self, path, shape, dtype, chunk_size=32, level=1, max_pending=4, max_delay=1.):
+        """
+        Initialise **SnapshotWriter** class. Creates, or overwrites, the file.
+        @param path: Path of the file.
+        @param shape: Shape of the frames, (num_x, num_y).
+        @param dtype: Integer type of the frames.
+        @param chunk_size: Maximal number of frames per chunk, i.e. between keyframes.
+        @param level: zlib compression level, 1 (fastest) to 9 (smallest).
+        @param max_pending: Number of chunks that may wait for the writer thread before **append** blocks.
+        @param max_delay: Time, in seconds, after which the frames of a partial chunk are written.
+        """
+        self.path = Path(path)
+        self.shape, self.dtype = tuple(shape), np.dtype(dtype)
+        self.chunk_size, self.level, self.max_delay = chunk_size, level, max_delay
+        self.n_frames = 0
+        self.error = None  # exception raised by the writer thread, re-raised by **append** and **close**.
+        self.index = []  # (offset, length, first frame) of every chunk written.
+
+        self.file = open(self.path, "wb")
+        header = json.dumps({"shape": self.shape, "dtype": self.dtype.str}).encode()
+        self.file.write(MAGIC + struct.pack("<I", len(header)) + header)
+        self.file.flush()
+
+        self.queue = queue.Queue(maxsize=max_pending * chunk_size)
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, frame):
+        """
+        Queue a copy of a frame. Blocks while **max_pending** chunks wait for the writer thread.
+        """
+        if self.error is not None:
+            raise IOError("Writing %s failed" % self.path) from self.error
+        frame = np.asarray(frame)
+        assert frame.shape == self.shape, "Frame of shape %s, expected %s" % (frame.shape, self.shape)
+        assert np.can_cast(frame.dtype, self.dtype), "Frame of type %s, expected %s" % (frame.dtype, self.dtype)
+        self.queue.put(frame.astype(self.dtype))
+        self.n_frames += 1
+
+    def work(self):
+        """
+        Writer thread: group the queued frames into chunks, and write every chunk once it is full or its first frame
+        has waited max_delay, until **close** queues None.
+        """
+        frames, deadline, closing = [], None, False
+        while not closing:
+            try:
+                frame = self.queue.get(timeout=max(deadline - time.monotonic(), 0.) if frames else None)
+                closing = frame is None
+                if not closing:
+                    if not frames:
+                        deadline = time.monotonic() + self.max_delay
+                    frames.append(frame)
+            except queue.Empty:  # the partial chunk is due, see below.
+                pass
+            if frames and (closing or (len(frames) == self.chunk_size) or (time.monotonic() >= deadline)):
+                if self.error is None:
+                    try:
+                        self.write_chunk(frames)
+                    except Exception as error:  # keep draining the queue, such that **append** does not block.
+                        self.error = error
+                frames = []
+
+    def write_chunk(self, frames):
+        """
+        Encode, compress and write a chunk of frames, and flush it to the file.
+        """
+        counts, gaps, values = [], [np.zeros(0, dtype=np.uint32)], [np.zeros(0, dtype=self.dtype)]
+        for previous, frame in zip(frames[:-1], frames[1:]):
+            changed = np.flatnonzero(previous != frame).astype(np.uint32)
+            counts.append(len(changed))
+            gaps.append(np.diff(changed, prepend=np.uint32(0)))
+            values.append(frame.ravel()[changed])
+        parts = (shuffle(frames[0]), np.array(counts, dtype=np.uint32).tobytes(), shuffle(np.concatenate(gaps)),
+                 shuffle(np.concatenate(values)))
+        payload = zlib.compress(b"".join(parts), self.level)
+        offset = self.file.tell()
+        self.file.write(RECORD.pack(b"CHNK", len(frames), len(payload)))
+        self.file.write(payload)
+        self.file.flush()
+        start = self.index[-1][2] + self.index[-1][3] if self.index else 0
+        self.index.append((offset, RECORD.size + len(payload), start, len(frames)))
+
+    def close(self):
+        """
+        Write the queued frames, and close the file.
+        """
+        if self.file.closed:
+            return
+        atexit.unregister(self.close)
+        self.queue.put(None)
+        self.thread.join()
+        try:
+            if self.error is None:
+                index = np.array(self.index, dtype=np.uint64).reshape(-1, 4)
+                offset = self.file.tell()
+                self.file.write(RECORD.pack(b"INDX", len(index), index.nbytes) + index.tobytes())
+                self.file.write(TRAILER.pack(offset, INDEX_MAGIC))
+        finally:
+            self.file.close()
+        if self.error is not None:
+            raise IOError("Writing %s failed" % self.path) from self.error
+
+
+class SnapshotReader:
+    """
+    **SnapshotReader** class, the frames of a run file of **SnapshotWriter**, as a read-only sequence of
+    (num_x x num_y) arrays. Frames are decoded on access, one chunk at a time, and the last chunk decoded is kept.
+    """
+
+    def __init__(self, path):
+        """
+        Initialise **SnapshotReader** class, from the index of the file, or by scanning the records of its complete
+        chunks if it has none.
+        @param path: Path of the file.
+        """
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            assert f.read(len(MAGIC)) == MAGIC, "%s is not a run file" % self.path
+            header_length = struct.unpack("<I", f.read(4))[0]
+            header = json.loads(f.read(header_length))
+            self.frame_shape, self.dtype = tuple(header["shape"]), np.dtype(header["dtype"])
+            size = f.seek(0, 2)
+            index = None
+            if size >= len(MAGIC) + 4 + header_length + TRAILER.size:
+                f.seek(size - TRAILER.size)
+                offset, magic = TRAILER.unpack(f.read(TRAILER.size))
+                if magic == INDEX_MAGIC:
+                    f.seek(offset)
+                    tag, n_chunks, length = RECORD.unpack(f.read(RECORD.size))
+                    index = np.frombuffer(f.read(length), dtype=np.uint64).reshape(n_chunks, 4).astype(np.int64)
+            if index is None:
+                index = self.scan(f, len(MAGIC) + 4 + header_length, size)
+        self.chunks = index[:, :2]  # offset and length of the record of every chunk.
+        self.starts = np.append(index[:, 2], index[-1, 2] + index[-1, 3] if len(index) else 0)
+        self.cached = (None, None)  # index and frames of the last chunk decoded.
+
+    @staticmethod
+    def scan(f, offset, size):
+        """
+        Index the complete chunks of a file without index, e.g. after a crash.
+        @return: (n_chunks x 4) int array of the offset, length, first frame and number of frames of every chunk.
+        """
+        index, start = [], 0
+        while offset + RECORD.size <= size:
+            f.seek(offset)
+            tag, n, length = RECORD.unpack(f.read(RECORD.size))
+            if (tag != b"CHNK") or (offset + RECORD.size + length > size):  # truncated by a crash.
+                break
+            index.append((offset, RECORD.size + length, start, n))
+            start += n
+            offset += RECORD.size + length
+        return np.array(index, dtype=np.int64).reshape(-1, 4)
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    @property
+    def shape(self):
+        return (len(self),) + self.frame_shape
+
+    def read_chunk(self, c):
+        """
+        @return: (n x num_x x num_y) array of the frames of chunk c, decoded from its keyframe and changed pixels.
+        """
+        if self.cached[0] != c:
+            offset, length = self.chunks[c]
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                tag, n, _ = RECORD.unpack(f.read(RECORD.size))
+                data = zlib.decompress(f.read(length - RECORD.size))
+            frames = np.empty((n,) + self.frame_shape, dtype=self.dtype)
+            keyframe, position = unshuffle(data, self.dtype, frames[0].size, 0)
+            frames[0] = keyframe.reshape(self.frame_shape)
+            counts = np.frombuffer(data, np.uint32, n - 1, position).astype(np.int64)
+            gaps, position = unshuffle(data, np.uint32, int(counts.sum()), position + 4 * (n - 1))
+            values, _ = unshuffle(data, self.dtype, int(counts.sum()), position)
+            ends = np.cumsum(counts)
+            for k in range(1, n):
+                start, end = ends[k - 1] - counts[k - 1], ends[k - 1]
+                frames[k] = frames[k - 1]
+                frames[k].ravel()[np.cumsum(gaps[start:end], dtype=np.int64)] = values[start:end]
+            frames.flags.writeable = False
+            self.cached = (c, frames)
+        return self.cached[1]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("Frame %d of %d" % (i, len(self)))
+        c = int(np.searchsorted(self.starts, i, side="right")) - 1
+        return self.read_chunk(c)[i - self.starts[c]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+"""
+This module defines **CPMState**, a compiled container (a numba jitclass) of all the arrays and scalars that the
+sampling kernels operate on.
+
+Calling a compiled function with the fourteen separate arrays and scalars of **kernels.do_steps** requires numba to
+type-check and unbox each of them on every call, which dominates the cost of short calls, such as the single steps of
+the GUI. A **CPMState** is unboxed as a single object, and the kernels read its fields directly.
+
+The fields reference the arrays of the CPM object (without copying), such that the sigma field, areas and perimeters
+of the CPM object are updated in place. A jitclass has fixed field types, so one class is compiled for each integer
+type of the sigma field (see **get_state_class**).
+"""
+
+import numpy as np
+from numba import from_dtype, jit, types
+from numba.experimental import jitclass
+
+from .heatbath import do_steps_heat_bath
+from .kernels import do_steps
+from .parallel import do_steps_checkerboard
+
+# Samplers that operate on a **CPMState** only. See **Sample** for their description.
+UNIFORM, HEAT_BATH, CHECKERBOARD = 0, 1, 2
+
+state_classes = {}  # **CPMState** classes, by the integer type of the sigma field.
+
+
+def get_state_class(I_dtype):
+    """
+    Return the **CPMState** class for sigma fields of type I_dtype, compiling it on first use.
+    """
+    I_dtype = np.dtype(I_dtype)
+    if I_dtype not in state_classes:
+        spec = [("I", from_dtype(I_dtype)[:, :]),
+                ("num_x", types.int64),
+                ("num_y", types.int64),
+                ("dP_table", types.int64[:]),
+                ("A", types.int64[:]),
+                ("P", types.int64[:]),
+                ("lambda_A", types.float64[:]),
+                ("lambda_P", types.float64[:]),
+                ("A0", types.float64[:]),
+                ("P0", types.float64[:]),
+                ("J_table", types.float64[:, :]),
+                ("cell_type", types.int64[:]),
+                ("T", types.float64),
+                ("allowed", types.boolean[:]),
+                ("rng", types.uint64[:]),
+                ("tile_size", types.int64),
+                ("boxes", types.int64[:, :, :])]
+        state_classes[I_dtype] = jitclass(spec)(CPMState)
+    return state_classes[I_dtype]
+
+
+class CPMState:
+    """
+    **CPMState** class, holding the state of a CPM object and the parameters of its energy functional.
+
+    The fields are those of **kernels.do_steps**, with the tuple adhesion stored as its arrays J_table and cell_type
+    (the overrides, which may be None, are passed to **run_state**), plus tile_size, the minimal side of the tiles of
+    the "checkerboard" sampler, and boxes, the buffer of its lattice scans. Use **make_state** to create one.
+    """
+
+    def __init__(self, I, num_x, num_y, dP_table, A, P, lambda_A, lambda_P, A0, P0, J_table, cell_type, T, allowed,
+                 rng, tile_size, boxes):
+        self.I = I
+        self.num_x = num_x
+        self.num_y = num_y
+        self.dP_table = dP_table
+        self.A = A
+        self.P = P
+        self.lambda_A = lambda_A
+        self.lambda_P = lambda_P
+        self.A0 = A0
+        self.P0 = P0
+        self.J_table = J_table
+        self.cell_type = cell_type
+        self.T = T
+        self.allowed = allowed
+        self.rng = rng
+        self.tile_size = tile_size
+        self.boxes = boxes
+
+
+def make_state(I, num_x, num_y, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T, allowed, rng, tile_size,
+               n_blocks=0):
+    """
+    Create a compiled **CPMState**. The arrays are referenced, not copied. The overrides of adhesion are not part of
+    the state, and are passed to **run_state**.
+    @param n_blocks: Number of blocks of rows of the concurrent scans of the "checkerboard" sampler, for which the
+    buffer boxes is allocated (see **parallel.max_cell_extent**), or 0 for the other samplers.
+    """
+    boxes = np.empty((n_blocks, len(A) if n_blocks else 0, 4), dtype=np.int64)
+    return get_state_class(I.dtype)(I, num_x, num_y, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion[0],
+                                    adhesion[1], float(T), allowed, rng, tile_size, boxes)
+
+
+@jit(nopython=True)
+def run_state(state, sampler, n_steps, stats=None, contacts=None, geometry=None, terms_dH=None, terms=None,
+              override_keys=None, override_J=None):
+    """
+    Perform n_steps iterations of the chosen sampler on a **CPMState**.
+    @param state: a **CPMState**.
+    @param sampler: UNIFORM, HEAT_BATH or CHECKERBOARD.
+    @param n_steps: Number of iteration steps.
+    @param stats: Tuple (counts, cell_type) of a **Stats** object, or None. Only recorded by the UNIFORM sampler.
+    @param contacts: Tuple of the arrays of a **Contacts** object, or None. Not updated by the CHECKERBOARD sampler.
+    @param geometry: Tuple of the arrays of a **CellGeometry** object, or None.
+    @param terms_dH, terms: The extra terms of the energy functional, or None. See the **energy** module.
+    @param override_keys, override_J: The overridden interfacial energies of pairs of cells, or None. See
+    **kernels.get_J**.
+    @return: dE, the change in the total energy.
+    """
+    adhesion = (state.J_table, state.cell_type, override_keys, override_J)
+    if sampler == HEAT_BATH:
+        return do_steps_heat_bath(n_steps, state.I, state.num_x, state.num_y, state.dP_table, state.A, state.P,
+                                  state.lambda_A, state.lambda_P, state.A0, state.P0, adhesion, state.T,
+                                  state.allowed, state.rng, contacts, geometry, terms_dH, terms)
+    elif sampler == CHECKERBOARD:
+        return do_steps_checkerboard(n_steps, state.I, state.num_x, state.num_y, state.dP_table, state.A, state.P,
+                                     state.lambda_A, state.lambda_P, state.A0, state.P0, adhesion, state.T,
+                                     state.allowed, state.rng, state.tile_size, state.boxes, geometry, terms_dH,
+                                     terms)
+    return do_steps(n_steps, state.I, state.num_x, state.num_y, state.dP_table, state.A, state.P, state.lambda_A,
+                    state.lambda_P, state.A0, state.P0, adhesion, state.T, state.allowed, state.rng, stats,
+                    contacts, geometry, terms_dH, terms)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+"""
+This module defines **Stats**, optional counters of where the flip attempts of the Metropolis-Hastings kernels go.
+
+The counts are recorded by the compiled kernels into a single preallocated int64 array. Kernels receive either the
+tuple (counts, cell_type) of a **Stats** object, or None. In the latter case, numba compiles a separate version of
+the kernels from which the recording is pruned, such that disabled statistics cost nothing.
+
+The array holds, in order:
+- the counters listed in **Stats.counters**;
+- a histogram of the change in energy dH of all proposals permitted by the zmasks, over N_DH_BINS bins: bin
+N_DH_BINS // 2 + k holds 2^k - 1 <= dH < 2^(k+1) - 1, and bin N_DH_BINS // 2 - 1 - k the same range of -dH;
+- the number of proposals, then of accepted swaps, of a pixel of cell type a to cell type b, as two
+(n_types x n_types) matrices (type 0 is the medium).
+"""
+
+import numpy as np
+from numba import jit
+
+# Indices of the counters.
+PROPOSALS, PICK_REJECTIONS, FORBIDDEN_S, FORBIDDEN_S2, DOWNHILL_ACCEPTED, UPHILL_ACCEPTED, UPHILL_REJECTED = range(7)
+N_COUNTERS = 7
+N_DH_BINS = 32
+
+
+class Stats:
+    """
+    **Stats** class, holding the counters recorded by the kernels of the "uniform" and "interface" samplers.
+    See **Sample.enable_stats**.
+    """
+
+    counters = ("proposals",  # pairs (s, s2) with s != s2 passed on to the Metropolis criterion.
+                "pick_rejections",  # draws rejected while choosing a pair, as on the border or with s == s2.
+                "forbidden_s",  # proposals forbidden by the zmask of the cell losing the pixel, s.
+                "forbidden_s2",  # proposals forbidden by the zmask of the cell gaining the pixel, s2.
+                "downhill_accepted",  # accepted swaps with dH <= 0.
+                "uphill_accepted",  # accepted swaps with dH > 0.
+                "uphill_rejected")  # swaps with dH > 0 rejected by the Metropolis criterion.
+
+    def __init__(self, cell_type, n_types=None):
+        """
+        Initialise **Stats** class.
+        @param cell_type: Cell type of every cell index, including 0 for the medium.
+        @param n_types: Number of cell types, including the medium. Defaults to the largest type in cell_type, plus 1.
+        """
+        self.cell_type = np.asarray(cell_type, dtype=np.int64)
+        self.n_types = int(self.cell_type.max()) + 1 if n_types is None else n_types
+        self.counts = np.zeros(N_COUNTERS + N_DH_BINS + 2 * self.n_types ** 2, dtype=np.int64)
+
+    @property
+    def kernel_args(self):
+        """
+        The statistics, as passed to the compiled kernels.
+        """
+        return self.counts, self.cell_type
+
+    def reset(self):
+        """
+        Set all counts to zero.
+        """
+        self.counts[:] = 0
+
+    def as_dict(self):
+        """
+        @return: dictionary of the counters, by name.
+        """
+        return {name: int(self.counts[k]) for k, name in enumerate(self.counters)}
+
+    def dH_histogram(self):
+        """
+        @return: edges: (N_DH_BINS + 1) bin edges, with infinite outer edges. counts: (N_DH_BINS) counts.
+        """
+        half = N_DH_BINS // 2
+        bounds = 2. ** np.arange(1, half) - 1
+        edges = np.concatenate(((-np.inf,), -bounds[::-1], (0,), bounds, (np.inf,)))
+        return edges, self.counts[N_COUNTERS:N_COUNTERS + N_DH_BINS].copy()
+
+    def type_pairs(self):
+        """
+        @return: proposed, accepted: (n_types x n_types) matrices of the proposals and accepted swaps of a pixel of
+        cell type a to cell type b.
+        """
+        n = self.n_types ** 2
+        start = N_COUNTERS + N_DH_BINS
+        proposed = self.counts[start:start + n].reshape(self.n_types, self.n_types).copy()
+        accepted = self.counts[start + n:start + 2 * n].reshape(self.n_types, self.n_types).copy()
+        return proposed, accepted
+
+    def acceptance(self):
+        """
+        @return: (n_types x n_types) matrix of the acceptance rates of swaps of a pixel of cell type a to cell type b
+        (NaN if never proposed).
+        """
+        proposed, accepted = self.type_pairs()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return accepted / proposed
+
+    def summary(self):
+        """
+        @return: printable summary of the counters, as fractions of all draws or proposals.
+        """
+        c = self.as_dict()
+        draws = max(c["proposals"] + c["pick_rejections"], 1)
+        proposals = max(c["proposals"], 1)
+        lines = ["draws %d: %.1f %% rejected while choosing the pair" % (draws, 100 * c["pick_rejections"] / draws)]
+        for name in self.counters[2:]:
+            lines.append("%-18s %12d (%.1f %% of proposals)" % (name, c[name], 100 * c[name] / proposals))
+        return "\n".join(lines)
+
+
+@jit(nopython=True)
+def record_pick_rejection(stats):
+    """
+    Count a draw rejected while choosing a pair. stats is the tuple (counts, cell_type).
+    """
+    stats[0][PICK_REJECTIONS] += 1
+
+
+@jit(nopython=True)
+def record_proposal(stats, s, s2, forbidden_1, forbidden_2, dH, accepted):
+    """
+    Count a proposal to swap a pixel from s to s2. stats is the tuple (counts, cell_type).
+    @param forbidden_1: True if the zmask of s forbids the swap.
+    @param forbidden_2: True if the zmask of s2 forbids the swap.
+    @param dH: Change in energy of the swap, if permitted by the zmasks.
+    @param accepted: True if the swap was performed.
+    """
+    counts, cell_type = stats
+    counts[PROPOSALS] += 1
+    if forbidden_1:
+        counts[FORBIDDEN_S] += 1
+    if forbidden_2:
+        counts[FORBIDDEN_S2] += 1
+    if not (forbidden_1 or forbidden_2):
+        if dH <= 0:
+            counts[DOWNHILL_ACCEPTED] += 1
+        elif accepted:
+            counts[UPHILL_ACCEPTED] += 1
+        else:
+            counts[UPHILL_REJECTED] += 1
+        half = N_DH_BINS // 2
+        k = min(int(np.log2(1. + abs(dH))), half - 1)
+        counts[N_COUNTERS + (half + k if dH >= 0 else half - 1 - k)] += 1
+
+    n_types = int(np.sqrt((len(counts) - N_COUNTERS - N_DH_BINS) // 2))
+    pair = N_COUNTERS + N_DH_BINS + cell_type[s] * n_types + cell_type[s2]
+    counts[pair] += 1
+    if accepted:
+        counts[pair + n_types ** 2] += 1
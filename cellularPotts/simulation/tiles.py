@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+
+"""
+This module defines **TiledLattice**, a sparse storage of the sigma field for tissues that fill a small fraction of a
+large lattice, and the kernels of the "tiled" sampler that operates on it (see **CPM.make_grid**).
+
+The lattice is split into square tiles of tile_size x tile_size pixels. A tile is only stored if one of its pixels, or
+one of their Moore neighbours, belongs to a cell: the tiles of medium around the tissue are neither stored nor sampled.
+Every stored tile carries a halo of one pixel, a copy of the borders of its neighbouring tiles (0, the medium, for tiles
+that are not stored and beyond the lattice), such that the Moore neighbourhood of any of its pixels is read from the
+tile alone. The kernels of the **kernels** module thus operate on a single tile, in its local coordinates, exactly as on
+the dense sigma field. After a swap, the new index of the pixel is copied to the halos of the neighbouring tiles and, if
+it is a cell, the neighbouring tiles that are not stored yet are created, such that tiles appear as cells grow into
+them. Tiles that have become entirely medium are dropped by **TiledLattice.compact**.
+
+The memory and the cost of a Monte Carlo Step are thus proportional to the area of the tissue, plus a margin of at most
+a tile around it, rather than to the area of the lattice. Only the index of the tiles, one int32 per tile position, spans
+the whole lattice.
+
+The "tiled" sampler draws a stored tile uniformly, then a pixel of the tile, and proceeds as **kernels.pick_pixel**. As
+every pixel with a neighbour of a different index is stored, it draws uniformly among the same pairs of pixels and
+neighbours as the "uniform" sampler, and is statistically equivalent to it per step. It supports the area, perimeter and
+adhesion terms of the energy functional, but not the extra terms, the contacts, the geometry and the statistics of the
+other samplers, which address the dense sigma field.
+"""
+
+import numpy as np
+from numba import jit
+from scipy import sparse
+
+from .kernels import attempt_flip, get_s2
+from .population import force_flips
+from .rng import random
+
+MAX_NEW_TILES = 4  # tiles created by a single write, at a corner of a tile that is not stored yet.
+
+
+class TiledLattice:
+    """
+    **TiledLattice** class, the sigma field of a (num_x x num_y) lattice, stored as a pool of tiles.
+
+    - tiles: (capacity x tile_size + 2 x tile_size + 2) array of the cell indices of the stored tiles, with their halos.
+    Only the first n_tiles entries are in use.
+    - tile_index: (n_tx x n_ty) int32 array of the slot of every tile position in the pool, -1 if it is not stored.
+    - tile_pos: (capacity x 2) int array of the tile position of every slot.
+    Pixel (x, y) of the lattice is pixel (x % tile_size + 1, y % tile_size + 1) of tile (x // tile_size, y // tile_size).
+    """
+
+    def __init__(self, num_x, num_y, tile_size=32, dtype=np.uint16, capacity=16):
+        """
+        Initialise **TiledLattice** class, with all pixels medium and no tile stored.
+        @param num_x: Number of pixels in the x-dimension of the lattice.
+        @param num_y: Number of pixels in the y-dimension of the lattice.
+        @param tile_size: Side of the tiles, in pixels.
+        @param dtype: Integer type of the cell indices.
+        @param capacity: Initial number of tiles of the pool, doubled when exhausted.
+        """
+        self.num_x, self.num_y, self.tile_size = num_x, num_y, tile_size
+        n_tx, n_ty = -(-num_x // tile_size), -(-num_y // tile_size)
+        self.tile_index = -np.ones((n_tx, n_ty), dtype=np.int32)
+        self.tiles = np.zeros((capacity, tile_size + 2, tile_size + 2), dtype=dtype)
+        self.tile_pos = np.zeros((capacity, 2), dtype=np.int64)
+        self.count = np.zeros(1, dtype=np.int64)  # number of stored tiles, as an array for the kernels to update.
+
+    @classmethod
+    def from_dense(cls, I, tile_size=32):
+        """
+        Tiled copy of the dense sigma field I.
+        """
+        lattice = cls(I.shape[0], I.shape[1], tile_size, I.dtype)
+        x, y = np.nonzero(I)
+        lattice.set_pixels(x, y, I[x, y])
+        return lattice
+
+    @property
+    def n_tiles(self):
+        """
+        Number of stored tiles.
+        """
+        return int(self.count[0])
+
+    @property
+    def dtype(self):
+        return self.tiles.dtype
+
+    @property
+    def nbytes(self):
+        """
+        Memory of the lattice in bytes, including the spare capacity of the pool and the index of the tiles.
+        """
+        return self.tiles.nbytes + self.tile_pos.nbytes + self.tile_index.nbytes
+
+    def grow(self, capacity):
+        """
+        Enlarge the pool to **capacity** tiles, copying the stored tiles.
+        """
+        n = len(self.tiles)
+        if capacity <= n:
+            return
+        self.tiles = np.concatenate((self.tiles, np.zeros((capacity - n,) + self.tiles.shape[1:], dtype=self.dtype)))
+        self.tile_pos = np.concatenate((self.tile_pos, np.zeros((capacity - n, 2), dtype=np.int64)))
+
+    def make_room(self):
+        """
+        Double the capacity of the pool once it is three quarters full, or too full for the kernels to proceed, such
+        that tiles are created at amortised O(1) reallocations.
+        """
+        if self.n_tiles + max(MAX_NEW_TILES + 1, len(self.tiles) // 4) > len(self.tiles):
+            self.grow(2 * len(self.tiles))
+
+    def astype(self, dtype):
+        """
+        Convert the cell indices to the integer type dtype, e.g. when the number of cells grows (see
+        **CPM.fit_sigma_dtype**).
+        """
+        if self.dtype != dtype:
+            self.tiles = self.tiles.astype(dtype)
+
+    def clear(self):
+        """
+        Set all pixels to the medium, dropping all tiles.
+        """
+        n = self.n_tiles
+        self.tile_index[self.tile_pos[:n, 0], self.tile_pos[:n, 1]] = -1
+        self.count[0] = 0
+
+    def compact(self):
+        """
+        Drop the tiles whose pixels and halo are all medium, i.e. the tiles that are no longer in contact with a cell,
+        moving the remaining tiles to the front of the pool. O(number of stored tiles).
+        """
+        n = self.n_tiles
+        keep = self.tiles[:n].reshape(n, -1).any(axis=1)
+        if keep.all():
+            return
+        pos = self.tile_pos[:n]
+        self.tile_index[pos[~keep, 0], pos[~keep, 1]] = -1
+        m = int(np.sum(keep))
+        self.tiles[:m], self.tile_pos[:m] = self.tiles[:n][keep], pos[keep]
+        self.tile_index[self.tile_pos[:m, 0], self.tile_pos[:m, 1]] = np.arange(m)
+        self.count[0] = m
+
+    def set_pixels(self, x, y, values):
+        """
+        Set pixels (x[k], y[k]) of the lattice to the cell indices values[k], in order, creating tiles as needed.
+        Does not update the areas and perimeters of the cells (see **CPM.assign_AP**).
+        @param x, y: int arrays of the coordinates of the pixels.
+        @param values: Cell index of every pixel, or a single cell index for all of them.
+        """
+        x, y = np.asarray(x, dtype=np.int64).ravel(), np.asarray(y, dtype=np.int64).ravel()
+        values = np.broadcast_to(np.asarray(values, dtype=self.dtype), x.shape)
+        start = 0
+        while start < len(x):
+            self.make_room()
+            start = write_pixels(start, x, y, values, self.tiles, self.tile_index, self.tile_pos, self.count)
+
+    def force_flips(self, pixels, s2, A, P, lambda_A, lambda_P, A0, P0, adhesion):
+        """
+        Swap pixels to cell index s2, regardless of the zmasks, as **population.force_flips** on the dense sigma field.
+        @return: dE, the change in the total energy.
+        """
+        dE, start = 0., 0
+        while start < len(pixels):
+            self.make_room()
+            start, dE = force_flips_tiled(start, dE, pixels, s2, self.tiles, self.tile_index, self.tile_pos,
+                                          self.count, A, P, lambda_A, lambda_P, A0, P0, adhesion)
+        return dE
+
+    def get_interiors(self):
+        """
+        View of the interiors of the stored tiles, without their halos, and the lattice coordinates of their first
+        pixels.
+        @return: (n_tiles x tile_size x tile_size) array, and (n_tiles x 2) int array.
+        """
+        n = self.n_tiles
+        return self.tiles[:n, 1:-1, 1:-1], self.tile_pos[:n] * self.tile_size
+
+    def get_pixels(self, s):
+        """
+        @return: (A x 2) array of the (x, y) coordinates of the pixels of cell s. O(number of stored tiles).
+        """
+        interiors, origins = self.get_interiors()
+        k, a, b = np.nonzero(interiors == s)
+        return np.stack((origins[k, 0] + a, origins[k, 1] + b), axis=1)
+
+    def get_window(self, x0=0, x1=None, y0=0, y1=None):
+        """
+        Dense copy of the window [x0, x1) x [y0, y1) of the lattice, assembled from the stored tiles that overlap it,
+        e.g. to render part of a large lattice (see **CPM.get_field**).
+        """
+        x1 = self.num_x if x1 is None else x1
+        y1 = self.num_y if y1 is None else y1
+        T = self.tile_size
+        I = np.zeros((x1 - x0, y1 - y0), dtype=self.dtype)
+        block = self.tile_index[x0 // T:-(-x1 // T), y0 // T:-(-y1 // T)]
+        for tx, ty in np.argwhere(block >= 0) + (x0 // T, y0 // T):
+            a0, b0 = max(x0 - tx * T, 0), max(y0 - ty * T, 0)
+            a1, b1 = min(x1 - tx * T, T), min(y1 - ty * T, T)
+            I[tx * T + a0 - x0:tx * T + a1 - x0, ty * T + b0 - y0:ty * T + b1 - y0] = \
+                self.tiles[self.tile_index[tx, ty], a0 + 1:a1 + 1, b0 + 1:b1 + 1]
+        return I
+
+    def to_dense(self):
+        """
+        Dense (num_x x num_y) copy of the sigma field.
+        """
+        return self.get_window()
+
+    def to_sparse(self):
+        """
+        Copy of the sigma field as a csr sparse matrix (scipy.sparse module), built from the stored tiles without a
+        dense intermediate, e.g. for the snapshots of **CPM.simulate**.
+        """
+        interiors, origins = self.get_interiors()
+        k, a, b = np.nonzero(interiors)
+        return sparse.csr_matrix((interiors[k, a, b], (origins[k, 0] + a, origins[k, 1] + b)),
+                                 shape=(self.num_x, self.num_y))
+
+    def get_neighbour_pairs(self):
+        """
+        Cell indices at both ends of every pair of Moore neighbours whose first pixel is stored, enumerated once as in
+        **CPM.get_neighbour_pairs**, but from the tiles and their halos. Pairs whose first pixel is not stored are
+        both medium.
+        @return: list of four (I1, I2) tuples of (n_tiles x tile_size x tile_size) arrays.
+        """
+        n, T = self.n_tiles, self.tile_size
+        return [(self.tiles[:n, 1:-1, 1:-1], self.tiles[:n, 1 + di:T + 1 + di, 1 + dj:T + 1 + dj])
+                for di, dj in ((1, 0), (0, 1), (1, 1), (1, -1))]
+
+    def get_perimeters_and_areas(self, perim_neighbour, n=None):
+        """
+        Areas and perimeters of all cells, from the stored tiles, as **CPM.get_perimeters_and_areas**.
+        @param perim_neighbour: (8 x 2) array of the shifts of the Moore neighbours.
+        @param n: Length of the returned vectors, at least the largest index + 1.
+        @return: P, A: vectors of perimeters and areas, indexed by cell index. Those of the medium, index 0, are 0.
+        """
+        interiors, _ = self.get_interiors()
+        T = self.tile_size
+        n = max(n if n is not None else 0, int(interiors.max(initial=0)) + 1)
+        A = np.bincount(interiors.ravel(), minlength=n)
+        P = np.zeros(n, dtype=A.dtype)
+        for i, j in perim_neighbour:
+            P += np.bincount(interiors[interiors != self.tiles[:self.n_tiles, 1 + i:T + 1 + i, 1 + j:T + 1 + j]],
+                             minlength=n)
+        A[0], P[0] = 0, 0
+        return P, A
+
+    def run(self, n_steps, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T, allowed, rng):
+        """
+        Perform **n_steps** flip attempts of the "tiled" sampler (see **do_steps_tiled**), growing the pool as tiles are
+        created. Tiles left entirely medium are dropped once the run has visited every stored pixel about once.
+        @return: dE, the change in the total energy.
+        """
+        dE, done, n_stored = 0., 0, self.n_tiles
+        while done < n_steps:
+            self.make_room()
+            n_done, dE_run = do_steps_tiled(n_steps - done, self.tiles, self.tile_index, self.tile_pos, self.count,
+                                            self.num_x, self.num_y, dP_table, A, P, lambda_A, lambda_P, A0, P0,
+                                            adhesion, T, allowed, rng)
+            done += n_done
+            dE += dE_run
+        if n_steps >= n_stored * self.tile_size ** 2:
+            self.compact()
+        return dE
+
+
+@jit(nopython=True)
+def new_tile(tiles, tile_index, tile_pos, count, tx, ty):
+    """
+    Store tile (tx, ty) in the next slot of the pool, with all its pixels medium, and its halo copied from the
+    neighbouring tiles. The pool must have a free slot.
+    @return: k, the slot of the tile.
+    """
+    size = tiles.shape[1] - 2
+    k = count[0]
+    count[0] += 1
+    tiles[k] = 0
+    tile_index[tx, ty] = k
+    tile_pos[k, 0], tile_pos[k, 1] = tx, ty
+    for a in range(size + 2):
+        for b in range(size + 2):
+            if (0 < a < size + 1) and (0 < b < size + 1):
+                continue
+            x, y = tx * size + a - 1, ty * size + b - 1
+            if (x < 0) or (y < 0):
+                continue
+            ox, oy = x // size, y // size
+            if (ox < tile_index.shape[0]) and (oy < tile_index.shape[1]) and (tile_index[ox, oy] >= 0):
+                tiles[k, a, b] = tiles[tile_index[ox, oy], x - ox * size + 1, y - oy * size + 1]
+    return k
+
+
+@jit(nopython=True)
+def write_pixel(tiles, tile_index, tile_pos, count, x, y, v):
+    """
+    Set pixel (x, y) of the lattice to cell index v: in the tile that holds it, and in the halos of the neighbouring
+    tiles. If v is a cell, the tiles that hold (x, y) in their interior or halo are created if they are not stored, which
+    requires up to **MAX_NEW_TILES** free slots in the pool.
+    """
+    size = tiles.shape[1] - 2
+    tx, ty = x // size, y // size
+    for ux in range(max(tx - 1, 0), min(tx + 2, tile_index.shape[0])):
+        a = x - ux * size + 1
+        if (a < 0) or (a > size + 1):
+            continue
+        for uy in range(max(ty - 1, 0), min(ty + 2, tile_index.shape[1])):
+            b = y - uy * size + 1
+            if (b < 0) or (b > size + 1):
+                continue
+            k = tile_index[ux, uy]
+            if k < 0:
+                if v == 0:
+                    continue
+                k = new_tile(tiles, tile_index, tile_pos, count, ux, uy)
+            tiles[k, a, b] = v
+
+
+@jit(nopython=True)
+def write_pixels(start, x, y, values, tiles, tile_index, tile_pos, count):
+    """
+    Write pixels start, start + 1, ... with **write_pixel**, until all are written or the pool is nearly full.
+    @return: the index of the next pixel to write.
+    """
+    for k in range(start, len(x)):
+        if count[0] + MAX_NEW_TILES > len(tiles):
+            return k
+        write_pixel(tiles, tile_index, tile_pos, count, x[k], y[k], values[k])
+    return len(x)
+
+
+@jit(nopython=True)
+def force_flips_tiled(start, dE, pixels, s2, tiles, tile_index, tile_pos, count, A, P, lambda_A, lambda_P, A0, P0,
+                      adhesion):
+    """
+    Swap pixels start, start + 1, ... to cell index s2 with **population.force_flips**, applied to the tile of each
+    pixel in its local coordinates, until all are swapped or the pool is nearly full.
+    @return: the index of the next pixel to swap, and the updated change in energy dE.
+    """
+    size = tiles.shape[1] - 2
+    local = np.empty((1, 2), dtype=np.int64)
+    for n in range(start, len(pixels)):
+        if count[0] + MAX_NEW_TILES + 1 > len(tiles):
+            return n, dE
+        x, y = pixels[n, 0], pixels[n, 1]
+        k = tile_index[x // size, y // size]
+        if k < 0:
+            k = new_tile(tiles, tile_index, tile_pos, count, x // size, y // size)
+        local[0, 0], local[0, 1] = x % size + 1, y % size + 1
+        dE += force_flips(local, s2, tiles[k], A, P, lambda_A, lambda_P, A0, P0, adhesion)
+        write_pixel(tiles, tile_index, tile_pos, count, x, y, tiles[k, local[0, 0], local[0, 1]])
+    return len(pixels), dE
+
+
+@jit(nopython=True)
+def do_steps_tiled(n_steps, tiles, tile_index, tile_pos, count, num_x, num_y, dP_table, A, P, lambda_A, lambda_P, A0,
+                   P0, adhesion, T, allowed, rng):
+    """
+    Perform up to n_steps flip attempts of the "tiled" sampler. The tiles, A and P are modified in place, and tiles are
+    created as cells grow into them. Stops early when the pool is nearly full, such that it can be enlarged.
+
+    A stored tile is drawn uniformly, then a pixel of its interior, away from the border of the lattice, and one of its
+    Neumann neighbours, until they differ, as in **kernels.pick_pixel**. The swap is then attempted on the tile with
+    **kernels.attempt_flip**, in the local coordinates of the tile.
+
+    @param tiles, tile_index, tile_pos, count: Arrays of the **TiledLattice**.
+    @param num_x: Number of pixels in the x-dimension of the lattice.
+    @param num_y: Number of pixels in the y-dimension of the lattice.
+    For the remaining parameters, see **kernels.do_steps**.
+    @return: The number of attempts performed, and dE, the change in the total energy.
+    """
+    size = tiles.shape[1] - 2
+    dE = 0.
+    for step in range(n_steps):
+        if count[0] + MAX_NEW_TILES > len(tiles):
+            return step, dE
+        picked = False
+        while picked is False:
+            k = int(random(rng) * count[0])
+            a = 1 + int(random(rng) * size)
+            b = 1 + int(random(rng) * size)
+            x, y = tile_pos[k, 0] * size + a - 1, tile_pos[k, 1] * size + b - 1
+            if (0 < x < num_x - 1) and (0 < y < num_y - 1):
+                I = tiles[k]
+                s = I[a, b]
+                s2 = get_s2(I, a, b, size + 2, size + 2, rng)
+                picked = s != s2
+        accepted, dH = attempt_flip(I, a, b, s, s2, dP_table, A, P, lambda_A, lambda_P, A0, P0, adhesion, T, allowed,
+                                    rng, None, None, None, None, None)
+        if accepted:
+            write_pixel(tiles, tile_index, tile_pos, count, x, y, s2)
+            dE += dH
+    return n_steps, dE
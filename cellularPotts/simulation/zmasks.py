@@ -41,6 +41,8 @@ class Zmasks:
     - zmasks are hashed by multiplying element-wise a (3x3) matrix, which contains powers of 2. This is the matrix,
     **primes**.
     - The hash is the sum of the element-wise multiplication between zmask and primes.
+    - As primes are powers of 2, the hash is a 9-bit integer, with bit (3 * a + b) set if zmask[a, b] is True. The
+    hashes therefore index directly into the dense 512-entry tables **allowed** and **dP_table**.
     """
 
     def __init__(self):
@@ -113,6 +115,20 @@ class Zmasks:
         ##Establish the hashing for the acceptable z_masks. Explanation in the doc-string of the class.
         self.primes = 2 ** np.arange(9).reshape(3, 3)
         self.hashes = np.sum(self.z_masks * self.primes, axis=(1, 2))
+        self.get_lookup_tables()
+
+
+    def get_lookup_tables(self):
+        """
+        Build dense tables, indexed by the 9-bit hash of a zmask, such that a neighbourhood can be checked in O(1).
+
+        self.allowed is a (512,) boolean array, True if the hash corresponds to an acceptable zmask.
+        self.dP_table is a (512,) int array of the change in perimeter for each acceptable zmask (0 otherwise).
+        """
+        self.allowed = np.zeros(512, dtype=bool)
+        self.allowed[self.hashes] = True
+        self.dP_table = np.zeros(512, dtype=self.dP_z.dtype)
+        self.dP_table[self.hashes] = self.dP_z
 
 
     def r0(self, x):
@@ -0,0 +1,177 @@
+"""
+Statistical-equivalence validation of the CPM samplers.
+
+Runs the reference sampler ("uniform", i.e. **kernels.do_steps**) and candidate samplers on small seeded lattices, from
+the same initialised tissue, and compares the distributions of the mean and spread of cell areas and perimeters, total
+energy and contact fractions with two-sample statistical tests. The throughput of every sampler is reported side by
+side.
+
+Each replica starts from the same tissue with an independent random number stream (see **CPM.set_seed**), such that
+replicas are independent samples of the dynamics, and a whole validation run is reproducible from its seed. Every
+observable is reduced to one value per replica, as the cells of a replica interact and are not independent samples.
+The replicas of "tiled" run on a **TiledLattice** copy of the tissue (see **CPM.make_grid**). The samplers that follow
+the dynamics of the reference ("interface", "rejection_free", "checkerboard", "tiled") can be compared after any number
+of MCS. "heat_bath" relaxes to the same states with different dynamics, and is only expected to pass once both
+samplers have relaxed, which takes about 20 MCS with the default settings.
+
+Run from the project directory:
+   python validation.py                         # all samplers against "uniform"
+   python validation.py checkerboard --mcs 200  # one candidate, longer runs
+"""
+
+#################################
+
+# System modules
+import argparse
+import time
+
+# Installed modules
+import numpy as np
+from scipy import stats
+
+# Local modules
+from benchmark import make_tissue
+from simulation.tiles import TiledLattice
+
+#################################
+
+def contact_fractions(cpm):
+    """
+    Fractions of the contacts of cells (pairs of Moore neighbours in different indices, with at least one cell) that
+    are homotypic (between cells of the same type), and that are with the medium.
+    """
+    n_cells, n_homotypic, n_medium = 0, 0, 0
+    I = cpm.get_field()
+    T = cpm.cell_type[I]
+    for (I1, I2), (T1, T2) in zip(cpm.get_neighbour_pairs(I), cpm.get_neighbour_pairs(T)):
+        contact = I1 != I2
+        medium = contact & ((I1 == 0) | (I2 == 0))
+        n_medium += np.sum(medium)
+        n_cells += np.sum(contact & ~medium)
+        n_homotypic += np.sum(contact & ~medium & (T1 == T2))
+    total = max(n_cells + n_medium, 1)
+    return n_homotypic / max(n_cells, 1), n_medium / total
+
+
+def run_replicas(cpm, sampler, n_replicas, n_mcs, n_samples, seed, tile_size=16):
+    """
+    Run **n_replicas** independent replicas of **sampler** from the current state of the CPM object, which is restored
+    afterwards. The replicas of "tiled" run on a **TiledLattice** of tiles of **tile_size** pixels, built from the
+    dense sigma field.
+
+    Each replica runs for **n_mcs** MCS; the observables are sampled **n_samples** times over the second half of the
+    run, and averaged over the samples. The areas and perimeters of the cells are reduced to their mean and standard
+    deviation over the cells of the replica.
+    @return: dictionary of the observables, one value per replica. elapsed, the wall-clock time of the sampling, and
+    n_attempts, the number of flip attempts performed.
+    """
+    sigma_0, A_0, P_0, rng_0 = cpm.sigma_field.copy(), cpm.A.copy(), cpm.P.copy(), cpm.rng.copy()
+    sample = cpm.sample
+    sample.sampler = sampler
+
+    def reset():
+        cpm.A, cpm.P = A_0.copy(), P_0.copy()
+        if sampler == "tiled":
+            cpm.sigma_field, cpm.lattice = None, TiledLattice.from_dense(sigma_0, tile_size)
+        else:
+            cpm.sigma_field = sigma_0.copy()
+        cpm.energy = None
+
+    reset()
+    sample.run(1)  # compile outside of the timing.
+    attempts = sample.attempts_per_mcs
+    n_burn = int(n_mcs / 2 * attempts)
+    n_every = int(n_mcs / 2 / n_samples * attempts)
+
+    names = ("mean area", "area sd", "mean perimeter", "perimeter sd", "energy", "homotypic contacts",
+             "medium contacts")
+    obs = {name: [] for name in names}
+    elapsed = 0.
+    for r in range(n_replicas):
+        reset()
+        cpm.set_seed(seed, stream=r)
+        t0 = time.perf_counter()
+        sample.run(n_burn)
+        elapsed += time.perf_counter() - t0
+        samples = []
+        for _ in range(n_samples):
+            t0 = time.perf_counter()
+            sample.run(n_every)
+            elapsed += time.perf_counter() - t0
+            cells = cpm.cell_ids
+            A, P = cpm.A[cells], cpm.P[cells]
+            samples.append((A.mean(), A.std(), P.mean(), P.std(), cpm.energy) + contact_fractions(cpm))
+        for name, value in zip(names, np.mean(samples, axis=0)):
+            obs[name].append(value)
+
+    cpm.sigma_field, cpm.lattice, cpm.A, cpm.P = sigma_0, None, A_0, P_0
+    cpm.rng[:] = rng_0
+    cpm.energy = None
+    return obs, elapsed, n_replicas * (n_burn + n_samples * n_every)
+
+
+def compare(reference, candidate):
+    """
+    Two-sample tests of every observable of a candidate against the reference.
+
+    The observables hold one value per replica, which are independent between replicas, and are compared with the
+    Kolmogorov-Smirnov test on their distributions and Welch's t-test on their means.
+    @return: list of (observable, test, statistic, p-value, reference mean, candidate mean).
+    """
+    results = []
+    for name in reference:
+        x, y = np.array(reference[name]), np.array(candidate[name])
+        ks = stats.ks_2samp(x, y)
+        results.append((name, "KS", ks.statistic, ks.pvalue, x.mean(), y.mean()))
+        t = stats.ttest_ind(x, y, equal_var=False)
+        results.append((name, "Welch t", t.statistic, t.pvalue, x.mean(), y.mean()))
+    return results
+
+
+def validate(candidates=("interface", "rejection_free", "heat_bath", "checkerboard", "tiled"), n_replicas=20,
+             n_mcs=40, n_samples=10, alpha=0.01, seed=0, width=40, height=40, cell_number=(4, 4, 3)):
+    """
+    Compare candidate samplers with the reference "uniform" sampler on a small seeded lattice.
+
+    A candidate passes if no test rejects equivalence at level **alpha**, with a Bonferroni correction over the tests
+    of the candidate. As the tests compare values that are independent between replicas (see **run_replicas**), a
+    correct sampler thus fails with probability at most **alpha**.
+    @return: dictionary of booleans, True if the candidate passed.
+    """
+    cpm = make_tissue(width, height, list(cell_number), seed=seed)
+    print("Validation against \"uniform\" (%d x %d lattice, %d cells, kT = %g, %d replicas of %g MCS)"
+          % (cpm.num_x, cpm.num_y, len(cpm.cell_ids), cpm.sample.T, n_replicas, n_mcs))
+
+    reference, elapsed, n_attempts = run_replicas(cpm, "uniform", n_replicas, n_mcs, n_samples, seed)
+    rate_ref = n_attempts / elapsed
+    print("  %-15s %12.0f attempts/s" % ("uniform", rate_ref))
+
+    passed = {}
+    for sampler in candidates:
+        candidate, elapsed, n_attempts = run_replicas(cpm, sampler, n_replicas, n_mcs, n_samples, seed + 1)
+        results = compare(reference, candidate)
+        threshold = alpha / len(results)
+        passed[sampler] = all(p >= threshold for _, _, _, p, _, _ in results)
+        print("  %-15s %12.0f attempts/s (%.1fx)   %s"
+              % (sampler, n_attempts / elapsed, n_attempts / elapsed / rate_ref, "PASS" if passed[sampler] else "FAIL"))
+        for name, test, statistic, p, x, y in results:
+            print("      %-20s %-8s stat %8.3f  p %.3g %s  (mean %.4g vs %.4g)"
+                  % (name, test, statistic, p, "*" if p < threshold else " ", x, y))
+    return passed
+
+
+#################################
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("candidates", nargs="*", default=["interface", "rejection_free", "heat_bath",
+                                                                 "checkerboard", "tiled"])
+    parser.add_argument("--replicas", type=int, default=20)
+    parser.add_argument("--mcs", type=float, default=40)
+    parser.add_argument("--alpha", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    passed = validate(args.candidates, args.replicas, args.mcs, alpha=args.alpha, seed=args.seed)
+    raise SystemExit(0 if all(passed.values()) else 1)